@@ -0,0 +1,138 @@
+"""per-chat actors: the updates of a chat are handled one at a time, and each chat owns the transfer running for it"""
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Coroutine
+from settings import settings
+import metrics
+
+log = logging.getLogger(__name__)
+
+# the updates of one chat waiting to be handled, and the transfer (a file delivery) running for it
+class ChatActor:
+	def __init__(self, chat_id: int):
+		self.chat_id = chat_id
+		self.inbox: deque[tuple[Callable[[Any], Awaitable], Any]] = deque()
+		self.handling = False
+		self.transfer: asyncio.Task | None = None
+		self.task: asyncio.Task | None = None
+		self.wakeup = asyncio.Event()
+		self.idle = asyncio.Event()
+		self.idle.set()
+
+	def busy(self) -> bool:
+		return bool(self.inbox) or self.handling or (self.transfer is not None and not self.transfer.done())
+
+# every chat gets an actor that handles its updates in arrival order, so two updates of a chat never race on its
+# session, while the actors of different chats run side by side. a transfer runs beside the updates of its chat,
+# so the chat can keep browsing while files arrive, until the chat replaces or cancels it. a chat may have at most
+# max_pending updates waiting, more are dropped, and an actor with nothing to do for idle_timeout seconds goes away.
+class ChatActors:
+	def __init__(self, max_pending: int, idle_timeout: float):
+		self.max_pending = max_pending
+		self.idle_timeout = idle_timeout
+		self.dropped = 0
+		self._actors: dict[int, ChatActor] = {}
+
+	def __len__(self) -> int:
+		return len(self._actors)
+
+	def _actor(self, chat_id: int) -> ChatActor:
+		actor = self._actors.get(chat_id)
+		if actor is None:
+			actor = self._actors[chat_id] = ChatActor(chat_id)
+			actor.task = asyncio.create_task(self._run(actor))
+		return actor
+
+	@staticmethod
+	def _update_idle(actor: ChatActor) -> None:
+		if actor.busy():
+			actor.idle.clear()
+		else:
+			actor.idle.set()
+
+	def submit(self, chat_id: int, handler: Callable[[Any], Awaitable], event: Any) -> bool:
+		"""Queue an update for its chat's actor, returning False when the chat has too many updates waiting."""
+		actor = self._actor(chat_id)
+		if len(actor.inbox) >= self.max_pending:
+			self.dropped += 1
+			log.warning(f"Chat {chat_id} has {len(actor.inbox)} updates waiting, dropping one")
+			return False
+		actor.inbox.append((handler, event))
+		actor.idle.clear()
+		actor.wakeup.set()
+		return True
+
+	async def _handle(self, actor: ChatActor, handler: Callable[[Any], Awaitable], event: Any) -> None:
+		# every update runs in a task of its own, so one that ends cancelled does not take the actor down with it
+		task = asyncio.create_task(handler(event))
+		try:
+			await asyncio.wait([task])
+		except asyncio.CancelledError:
+			task.cancel()
+			await asyncio.gather(task, return_exceptions=True)
+			raise
+		if task.cancelled():
+			log.warning(f"Update of chat {actor.chat_id} was cancelled")
+		elif task.exception() is not None:
+			log.warning(f"Update of chat {actor.chat_id} failed: {task.exception()}")
+
+	async def _run(self, actor: ChatActor) -> None:
+		try:
+			while True:
+				while actor.inbox:
+					handler, event = actor.inbox.popleft()
+					actor.handling = True
+					try:
+						await self._handle(actor, handler, event)
+					finally:
+						actor.handling = False
+				self._update_idle(actor)
+				actor.wakeup.clear()
+				try:
+					await asyncio.wait_for(actor.wakeup.wait(), self.idle_timeout)
+				except asyncio.TimeoutError:
+					if not actor.busy():
+						return
+		finally:
+			# an actor that is gone for whatever reason is replaced by a new one on the next update of its chat
+			if self._actors.get(actor.chat_id) is actor:
+				del self._actors[actor.chat_id]
+
+	def start_transfer(self, chat_id: int, coroutine: Coroutine) -> asyncio.Task:
+		"""Run a coroutine as the transfer of a chat, cancelling the one it had before."""
+		actor = self._actor(chat_id)
+		if actor.transfer is not None:
+			actor.transfer.cancel()
+		actor.transfer = asyncio.create_task(coroutine)
+		actor.transfer.add_done_callback(lambda _: self._update_idle(actor))
+		actor.idle.clear()
+		return actor.transfer
+
+	async def cancel_transfer(self, chat_id: int) -> bool:
+		"""Cancel the transfer of a chat and wait until it let go of its resources, returning whether one was running."""
+		actor = self._actors.get(chat_id)
+		if actor is None or actor.transfer is None or actor.transfer.done():
+			return False
+		actor.transfer.cancel()
+		await asyncio.gather(actor.transfer, return_exceptions=True)
+		return True
+
+	async def wait_idle(self, chat_id: int) -> None:
+		"""Wait until a chat has no update waiting or being handled and no transfer running."""
+		actor = self._actors.get(chat_id)
+		if actor is not None:
+			await actor.idle.wait()
+
+	async def stop(self) -> None:
+		"""Cancel every actor and transfer."""
+		tasks = [task for actor in self._actors.values() for task in (actor.task, actor.transfer) if task is not None]
+		for task in tasks:
+			task.cancel()
+		await asyncio.gather(*tasks, return_exceptions=True)
+		self._actors.clear()
+
+# the actors of every chat the bot is talking to
+actors = ChatActors(settings.CHAT_MAX_PENDING_UPDATES, settings.CHAT_ACTOR_IDLE_TIMEOUT)
+metrics.Observed("bot_chat_actors", "Chats with an actor handling their updates or running a delivery.", "gauge", lambda: len(actors))
+metrics.Observed("bot_chat_updates_dropped_total", "Updates dropped because too many of their chat were waiting.", "counter", lambda: actors.dropped)
@@ -0,0 +1 @@
+"""offline benchmarks of the bot against a local stand-in of the site and a fake telegram client"""
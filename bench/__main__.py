@@ -0,0 +1,214 @@
+"""run the offline benchmark: python -m bench --users 200 --output results.json [--baseline previous.json]"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+# the bot's modules are imported only after the environment points them at the stand-in site
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.site import FakeSite, SiteConfig  # noqa: E402
+from bench.telegram import FakeTelegramClient  # noqa: E402
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+	parser = argparse.ArgumentParser(prog="python -m bench", description="Replay simulated users through the bot against a local stand-in of the site and telegram.")
+	parser.add_argument("--users", type=int, default=100, help="simulated chats")
+	parser.add_argument("--scenario", action="append", choices=("browse", "textbook", "search"), help="scenario to run, may be repeated (default: all)")
+	parser.add_argument("--ramp", type=float, default=5.0, help="seconds over which the users start")
+	parser.add_argument("--think-time", type=float, default=0.0, help="mean seconds a user waits between steps")
+	parser.add_argument("--seed", type=int, default=1)
+	parser.add_argument("--posts", type=int, default=150, help="posts per category")
+	parser.add_argument("--files-per-post", type=int, default=3)
+	parser.add_argument("--file-size", type=int, default=2 * 1024 * 1024, help="bytes per file")
+	parser.add_argument("--site-latency", type=float, default=0.02, help="seconds added to every site response")
+	parser.add_argument("--site-bandwidth", type=float, default=0, help="file bytes per second per download (0 for unlimited)")
+	parser.add_argument("--no-ranges", action="store_true", help="make the file host ignore byte ranges")
+	parser.add_argument("--site-drop-rate", type=float, default=0, help="chance a file response is cut off halfway")
+	parser.add_argument("--telegram-latency", type=float, default=0.01, help="seconds every telegram call takes")
+	parser.add_argument("--upload-bandwidth", type=float, default=0, help="upload bytes per second per file, or per connection for parallel uploads (0 for unlimited)")
+	parser.add_argument("--no-catalog", action="store_true", help="browse from the WordPress API instead of a synced catalog")
+	parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE", help="override a bot setting, may be repeated")
+	parser.add_argument("--output", default="bench_results.json", help="where to write the JSON report")
+	parser.add_argument("--baseline", help="earlier JSON report to compare against")
+	return parser.parse_args(argv)
+
+def configure_environment(args: argparse.Namespace, base_url: str, workdir: str) -> dict:
+	"""Point the bot's settings at the stand-in site and a scratch directory, returning the overrides applied."""
+	overrides = {
+		"BASE_URL": base_url,
+		"API_ID": "1",
+		"API_HASH": "bench",
+		"BOT_TOKEN": "bench",
+		"CHANNEL_USERNAME": "@bench",
+		"MEMBERSHIP_CHECK_ENABLED": "false",
+		"FILE_CACHE_PATH": os.path.join(workdir, "file_cache.db"),
+		"SESSION_DB_PATH": os.path.join(workdir, "sessions.db"),
+		"CATALOG_PATH": os.path.join(workdir, "catalog.db"),
+		"DOWNLOAD_CACHE_DIR": os.path.join(workdir, "download_cache"),
+		"CATALOG_ENABLED": "false" if args.no_catalog else "true"
+	}
+	for assignment in args.set:
+		name, _, value = assignment.partition("=")
+		overrides[name.strip()] = value.strip()
+	os.environ.update(overrides)
+	return overrides
+
+def peak_rss_mb() -> float:
+	# ru_maxrss is in kilobytes on linux and in bytes on macOS
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def compare(report: dict, baseline: dict) -> None:
+	"""Print how the latency percentiles and throughput moved against an earlier report."""
+	print(f"\nCompared with {baseline.get('started', 'baseline')}:")
+	for name, stats in report["transitions"].items():
+		before = baseline.get("transitions", {}).get(name)
+		if not before:
+			print(f"  {name:<16} new")
+			continue
+		changes = []
+		for key in ("p50_ms", "p95_ms", "p99_ms"):
+			change = (stats[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+			changes.append(f"{key[:-3]} {before[key]:.1f} -> {stats[key]:.1f} ms ({change:+.0f}%)")
+		print(f"  {name:<16} " + ", ".join(changes))
+	before = baseline.get("throughput", {}).get("transitions_per_s")
+	if before:
+		print(f"  throughput       {before} -> {report['throughput']['transitions_per_s']} transitions/s")
+	before = baseline.get("event_loop_lag", {}).get("p99_ms")
+	if before is not None and report.get("event_loop_lag"):
+		print(f"  loop lag p99     {before} -> {report['event_loop_lag']['p99_ms']} ms")
+	before = baseline.get("peak_rss_mb")
+	if before:
+		print(f"  peak RSS         {before} -> {report['peak_rss_mb']} MB")
+
+def print_report(report: dict) -> None:
+	print(f"\n{'transition':<16}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+	for name, stats in report["transitions"].items():
+		print(f"{name:<16}{stats['count']:>7}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}{stats['max_ms']:>10.1f}")
+	throughput = report["throughput"]
+	print(f"\n{throughput['transitions_per_s']} transitions/s, {throughput['files_per_s']} files/s over {report['duration_s']} s")
+	print(f"peak RSS {report['peak_rss_mb']} MB, site sent {report['bytes']['site_sent']} bytes, telegram received {report['bytes']['uploaded']} bytes")
+	lag = report.get("event_loop_lag")
+	if lag:
+		print(f"event loop lag p50 {lag['p50_ms']} ms, p99 {lag['p99_ms']} ms, max {lag['max_ms']} ms")
+	if report["errors"]:
+		print(f"errors: {report['errors']}")
+
+async def run(args: argparse.Namespace) -> dict:
+	scenarios = args.scenario or ["browse", "textbook", "search"]
+	if args.no_catalog and "search" in scenarios:
+		scenarios.remove("search")
+		if not scenarios:
+			raise SystemExit("search needs the catalog")
+
+	workdir = tempfile.mkdtemp(prefix="bot-bench-")
+	# the categories are only known once the bot is imported, so the site learns them after it is listening
+	site = FakeSite(SiteConfig(
+		posts_per_category=args.posts,
+		files_per_post=args.files_per_post,
+		file_size=args.file_size,
+		latency=args.site_latency,
+		bandwidth=args.site_bandwidth,
+		ranges=not args.no_ranges,
+		drop_rate=args.site_drop_rate
+	))
+	base_url = await site.start()
+	overrides = configure_environment(args, base_url, workdir)
+
+	# telethon keeps its session file in the working directory, so the bot is imported from the scratch one
+	os.chdir(workdir)
+	bot = importlib.import_module("main")
+	from bench.scenarios import run_users, summarize
+
+	slugs, textbook_slugs = [], []
+	for value in bot.CATEGORIES.values():
+		if isinstance(value, dict):
+			slugs.extend(value.values())
+			textbook_slugs.extend(value.values())
+		else:
+			slugs.append(value)
+	site.populate(slugs, textbook_slugs)
+
+	client = FakeTelegramClient(args.telegram_latency, args.upload_bandwidth)
+	bot.client = client
+	bot.job_queue.client = client
+	bot.membership.client = client
+	# the parallel uploader opens fake connections that count the parts instead of MTProto ones
+	uploads = importlib.import_module("uploads")
+	uploads.uploader.open_sender = client.open_sender
+
+	await bot.open_http_session()
+	await bot.parse_pool.start()
+	setup = {}
+	if bot.settings.CATALOG_ENABLED:
+		started = time.perf_counter()
+		setup["catalog_posts"] = await bot.catalog.sync()
+		setup["catalog_sync_s"] = round(time.perf_counter() - started, 3)
+	if bot.settings.WARMUP_ENABLED:
+		setup["warmup"] = await bot.warm_up()
+	bot.job_queue.start()
+	bot.metrics.loop_lag.start()
+
+	started_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+	site_bytes = site.bytes_sent
+	started = time.perf_counter()
+	try:
+		recorder = await run_users(bot, client, scenarios, args.users, args.ramp, args.think_time, args.seed)
+	finally:
+		duration = time.perf_counter() - started
+		await bot.metrics.loop_lag.stop()
+		await bot.actors.stop()
+		await bot.prefetcher.stop()
+		await uploads.uploader.stop()
+		await bot.job_queue.stop()
+		await bot.parse_pool.stop()
+		await bot.close_http_session()
+		await site.stop()
+
+	files_sent = sum(1 if call.kind == "send_file" else call.size for call in client.calls if call.kind in ("send_file", "send_album"))
+	return {
+		"started": started_at,
+		"arguments": vars(args),
+		"settings": {name: value for name, value in overrides.items() if name not in ("API_ID", "API_HASH", "BOT_TOKEN", "CHANNEL_USERNAME")},
+		"setup": setup,
+		"duration_s": round(duration, 3),
+		"transitions": recorder.summary(),
+		"throughput": {
+			"transitions_per_s": round(recorder.transitions / duration, 2),
+			"files_per_s": round(files_sent / duration, 2)
+		},
+		# the stand-in site runs in the same process, so it is included in the peak
+		"peak_rss_mb": peak_rss_mb(),
+		# how late the event loop woke a task sleeping LOOP_LAG_INTERVAL seconds, i.e. how long handlers were blocked
+		"event_loop_lag": summarize(list(bot.metrics.loop_lag.lags)) if bot.metrics.loop_lag.lags else {},
+		"bytes": {"site_sent": site.bytes_sent - site_bytes, "uploaded": client.bytes_uploaded, "parallel_parts": client.parts_sent},
+		"prefetch": {outcome: int(bot.metrics.PREFETCH.value(outcome=outcome)) for outcome in ("started", "skipped", "failed", "used")},
+		"site_requests": site.requests,
+		"telegram_calls": client.counts(),
+		"errors": recorder.errors
+	}
+
+def main(argv: list[str] | None = None) -> None:
+	args = parse_args(argv)
+	output = os.path.abspath(args.output)
+	baseline = None
+	if args.baseline:
+		with open(args.baseline, encoding="utf-8") as f:
+			baseline = json.load(f)
+
+	report = asyncio.run(run(args))
+	print_report(report)
+	if baseline:
+		compare(report, baseline)
+	with open(output, "w", encoding="utf-8") as f:
+		json.dump(report, f, ensure_ascii=False, indent=2)
+	print(f"\nReport written to {output}")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,159 @@
+"""simulated users walking through the bot's conversations, timing every state transition"""
+import asyncio
+import math
+import random
+import time
+from types import ModuleType
+from keyboards import ITEM_PREFIX, PAGE_PREFIX, parse_callback
+from bench.telegram import FakeCallbackEvent, FakeMessageEvent, FakeTelegramClient
+
+# latencies of every transition, by transition name, and the transitions that went wrong
+class Recorder:
+	def __init__(self):
+		self.latencies: dict[str, list[float]] = {}
+		self.errors: dict[str, int] = {}
+
+	def add(self, name: str, seconds: float) -> None:
+		self.latencies.setdefault(name, []).append(seconds)
+
+	def fail(self, name: str) -> None:
+		self.errors[name] = self.errors.get(name, 0) + 1
+
+	@property
+	def transitions(self) -> int:
+		return sum(len(values) for values in self.latencies.values())
+
+	def summary(self) -> dict:
+		"""Return count, mean and p50/p95/p99/max latency in milliseconds for every transition."""
+		return {name: summarize(values) for name, values in sorted(self.latencies.items())}
+
+def percentile(ordered: list[float], p: float) -> float:
+	"""Nearest-rank percentile of an already sorted list."""
+	return ordered[max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))]
+
+def summarize(values: list[float]) -> dict:
+	ordered = sorted(values)
+	return {
+		"count": len(ordered),
+		"mean_ms": round(sum(ordered) / len(ordered) * 1000, 2),
+		"p50_ms": round(percentile(ordered, 50) * 1000, 2),
+		"p95_ms": round(percentile(ordered, 95) * 1000, 2),
+		"p99_ms": round(percentile(ordered, 99) * 1000, 2),
+		"max_ms": round(ordered[-1] * 1000, 2)
+	}
+
+class ScenarioError(Exception):
+	"""Raised when the bot did not answer a step the way the scenario expects."""
+
+# one chat talking to the bot. every step feeds an event to the bot's handlers, waits until they return and
+# records how long that took, then reads the buttons the bot answered with to pick the next step.
+class User:
+	def __init__(self, bot: ModuleType, client: FakeTelegramClient, recorder: Recorder, chat_id: int, rng: random.Random, think_time: float):
+		self.bot = bot
+		self.client = client
+		self.recorder = recorder
+		self.chat_id = chat_id
+		self.rng = rng
+		self.think_time = think_time
+
+	async def _timed(self, name: str, handler, event) -> None:
+		if self.think_time:
+			await asyncio.sleep(self.rng.uniform(0, 2 * self.think_time))
+		started = time.perf_counter()
+		try:
+			await handler(event)
+			# a picked post or book is delivered by the chat's transfer after the handler returned
+			await self.bot.actors.wait_idle(self.chat_id)
+		except Exception:
+			self.recorder.fail(name)
+			raise
+		self.recorder.add(name, time.perf_counter() - started)
+
+	async def send(self, name: str, text: str) -> None:
+		await self._timed(name, self.bot.handle_message, FakeMessageEvent(self.client, self.chat_id, text))
+
+	async def press(self, name: str, data: bytes, message_id: int) -> None:
+		await self._timed(name, self.bot.handle_inline, FakeCallbackEvent(self.client, self.chat_id, data, message_id))
+
+	def _keyboard(self):
+		keyboard = self.client.last_message(self.chat_id)
+		if keyboard is None:
+			raise ScenarioError(f"chat {self.chat_id} got no keyboard")
+		return keyboard
+
+	def reply_options(self) -> list[str]:
+		"""Labels of the reply keyboard the bot sent last."""
+		# reply buttons come wrapped in telethon's Button, inline ones are the bare TL objects
+		return [button.button.text for row in self._keyboard().buttons for button in row if hasattr(button, "button")]
+
+	def inline_options(self, prefix: bytes) -> tuple[int, list[tuple[int, bytes]]]:
+		"""Message id of the last inline keyboard and the (number, data) of its buttons with the given prefix."""
+		keyboard = self._keyboard()
+		options = []
+		for row in keyboard.buttons:
+			for button in row:
+				callback = parse_callback(getattr(button, "data", b""))
+				if callback and callback[0] == prefix:
+					options.append((callback[2], button.data))
+		return keyboard.message_id, options
+
+	async def pick_from_list(self, name: str, pages: int) -> None:
+		"""Turn up to pages pages of the inline list forward, then pick an item of the page reached."""
+		page = 0
+		for _ in range(pages):
+			message_id, options = self.inline_options(PAGE_PREFIX)
+			forward = [(number, data) for number, data in options if number == page + 1]
+			if not forward:
+				break
+			page, data = forward[0]
+			await self.press("list_page", data, message_id)
+		message_id, items = self.inline_options(ITEM_PREFIX)
+		if not items:
+			raise ScenarioError(f"chat {self.chat_id} got an empty list")
+		await self.press(name, self.rng.choice(items)[1], message_id)
+
+	async def browse(self) -> None:
+		"""Open a category, page through its posts and download one of them."""
+		await self.send("start", "/start")
+		categories = [name for name in self.reply_options() if not isinstance(self.bot.CATEGORIES.get(name), dict)]
+		await self.send("category", self.rng.choice(categories))
+		await self.pick_from_list("post_delivery", self.rng.randint(0, 3))
+
+	async def textbook(self) -> None:
+		"""Walk down to a textbook grade and download one of its books."""
+		await self.send("start", "/start")
+		category = next(name for name, value in self.bot.CATEGORIES.items() if isinstance(value, dict))
+		await self.send("category", category)
+		await self.send("subcategory", self.reply_options()[0])
+		await self.send("grade", self.rng.choice(self.reply_options()))
+		await self.pick_from_list("book_delivery", 0)
+
+	async def search(self) -> None:
+		"""Search the catalog and download one of the matches."""
+		await self.send("start", "/start")
+		categories = [name for name in self.reply_options() if not isinstance(self.bot.CATEGORIES.get(name), dict)]
+		query = self.bot.CATEGORIES[self.rng.choice(categories)].split("-")[0]
+		await self.send("search", f"/search {query}")
+		await self.pick_from_list("post_delivery", self.rng.randint(0, 1))
+
+SCENARIOS = ("browse", "textbook", "search")
+
+async def run_users(bot: ModuleType, client: FakeTelegramClient, scenarios: list[str], users: int, ramp: float, think_time: float, seed: int) -> Recorder:
+	"""Run users concurrently, starting them evenly over ramp seconds and giving each the next scenario in turn."""
+	recorder = Recorder()
+	rng = random.Random(seed)
+
+	async def one_user(number: int) -> None:
+		await asyncio.sleep(ramp * number / max(1, users))
+		user = User(bot, client, recorder, 1000 + number, random.Random(rng.random()), think_time)
+		scenario = scenarios[number % len(scenarios)]
+		try:
+			await getattr(user, scenario)()
+		except ScenarioError as e:
+			recorder.fail(scenario)
+			print(f"Scenario {scenario} of chat {user.chat_id} failed: {e}")
+		except Exception as e:
+			print(f"Scenario {scenario} of chat {user.chat_id} raised: {e!r}")
+
+	await asyncio.gather(*(one_user(number) for number in range(users)))
+	return recorder
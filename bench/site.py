@@ -0,0 +1,227 @@
+"""local stand-in of the wordpress site: the JSON API, post and textbook pages, and large files"""
+import asyncio
+import hashlib
+import json
+import random
+import re
+from dataclasses import dataclass
+from urllib.parse import quote, unquote
+from aiohttp import web
+
+# shape of the generated site and how slow it is. latency is added before every response, bandwidth (bytes per
+# second, 0 for unlimited) throttles each file response the way a slow file host would, ranges turns byte range
+# support on or off, and drop_rate is the chance a file response is cut off halfway, like a flaky connection.
+@dataclass
+class SiteConfig:
+	posts_per_category: int = 150
+	files_per_post: int = 3
+	file_size: int = 2 * 1024 * 1024
+	textbook_grades: int = 12
+	books_per_grade: int = 8
+	latency: float = 0.02
+	bandwidth: float = 0
+	ranges: bool = True
+	drop_rate: float = 0
+	chunk_size: int = 64 * 1024
+
+# serves a deterministic site with one category per populated slug. every post page links files_per_post video
+# files, and the posts of a textbook category link to the textbook page with its grades and zipped books.
+class FakeSite:
+	def __init__(self, config: SiteConfig):
+		self.config = config
+		self.bytes_sent = 0
+		self.requests: dict[str, int] = {}
+		self.categories: list[dict] = []
+		self.textbook_ids: set[int] = set()
+		self.posts: list[dict] = []
+		self._posts_by_id: dict[int, dict] = {}
+		self.base_url = ""
+		self._runner: web.AppRunner | None = None
+		self._random = random.Random(0)
+
+	def populate(self, slugs: list[str], textbook_slugs: list[str]) -> None:
+		"""Generate one category per slug with posts_per_category posts each."""
+		config = self.config
+		self.categories = [{"id": index + 1, "slug": slug, "name": slug, "count": config.posts_per_category} for index, slug in enumerate(slugs)]
+		self.textbook_ids = {c["id"] for c in self.categories if c["slug"] in textbook_slugs}
+		self.posts = [
+			{"id": category["id"] * 100000 + number, "category": category["id"], "title": f"{category['slug']} {number}", "date": f"2024-01-01T00:{number // 60 % 60:02d}:{number % 60:02d}"}
+			for category in self.categories for number in range(config.posts_per_category)
+		]
+		self._posts_by_id = {post["id"]: post for post in self.posts}
+
+	def _count(self, kind: str) -> None:
+		self.requests[kind] = self.requests.get(kind, 0) + 1
+
+	async def _delay(self) -> None:
+		if self.config.latency:
+			await asyncio.sleep(self.config.latency)
+
+	def _json(self, data, **headers) -> web.Response:
+		body = json.dumps(data, ensure_ascii=False).encode()
+		self.bytes_sent += len(body)
+		return web.Response(body=body, content_type="application/json", headers=headers)
+
+	def _html(self, html: str) -> web.Response:
+		body = html.encode()
+		self.bytes_sent += len(body)
+		etag = '"' + hashlib.md5(body).hexdigest() + '"'
+		return web.Response(body=body, content_type="text/html", headers={"ETag": etag})
+
+	def _post_link(self, post: dict) -> str:
+		if post["category"] in self.textbook_ids:
+			return f"{self.base_url}/textbook/{post['category']}/"
+		return f"{self.base_url}/post/{post['id']}/"
+
+	def _post_content(self, post: dict) -> str:
+		links = "".join(
+			f'<p><a href="{self.base_url}/files/{post["id"]}-{number}.mkv">قسمت {number + 1}</a></p>'
+			for number in range(self.config.files_per_post)
+		)
+		return f"<p>{post['title']}</p>{links}<p><a href=\"{self.base_url}/tag/x/\">tag</a></p>"
+
+	def _wp_post(self, post: dict, fields: list[str]) -> dict:
+		full = {
+			"id": post["id"],
+			"title": {"rendered": post["title"]},
+			"link": self._post_link(post),
+			"date": post["date"],
+			"modified": post["date"],
+			"categories": [post["category"]],
+			"content": {"rendered": self._post_content(post)}
+		}
+		return {key: value for key, value in full.items() if not fields or key in fields}
+
+	@staticmethod
+	def _wp_category(category: dict) -> dict:
+		# wordpress keeps non-latin slugs percent-encoded, in lower case, and returns them that way
+		return {**category, "slug": quote(category["slug"]).lower()}
+
+	async def categories_endpoint(self, request: web.Request) -> web.Response:
+		self._count("categories")
+		await self._delay()
+		slug = request.query.get("slug")
+		if slug is not None:
+			return self._json([self._wp_category(c) for c in self.categories if c["slug"] == unquote(slug)])
+		return self._json([self._wp_category(c) for c in self.categories], **{"X-WP-Total": str(len(self.categories)), "X-WP-TotalPages": "1"})
+
+	async def posts_endpoint(self, request: web.Request) -> web.Response:
+		self._count("posts")
+		await self._delay()
+		posts = self.posts
+		if "categories" in request.query:
+			category_id = int(request.query["categories"])
+			posts = [p for p in posts if p["category"] == category_id]
+		if "modified_after" in request.query:
+			posts = [p for p in posts if p["date"] > request.query["modified_after"]]
+		per_page = int(request.query.get("per_page", 10))
+		page = int(request.query.get("page", 1))
+		total_pages = max(1, (len(posts) + per_page - 1) // per_page)
+		fields = [f for f in request.query.get("_fields", "").split(",") if f]
+		selected = [self._wp_post(p, fields) for p in posts[(page - 1) * per_page:page * per_page]]
+		return self._json(selected, **{"X-WP-Total": str(len(posts)), "X-WP-TotalPages": str(total_pages)})
+
+	async def post_page(self, request: web.Request) -> web.Response:
+		self._count("post_page")
+		await self._delay()
+		post = self._posts_by_id.get(int(request.match_info["post_id"]))
+		if post is None:
+			raise web.HTTPNotFound()
+		# the parts of an elementor page the bot looks at, wrapped in the usual theme noise
+		navigation = "".join(f'<li><a href="{self.base_url}/category/{c["slug"]}/">{c["name"]}</a></li>' for c in self.categories)
+		return self._html(
+			f"<html><head><title>{post['title']}</title></head><body><nav><ul>{navigation}</ul></nav>"
+			f'<div class="elementor-widget-theme-post-content"><div class="elementor-widget-container">'
+			f'<div class="post-ser-css">share</div>{self._post_content(post)}<p> </p></div></div>'
+			f"<footer>{'<p>footer</p>' * 50}</footer></body></html>"
+		)
+
+	async def textbook_page(self, request: web.Request) -> web.Response:
+		self._count("textbook_page")
+		await self._delay()
+		grades = "".join(
+			f"<h2>پایه {grade + 1}</h2>" + "".join(
+				f'<p><a href="{self.base_url}/scb/{grade + 1}/book-{book + 1}.zip">کتاب {book + 1} پایه {grade + 1}</a></p>'
+				for book in range(self.config.books_per_grade)
+			)
+			for grade in range(self.config.textbook_grades)
+		)
+		return self._html(f"<html><body><div>{grades}</div></body></html>")
+
+	async def file(self, request: web.Request) -> web.StreamResponse:
+		self._count("file_head" if request.method == "HEAD" else "file_get")
+		await self._delay()
+		name = request.match_info["name"]
+		size = self.config.file_size
+		headers = {
+			"Content-Type": "application/zip" if name.endswith(".zip") else "video/x-matroska",
+			"Content-Length": str(size),
+			"ETag": '"' + hashlib.md5(name.encode()).hexdigest() + '"'
+		}
+		if self.config.ranges:
+			headers["Accept-Ranges"] = "bytes"
+		if request.method == "HEAD":
+			return web.Response(headers=headers)
+
+		first, last, status = 0, size - 1, 200
+		match = re.fullmatch(r"bytes=(\d+)-(\d*)", request.headers.get("Range", ""))
+		if self.config.ranges and match:
+			first, last, status = int(match[1]), min(int(match[2] or size - 1), size - 1), 206
+			if first > last:
+				return web.Response(status=416, headers={"Content-Range": f"bytes */{size}"})
+			headers["Content-Range"] = f"bytes {first}-{last}/{size}"
+			headers["Content-Length"] = str(last - first + 1)
+			self._count("file_range")
+
+		response = web.StreamResponse(status=status, headers=headers)
+		try:
+			await response.prepare(request)
+		except ConnectionResetError:
+			# the bot hung up before the headers went out, e.g. a cancelled delivery closing its prefetches
+			return response
+		chunk = bytes(self.config.chunk_size)
+		length = last - first + 1
+		drop_at = length // 2 if self._random.random() < self.config.drop_rate else None
+		sent = 0
+		while sent < length:
+			if drop_at is not None and sent >= drop_at:
+				self._count("file_dropped")
+				request.transport.close()
+				return response
+			part = chunk[:min(len(chunk), length - sent)]
+			try:
+				await response.write(part)
+			except ConnectionResetError:
+				# the bot hung up, e.g. a ranged download falling back to a single stream
+				return response
+			sent += len(part)
+			self.bytes_sent += len(part)
+			if self.config.bandwidth:
+				await asyncio.sleep(len(part) / self.config.bandwidth)
+		await response.write_eof()
+		return response
+
+	def app(self) -> web.Application:
+		app = web.Application()
+		app.router.add_get("/wp-json/wp/v2/categories", self.categories_endpoint)
+		app.router.add_get("/wp-json/wp/v2/posts", self.posts_endpoint)
+		app.router.add_get("/post/{post_id}/", self.post_page)
+		app.router.add_get("/textbook/{category_id}/", self.textbook_page)
+		app.router.add_route("*", "/files/{name}", self.file)
+		app.router.add_route("*", "/scb/{grade}/{name}", self.file)
+		return app
+
+	async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+		"""Serve the site and return its base URL."""
+		self._runner = web.AppRunner(self.app(), access_log=None)
+		await self._runner.setup()
+		site = web.TCPSite(self._runner, host, port)
+		await site.start()
+		port = site._server.sockets[0].getsockname()[1]
+		self.base_url = f"http://{host}:{port}"
+		return self.base_url
+
+	async def stop(self) -> None:
+		if self._runner is not None:
+			await self._runner.cleanup()
+			self._runner = None
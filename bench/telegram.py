@@ -0,0 +1,153 @@
+"""fake telegram client and events that record what the bot sends instead of talking to telegram"""
+import asyncio
+import io
+import itertools
+import time
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+from telethon.tl import types
+
+# one call the bot made to telegram
+@dataclass
+class Call:
+	kind: str
+	chat_id: int
+	at: float
+	size: int = 0
+	text: str | None = None
+	message_id: int = 0
+	# rows of telethon keyboard buttons, with .text and, for inline buttons, .data
+	buttons: list = field(default_factory=list)
+
+# stands in for one of the extra MTProto connections of the parallel uploader: every part waits latency seconds
+# plus the time upload_bandwidth takes to carry it, and is counted by the client it belongs to
+class FakeSender:
+	def __init__(self, client: "FakeTelegramClient"):
+		self.client = client
+
+	async def send(self, request) -> bool:
+		await asyncio.sleep(self.client.latency)
+		if self.client.upload_bandwidth:
+			await asyncio.sleep(len(request.bytes) / self.client.upload_bandwidth)
+		self.client.bytes_uploaded += len(request.bytes)
+		self.client.parts_sent += 1
+		return True
+
+	async def disconnect(self) -> None:
+		pass
+
+# stands in for TelegramClient. every call waits latency seconds like a round trip would and is recorded, and
+# uploads read the whole file so downloads are exercised end to end. upload_bandwidth (bytes per second, 0 for
+# unlimited) slows uploads down the way telegram's upload speed would.
+class FakeTelegramClient:
+	def __init__(self, latency: float = 0.01, upload_bandwidth: float = 0):
+		self.latency = latency
+		self.upload_bandwidth = upload_bandwidth
+		self.calls: list[Call] = []
+		self.bytes_uploaded = 0
+		self.parts_sent = 0
+		self._ids = itertools.count(1)
+
+	def _record(self, kind: str, chat_id, size: int = 0, text: str | None = None, buttons=None, message_id: int = 0) -> None:
+		rows = [row if isinstance(row, list) else [row] for row in buttons or []]
+		self.calls.append(Call(kind, chat_id, time.monotonic(), size, text, message_id, rows))
+
+	def _message(self, chat_id, text: str | None = None, buttons=None, document=None) -> SimpleNamespace:
+		return SimpleNamespace(id=next(self._ids), chat_id=chat_id, text=text, buttons=buttons, document=document)
+
+	async def _upload(self, file) -> int:
+		size = 0
+		read = file.read
+		while True:
+			chunk = read(512 * 1024)
+			if asyncio.iscoroutine(chunk):
+				chunk = await chunk
+			if not chunk:
+				break
+			size += len(chunk)
+			if self.upload_bandwidth:
+				await asyncio.sleep(len(chunk) / self.upload_bandwidth)
+		self.bytes_uploaded += size
+		return size
+
+	async def upload_file(self, file, *, file_size: int | None = None, file_name: str | None = None, **kwargs) -> types.InputFileBig:
+		await asyncio.sleep(self.latency)
+		size = await self._upload(file)
+		self._record("upload_file", None, size)
+		return types.InputFileBig(id=next(self._ids), parts=max(1, size // (512 * 1024)), name=file_name or "file")
+
+	async def open_sender(self, client=None) -> FakeSender:
+		"""Open a fake upload connection, in place of ParallelUploader.open_sender."""
+		await asyncio.sleep(self.latency)
+		self._record("open_sender", None)
+		return FakeSender(self)
+
+	async def send_file(self, entity, file, caption: str | None = None, **kwargs) -> SimpleNamespace:
+		await asyncio.sleep(self.latency)
+		if isinstance(file, list):
+			# an album: one call, one message per already uploaded file
+			captions = caption if isinstance(caption, list) else [caption] * len(file)
+			self._record("send_album", entity, len(file), "\n".join(c or "" for c in captions))
+			return [self._message(entity, c, document=self._document(0)) for c in captions]
+		size = 0
+		if isinstance(file, io.IOBase) or hasattr(file, "read"):
+			size = await self._upload(file)
+		self._record("send_file", entity, size, caption)
+		return self._message(entity, caption, document=self._document(size))
+
+	def _document(self, size: int) -> types.Document:
+		return types.Document(
+			id=next(self._ids), access_hash=0, file_reference=b"bench", date=None, mime_type="application/octet-stream",
+			size=size, dc_id=0, attributes=[]
+		)
+
+	async def send_message(self, entity, message: str = "", buttons=None, **kwargs) -> SimpleNamespace:
+		await asyncio.sleep(self.latency)
+		sent = self._message(entity, message, buttons)
+		self._record("send_message", entity, text=message, buttons=buttons, message_id=sent.id)
+		return sent
+
+	async def edit_message(self, entity, message=None, text: str | None = None, buttons=None, **kwargs) -> SimpleNamespace:
+		await asyncio.sleep(self.latency)
+		self._record("edit_message", entity, text=text, buttons=buttons, message_id=message if isinstance(message, int) else 0)
+		return self._message(entity, text, buttons)
+
+	async def __call__(self, request, *args, **kwargs):
+		await asyncio.sleep(self.latency)
+		self._record(type(request).__name__, None)
+		raise NotImplementedError(f"{type(request).__name__} is not faked")
+
+	def last_message(self, chat_id: int) -> Call | None:
+		"""Return the last message sent to or edited in a chat that carried buttons."""
+		return next((call for call in reversed(self.calls) if call.chat_id == chat_id and call.buttons), None)
+
+	def counts(self) -> dict:
+		counts: dict[str, int] = {}
+		for call in self.calls:
+			counts[call.kind] = counts.get(call.kind, 0) + 1
+		return counts
+
+# what handle_message needs of a NewMessage event
+class FakeMessageEvent:
+	def __init__(self, client: FakeTelegramClient, chat_id: int, text: str):
+		self.client = client
+		self.chat_id = chat_id
+		self.sender_id = chat_id
+		self.text = text
+
+	async def respond(self, message: str = "", buttons=None, **kwargs) -> SimpleNamespace:
+		return await self.client.send_message(self.chat_id, message, buttons=buttons, **kwargs)
+
+# what handle_inline needs of a CallbackQuery event, pressed on the message with the given id
+class FakeCallbackEvent(FakeMessageEvent):
+	def __init__(self, client: FakeTelegramClient, chat_id: int, data: bytes, message_id: int = 0):
+		super().__init__(client, chat_id, "")
+		self.data = data
+		self.message_id = message_id
+
+	async def answer(self, message: str | None = None, **kwargs) -> None:
+		await asyncio.sleep(self.client.latency)
+		self.client._record("answer", self.chat_id, text=message)
+
+	async def edit(self, text: str | None = None, buttons=None, **kwargs) -> SimpleNamespace:
+		return await self.client.edit_message(self.chat_id, self.message_id, text=text, buttons=buttons, **kwargs)
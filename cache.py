@@ -0,0 +1,110 @@
+"""small in-process caches shared by all users of the bot"""
+import asyncio
+import functools
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+log = logging.getLogger(__name__)
+
+# key/value cache whose entries are fresh for ttl seconds and may still be served for stale_ttl more seconds
+# while they are reloaded in the background. the least recently used entries go first once max_entries is reached.
+class TTLCache:
+	def __init__(self, ttl: float, stale_ttl: float = 0, max_entries: int | None = None):
+		self.ttl = ttl
+		self.stale_ttl = stale_ttl
+		self.max_entries = max_entries
+		self.hits = 0
+		self.misses = 0
+		self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+		self._loading: dict[Hashable, asyncio.Task] = {}
+		self._background: set[asyncio.Task] = set()
+
+	def __len__(self) -> int:
+		return len(self._entries)
+
+	def _lookup(self, key: Hashable) -> tuple[float, Any] | None:
+		entry = self._entries.get(key)
+		if entry is None:
+			return None
+		if time.monotonic() - entry[0] > self.ttl + self.stale_ttl:
+			del self._entries[key]
+			return None
+		self._entries.move_to_end(key)
+		return entry
+
+	def get(self, key: Hashable, default: Any = None) -> Any:
+		"""Return a fresh cached value, or default when it is missing or expired."""
+		entry = self._lookup(key)
+		if entry is None or time.monotonic() - entry[0] > self.ttl:
+			return default
+		return entry[1]
+
+	def peek(self, key: Hashable, default: Any = None) -> Any:
+		"""Return a cached value even when it is stale, or default when it is missing."""
+		entry = self._lookup(key)
+		return default if entry is None else entry[1]
+
+	def set(self, key: Hashable, value: Any) -> None:
+		"""Store a value, evicting the least recently used entries when the cache is full."""
+		self._entries[key] = (time.monotonic(), value)
+		self._entries.move_to_end(key)
+		if self.max_entries is not None:
+			while len(self._entries) > self.max_entries:
+				self._entries.popitem(last=False)
+
+	def pop(self, key: Hashable) -> Any:
+		"""Remove a key and return its value, if any."""
+		entry = self._entries.pop(key, None)
+		return entry[1] if entry else None
+
+	def clear(self) -> None:
+		self._entries.clear()
+
+	async def _run_loader(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+		value = await loader()
+		# None means the load failed and must not be cached
+		if value is not None:
+			self.set(key, value)
+		return value
+
+	def _loaded(self, key: Hashable, task: asyncio.Task) -> None:
+		if self._loading.get(key) is task:
+			del self._loading[key]
+		# nobody may be waiting any more, so make sure an exception is marked as retrieved
+		if not task.cancelled():
+			task.exception()
+
+	async def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+		# concurrent loads of the same key share one call to the loader. it runs in a task of its own that every
+		# caller shields, so a caller that is cancelled leaves the load running for the others
+		task = self._loading.get(key)
+		if task is None:
+			task = self._loading[key] = asyncio.create_task(self._run_loader(key, loader))
+			task.add_done_callback(functools.partial(self._loaded, key))
+		return await asyncio.shield(task)
+
+	async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+		"""Return the cached value for key, loading it when missing and revalidating it in the background when stale."""
+		entry = self._lookup(key)
+		if entry is None:
+			self.misses += 1
+			return await self._load(key, loader)
+
+		self.hits += 1
+		if time.monotonic() - entry[0] > self.ttl and key not in self._loading:
+			task = asyncio.create_task(self._revalidate(key, loader))
+			self._background.add(task)
+			task.add_done_callback(self._background.discard)
+		return entry[1]
+
+	async def _revalidate(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> None:
+		try:
+			await self._load(key, loader)
+		except Exception as e:
+			log.warning(f"Background refresh of {key!r} failed: {e}")
+
+	def stats(self) -> dict:
+		"""Return hit/miss counters and the number of entries."""
+		return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
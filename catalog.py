@@ -0,0 +1,247 @@
+"""local sqlite mirror of the site's posts, categories and download links with a full-text index on titles"""
+import asyncio
+import html
+import logging
+import re
+import sqlite3
+import aiohttp
+from urllib.parse import unquote
+from settings import settings
+from utils import get_http_session, extract_download_links
+
+log = logging.getLogger(__name__)
+
+# the local index of the wordpress site, kept up to date by an incremental background sync
+class Catalog:
+	def __init__(self, path: str):
+		self._db = sqlite3.connect(path, check_same_thread=False)
+		self._db.executescript("""
+			CREATE TABLE IF NOT EXISTS categories (
+				id INTEGER PRIMARY KEY,
+				slug TEXT UNIQUE NOT NULL,
+				name TEXT NOT NULL,
+				count INTEGER NOT NULL DEFAULT 0
+			);
+			CREATE TABLE IF NOT EXISTS posts (
+				id INTEGER PRIMARY KEY,
+				title TEXT NOT NULL,
+				link TEXT NOT NULL,
+				date TEXT,
+				modified TEXT
+			);
+			CREATE TABLE IF NOT EXISTS post_categories (
+				post_id INTEGER NOT NULL,
+				category_id INTEGER NOT NULL,
+				PRIMARY KEY (post_id, category_id)
+			);
+			CREATE INDEX IF NOT EXISTS post_categories_category ON post_categories (category_id);
+			CREATE TABLE IF NOT EXISTS links (
+				post_id INTEGER NOT NULL,
+				position INTEGER NOT NULL,
+				href TEXT NOT NULL,
+				filename TEXT NOT NULL,
+				description TEXT NOT NULL,
+				PRIMARY KEY (post_id, position)
+			);
+			CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(title);
+			CREATE TABLE IF NOT EXISTS sync_state (
+				key TEXT PRIMARY KEY,
+				value TEXT NOT NULL
+			);
+		""")
+		self._db.commit()
+		# indexes written before slugs were decoded and titles unescaped are fixed up once
+		if self._get_state("decoded") is None:
+			self._db.executemany("UPDATE categories SET slug = ? WHERE id = ?", [(unquote(slug), category_id) for category_id, slug in self._db.execute("SELECT id, slug FROM categories").fetchall()])
+			self._db.execute("DELETE FROM posts_fts")
+			self._db.executemany("INSERT INTO posts_fts (rowid, title) VALUES (?, ?)", [(post_id, html.unescape(title)) for post_id, title in self._db.execute("SELECT id, title FROM posts").fetchall()])
+			self._set_state("decoded", "1")
+			self._db.commit()
+		self._sync_task = None
+		# true once one full sync has finished, before that the index may be missing posts
+		self.ready = self._get_state("synced") is not None
+
+	@staticmethod
+	def _as_post(row: tuple) -> dict:
+		# same shape as the wordpress API listing, so the bot treats both sources alike
+		post_id, title, link, date = row
+		return {"id": post_id, "title": {"rendered": title}, "link": link, "date": date}
+
+	def category_posts(self, category_slug: str) -> list:
+		"""Return the indexed posts of a category, newest first."""
+		rows = self._db.execute("""
+			SELECT p.id, p.title, p.link, p.date FROM posts p
+			JOIN post_categories pc ON pc.post_id = p.id
+			JOIN categories c ON c.id = pc.category_id
+			WHERE c.slug = ? ORDER BY p.date DESC
+		""", (category_slug,)).fetchall()
+		return [self._as_post(row) for row in rows]
+
+	def posts_by_ids(self, post_ids: tuple[int, ...] | list[int]) -> list:
+		"""Return the indexed posts with the given ids, in the same order."""
+		if not post_ids:
+			return []
+		placeholders = ",".join("?" * len(post_ids))
+		rows = self._db.execute(f"SELECT id, title, link, date FROM posts WHERE id IN ({placeholders})", tuple(post_ids)).fetchall()
+		posts = {row[0]: self._as_post(row) for row in rows}
+		return [posts[post_id] for post_id in post_ids if post_id in posts]
+
+	def search(self, query: str, limit: int = 50) -> list:
+		"""Find posts whose title matches every word of the query, best matches first."""
+		words = re.findall(r'\w+', query)
+		if not words:
+			return []
+		# every word is quoted so user input can not inject fts5 syntax, and matches as a prefix
+		match = " ".join(f'"{word}"*' for word in words)
+		rows = self._db.execute("""
+			SELECT p.id, p.title, p.link, p.date FROM posts_fts f
+			JOIN posts p ON p.id = f.rowid
+			WHERE posts_fts MATCH ? ORDER BY f.rank LIMIT ?
+		""", (match, limit)).fetchall()
+		return [self._as_post(row) for row in rows]
+
+	def post_links(self, post_id: int) -> list[tuple[str, str, str]]:
+		"""Return the download links extracted from an indexed post."""
+		rows = self._db.execute("SELECT href, filename, description FROM links WHERE post_id = ? ORDER BY position", (post_id,)).fetchall()
+		return [tuple(row) for row in rows]
+
+	def _get_state(self, key: str) -> str | None:
+		row = self._db.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+		return row[0] if row else None
+
+	def _set_state(self, key: str, value: str) -> None:
+		self._db.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, value))
+
+	async def _fetch_pages(self, path: str, params: dict, strict: bool = False):
+		"""Yield every page of a paginated wordpress API collection, raising IOError on a failed page when strict."""
+		session = await get_http_session()
+		page = 1
+		total_pages = 1
+		while page <= total_pages:
+			async with session.get(f"{settings.BASE_URL}{path}", params={**params, "page": page, "per_page": 100}) as response:
+				# wordpress answers past the last page with an error, which just means we are done
+				if response.status != 200:
+					if strict:
+						raise IOError(f"page {page} of {path} failed with status {response.status}")
+					if page == 1:
+						log.warning(f"Failed to fetch {path}: {await response.text()}")
+					return
+				total_pages = int(response.headers.get('X-WP-TotalPages', 1))
+				items = await response.json()
+			yield items
+			page += 1
+
+	async def sync(self) -> int:
+		"""Mirror categories and every post modified since the last sync, returning the number of updated posts."""
+		async for categories in self._fetch_pages("/wp-json/wp/v2/categories", {"_fields": "id,slug,name,count"}):
+			self._db.executemany(
+				"INSERT OR REPLACE INTO categories (id, slug, name, count) VALUES (?, ?, ?, ?)",
+				# wordpress returns non-latin slugs percent-encoded, the bot knows them decoded
+				[(c['id'], unquote(c['slug']), c['name'], c.get('count', 0)) for c in categories]
+			)
+		self._db.commit()
+
+		# only posts modified after the newest one we already have are requested
+		params = {"orderby": "modified", "order": "asc", "_fields": "id,title,link,date,modified,categories,content"}
+		watermark = self._get_state("modified_after")
+		if watermark:
+			params["modified_after"] = watermark
+
+		updated = 0
+		async for posts in self._fetch_pages("/wp-json/wp/v2/posts", params):
+			for post in posts:
+				links = await extract_download_links(post.get('content', {}).get('rendered', ''), post['link'])
+				self._store_post(post, links)
+				if not watermark or post['modified'] > watermark:
+					watermark = post['modified']
+			if watermark:
+				self._set_state("modified_after", watermark)
+			self._db.commit()
+			updated += len(posts)
+
+		# posts deleted or unpublished on the site never show up as modified, so they are looked for separately
+		await self._prune()
+
+		# from now on the index holds the whole site and can answer browsing on its own
+		self._set_state("synced", "1")
+		self._db.commit()
+		self.ready = True
+		return updated
+
+	async def _prune(self) -> int:
+		"""Remove the posts the site does not publish any more, returning how many were removed."""
+		# ordered by id so posts published meanwhile go to the end and do not shift the pages
+		listed = set()
+		try:
+			async for posts in self._fetch_pages("/wp-json/wp/v2/posts", {"orderby": "id", "order": "asc", "_fields": "id"}, strict=True):
+				listed.update(post['id'] for post in posts)
+		except IOError as e:
+			log.warning(f"Could not list the published posts, keeping the index as it is: {e}")
+			return 0
+
+		# a post deleted while the listing was paged may still have shifted one off it, so every missing post is
+		# asked for on its own before it goes
+		session = await get_http_session()
+		removed = 0
+		for post_id, in self._db.execute("SELECT id FROM posts").fetchall():
+			if post_id in listed:
+				continue
+			async with session.get(f"{settings.BASE_URL}/wp-json/wp/v2/posts/{post_id}", params={"_fields": "id"}) as response:
+				# deleted posts answer 404, unpublished ones 401 or 403
+				if response.status not in (401, 403, 404, 410):
+					continue
+			self._remove_post(post_id)
+			removed += 1
+		self._db.commit()
+		if removed:
+			log.info(f"Removed {removed} posts the site no longer publishes from the catalog")
+		return removed
+
+	def _remove_post(self, post_id: int) -> None:
+		self._db.execute("DELETE FROM posts WHERE id = ?", (post_id,))
+		self._db.execute("DELETE FROM posts_fts WHERE rowid = ?", (post_id,))
+		self._db.execute("DELETE FROM post_categories WHERE post_id = ?", (post_id,))
+		self._db.execute("DELETE FROM links WHERE post_id = ?", (post_id,))
+
+	def _store_post(self, post: dict, links: list[tuple[str, str, str]]) -> None:
+		post_id = post['id']
+		title = post['title']['rendered']
+		self._db.execute("INSERT OR REPLACE INTO posts (id, title, link, date, modified) VALUES (?, ?, ?, ?, ?)", (post_id, title, post['link'], post.get('date'), post.get('modified')))
+		self._db.execute("DELETE FROM posts_fts WHERE rowid = ?", (post_id,))
+		self._db.execute("INSERT INTO posts_fts (rowid, title) VALUES (?, ?)", (post_id, html.unescape(title)))
+		self._db.execute("DELETE FROM post_categories WHERE post_id = ?", (post_id,))
+		self._db.executemany("INSERT OR IGNORE INTO post_categories (post_id, category_id) VALUES (?, ?)", [(post_id, category_id) for category_id in post.get('categories', [])])
+		self._db.execute("DELETE FROM links WHERE post_id = ?", (post_id,))
+		self._db.executemany(
+			"INSERT INTO links (post_id, position, href, filename, description) VALUES (?, ?, ?, ?, ?)",
+			[(post_id, position, href, filename, description) for position, (href, filename, description) in enumerate(links)]
+		)
+
+	async def _sync_forever(self, interval: float) -> None:
+		while True:
+			try:
+				updated = await self.sync()
+				log.info(f"Catalog sync finished, {updated} posts updated")
+			except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+				log.warning(f"Catalog sync network error: {e}")
+			except Exception as e:
+				log.exception(f"Catalog sync error: {e}")
+			await asyncio.sleep(interval)
+
+	def start_sync(self, interval: float) -> None:
+		"""Keep the catalog in sync in the background."""
+		if self._sync_task is None or self._sync_task.done():
+			self._sync_task = asyncio.create_task(self._sync_forever(interval))
+
+	async def stop_sync(self) -> None:
+		"""Stop the background sync."""
+		if self._sync_task is not None:
+			self._sync_task.cancel()
+			try:
+				await self._sync_task
+			except asyncio.CancelledError:
+				pass
+			self._sync_task = None
+
+# the catalog shared by the whole bot
+catalog = Catalog(settings.CATALOG_PATH)
@@ -0,0 +1,195 @@
+"""sending remote files to telegram chats"""
+import asyncio
+import logging
+import mimetypes
+import os
+from dataclasses import dataclass
+from typing import Awaitable, BinaryIO
+from telethon import TelegramClient
+from telethon.errors import RPCError
+from telethon.tl import types
+from settings import settings
+from utils import download_to_bytesio, fetch_file_info
+from file_cache import file_cache
+from download_cache import CachingReader, download_cache
+from streaming import RangedDownload, StreamingDownload, open_download
+from ratelimit import scheduler
+from uploads import uploader
+import metrics
+
+log = logging.getLogger(__name__)
+
+# a file that is ready to be sent: a telegram document uploaded before, a copy in the download cache opened for
+# reading, or a download that is already running
+@dataclass
+class PreparedFile:
+	url: str
+	filename: str
+	version: str | None
+	size: int | None = None
+	cached_document: types.InputDocument | None = None
+	cached_file: BinaryIO | None = None
+	stream: StreamingDownload | RangedDownload | CachingReader | None = None
+
+	async def close(self) -> None:
+		"""Stop the download of the file, if there is one, and close its cached copy."""
+		if self.stream is not None:
+			await self.stream.close()
+			self.stream = None
+		if self.cached_file is not None:
+			self.cached_file.close()
+			self.cached_file = None
+
+async def prepare_remote_file(url: str, filename: str, use_cache: bool = True) -> PreparedFile:
+	"""Look a remote file up in the telegram file cache, or start downloading it."""
+	file_info = await fetch_file_info(url)
+	prepared = PreparedFile(url, filename, file_cache.version_of(file_info), file_info.get("content_length") if file_info else None)
+
+	# a cached reference is forwarded instantly without touching the origin server
+	if use_cache:
+		prepared.cached_document = file_cache.get(url, prepared.version)
+		if prepared.cached_document:
+			return prepared
+
+	# a copy downloaded before is uploaded straight from disk
+	if download_cache is not None:
+		prepared.cached_file = download_cache.open(url, prepared.version, prepared.size)
+		if prepared.cached_file is not None:
+			return prepared
+
+	# stream the file when its size is known so upload overlaps the download and memory stays bounded,
+	# over several connections when the host serves byte ranges, and keep what the upload reads in the download cache
+	if settings.STREAMING_ENABLED and prepared.size:
+		prepared.stream = open_download(url, filename, prepared.size, bool(file_info and file_info.get("accept_ranges")))
+		writer = download_cache.writer(url, prepared.version, prepared.size) if download_cache is not None else None
+		if writer is not None:
+			prepared.stream = CachingReader(prepared.stream, writer)
+	return prepared
+
+async def upload_prepared(client: TelegramClient, prepared: PreparedFile) -> types.TypeInputFile | None:
+	"""Upload a prepared file that has no cached telegram copy, returning the uploaded file or None when that failed."""
+	if prepared.cached_file is not None:
+		file, size, mode = prepared.cached_file, os.fstat(prepared.cached_file.fileno()).st_size, "disk"
+	elif prepared.stream is not None:
+		file, size, mode = prepared.stream, prepared.size, "stream"
+	else:
+		file = await download_to_bytesio(prepared.url, prepared.filename)
+		if not file:
+			return None
+		size, mode = file.getbuffer().nbytes, "buffered"
+		writer = download_cache.writer(prepared.url, prepared.version, size) if download_cache is not None else None
+		if writer is not None:
+			with file.getbuffer() as view:
+				await writer.write(view)
+			await writer.finish()
+	try:
+		with metrics.UPLOAD_SECONDS.time(mode="parallel" if uploader.handles(size) else mode):
+			return await uploader.upload(client, file, size, prepared.filename)
+	except Exception as e:
+		metrics.ERRORS.inc(stage="upload")
+		log.warning(f"Upload of {prepared.url} failed: {e}")
+		return None
+
+async def send_prepared_file(client: TelegramClient, chat_id: int, prepared: PreparedFile, caption: str) -> bool:
+	"""Send a prepared file to a chat and remember the uploaded document, returning whether it was sent."""
+	if prepared.cached_document:
+		try:
+			await scheduler.call(chat_id, client.send_file, chat_id, prepared.cached_document, caption=caption)
+			metrics.FILES_SENT.inc(source="cache")
+			return True
+		except RPCError as e:
+			# the reference expired or was rejected, so upload the file again
+			log.warning(f"Cached file for {prepared.url} could not be sent: {e}")
+			file_cache.invalidate(prepared.url)
+			prepared = await prepare_remote_file(prepared.url, prepared.filename, use_cache=False)
+
+	try:
+		file = await upload_prepared(client, prepared)
+		if file is None:
+			return False
+		message = await scheduler.call(chat_id, client.send_file, chat_id, file, caption=caption)
+		metrics.FILES_SENT.inc(source="upload")
+		file_cache.store(prepared.url, prepared.version, message.document)
+		return True
+	finally:
+		await prepared.close()
+
+def media_kind(filename: str) -> str:
+	"""Return the kind of album a file can go in: telegram only groups audio with audio, and sends .mp4 videos as
+	videos but every other file, .mkv videos included, as a document."""
+	mime_type, _ = mimetypes.guess_type(filename)
+	if mime_type and mime_type.startswith("audio/"):
+		return "audio"
+	if mime_type == "video/mp4":
+		return "video"
+	return "document"
+
+def album_groups(files: list[tuple[str, str, str]], max_items: int) -> list[list[tuple[str, str, str]]]:
+	"""Split (url, filename, caption) files into runs of at most max_items consecutive files of the same media kind,
+	so sending the groups in order keeps the order of the files."""
+	groups: list[list[tuple[str, str, str]]] = []
+	for file in files:
+		if groups and len(groups[-1]) < max_items and media_kind(groups[-1][-1][1]) == media_kind(file[1]):
+			groups[-1].append(file)
+		else:
+			groups.append([file])
+	return groups
+
+async def send_prepared_album(client: TelegramClient, chat_id: int, preparing: list[Awaitable[PreparedFile]], captions: list[str]) -> list[bool]:
+	"""Send files of the same media kind as one telegram album and remember the uploaded documents, returning for
+	each file whether it was sent. The files are prepared in order, each one downloading while the one before it
+	uploads, and when telegram refuses the album they are sent one by one instead."""
+	prepared_files: list[PreparedFile] = []
+	media: list = []
+	upcoming = asyncio.ensure_future(preparing[0])
+	try:
+		for index in range(len(preparing)):
+			prepared = await upcoming
+			prepared_files.append(prepared)
+			upcoming = asyncio.ensure_future(preparing[index + 1]) if index + 1 < len(preparing) else None
+			media.append(prepared.cached_document or await upload_prepared(client, prepared))
+			await prepared.close()
+	except BaseException:
+		if upcoming is not None:
+			upcoming.cancel()
+			try:
+				await (await upcoming).close()
+			except (asyncio.CancelledError, Exception):
+				pass
+		for coroutine in preparing[len(prepared_files) + 1:]:
+			coroutine.close()
+		for prepared in prepared_files:
+			await prepared.close()
+		raise
+
+	ready = [index for index, item in enumerate(media) if item is not None]
+	sent = [False] * len(media)
+	if len(ready) > 1:
+		try:
+			messages = await scheduler.call(chat_id, client.send_file, chat_id, [media[index] for index in ready], caption=[captions[index] for index in ready])
+		except RPCError as e:
+			# e.g. an expired cached reference, which a single send can replace with a fresh upload
+			log.warning(f"Album of {len(ready)} files could not be sent, sending them one by one: {e}")
+		else:
+			metrics.ALBUMS_SENT.inc()
+			for index, message in zip(ready, messages):
+				prepared = prepared_files[index]
+				metrics.FILES_SENT.inc(source="cache" if prepared.cached_document else "upload")
+				if not prepared.cached_document:
+					file_cache.store(prepared.url, prepared.version, message.document)
+				sent[index] = True
+			return sent
+
+	for index in ready:
+		prepared = prepared_files[index]
+		try:
+			if prepared.cached_document:
+				sent[index] = await send_prepared_file(client, chat_id, prepared, captions[index])
+				continue
+			message = await scheduler.call(chat_id, client.send_file, chat_id, media[index], caption=captions[index])
+			metrics.FILES_SENT.inc(source="upload")
+			file_cache.store(prepared.url, prepared.version, message.document)
+			sent[index] = True
+		except RPCError as e:
+			log.warning(f"File {prepared.url} could not be sent: {e}")
+	return sent
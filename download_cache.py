@@ -0,0 +1,226 @@
+"""content-addressed on-disk cache of downloaded files, so a file is fetched from its host once and re-sent from disk"""
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from typing import BinaryIO
+from settings import settings
+import metrics
+
+log = logging.getLogger(__name__)
+
+# files are stored once per content under blobs/<first two hex digits>/<sha256 of the content>, and an index maps
+# every URL and its version (ETag/Content-Length) to the content it had. files are written to tmp/ and only moved
+# into blobs/ once complete and synced, so a crash leaves at most a partial file in tmp/, which is cleared on startup
+# together with blobs the index does not know. the least recently used blobs are deleted once all of them take more
+# than max_bytes. a blob deleted while it is being uploaded stays readable through the file already opened.
+class DownloadCache:
+	def __init__(self, directory: str, max_bytes: int):
+		self.directory = directory
+		self.max_bytes = max_bytes
+		self.hits = 0
+		self.misses = 0
+		self.bytes_saved = 0
+		self._blobs = os.path.join(directory, "blobs")
+		self._tmp = os.path.join(directory, "tmp")
+		os.makedirs(self._blobs, exist_ok=True)
+		os.makedirs(self._tmp, exist_ok=True)
+		self._db = sqlite3.connect(os.path.join(directory, "index.db"), check_same_thread=False)
+		self._db.execute("CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+		self._db.execute("CREATE TABLE IF NOT EXISTS entries (url TEXT PRIMARY KEY, version TEXT NOT NULL, digest TEXT NOT NULL)")
+		self._db.commit()
+		self._recover()
+
+	def _path(self, digest: str) -> str:
+		return os.path.join(self._blobs, digest[:2], digest)
+
+	def _recover(self) -> None:
+		# partial files of downloads a crash interrupted
+		for name in os.listdir(self._tmp):
+			os.remove(os.path.join(self._tmp, name))
+		known = {digest for digest, in self._db.execute("SELECT digest FROM blobs")}
+		present = set()
+		for prefix in os.listdir(self._blobs):
+			for digest in os.listdir(os.path.join(self._blobs, prefix)):
+				if digest in known:
+					present.add(digest)
+				else:
+					# moved into place but never indexed
+					os.remove(os.path.join(self._blobs, prefix, digest))
+		missing = [(digest,) for digest in known - present]
+		self._db.executemany("DELETE FROM blobs WHERE digest = ?", missing)
+		self._db.execute("DELETE FROM entries WHERE digest NOT IN (SELECT digest FROM blobs)")
+		self._db.commit()
+
+	@property
+	def total_bytes(self) -> int:
+		return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+	def open(self, url: str, version: str | None, size: int | None = None) -> BinaryIO | None:
+		"""Open the cached copy of a URL for reading when it matches the origin's version (and size, if known)."""
+		row = self._db.execute(
+			"SELECT blobs.digest, blobs.size FROM entries JOIN blobs ON blobs.digest = entries.digest WHERE entries.url = ? AND entries.version = ?",
+			(url, version)
+		).fetchone() if version else None
+		if row is None or (size is not None and row[1] != size):
+			self.misses += 1
+			return None
+		digest, blob_size = row
+		try:
+			file = open(self._path(digest), "rb")
+		except FileNotFoundError:
+			self._forget(digest)
+			self.misses += 1
+			return None
+		self._db.execute("UPDATE blobs SET last_used = ? WHERE digest = ?", (time.time(), digest))
+		self._db.commit()
+		self.hits += 1
+		self.bytes_saved += blob_size
+		return file
+
+	def writer(self, url: str, version: str | None, size: int | None) -> "CacheWriter | None":
+		"""Start writing a download of a URL into the cache, or None when it can not be cached."""
+		if not version or (size is not None and size > self.max_bytes):
+			return None
+		return CacheWriter(self, url, version, size, os.path.join(self._tmp, uuid.uuid4().hex + ".part"))
+
+	def _store_blob(self, digest: str, part_path: str) -> None:
+		# runs in a worker thread: the blob is moved into place before it is indexed, see _recover
+		path = self._path(digest)
+		if os.path.exists(path):
+			os.remove(part_path)
+		else:
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			os.replace(part_path, path)
+
+	def _index(self, url: str, version: str, digest: str, size: int) -> None:
+		self._db.execute("INSERT OR REPLACE INTO blobs (digest, size, last_used) VALUES (?, ?, ?)", (digest, size, time.time()))
+		self._db.execute("INSERT OR REPLACE INTO entries (url, version, digest) VALUES (?, ?, ?)", (url, version, digest))
+		self._db.commit()
+		self._evict()
+
+	def _forget(self, digest: str) -> None:
+		self._db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+		self._db.execute("DELETE FROM entries WHERE digest = ?", (digest,))
+		self._db.commit()
+
+	def _evict(self) -> None:
+		total = self.total_bytes
+		for digest, size in self._db.execute("SELECT digest, size FROM blobs ORDER BY last_used").fetchall():
+			if total <= self.max_bytes:
+				break
+			try:
+				os.remove(self._path(digest))
+			except FileNotFoundError:
+				pass
+			self._forget(digest)
+			total -= size
+
+	def stats(self) -> dict:
+		"""Return hit/miss counters, the hit ratio, the bytes not downloaded again, and the size of the cache."""
+		lookups = self.hits + self.misses
+		return {
+			"hits": self.hits,
+			"misses": self.misses,
+			"hit_ratio": self.hits / lookups if lookups else 0.0,
+			"bytes_saved": self.bytes_saved,
+			"entries": self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0],
+			"bytes": self.total_bytes
+		}
+
+# a download on its way into the cache. data is appended in order and hashed as it goes, the file is synced and
+# moved into the cache once exactly size bytes were written (or on finish() when the size was not known), and
+# dropped on abort() or when the data does not add up.
+class CacheWriter:
+	def __init__(self, cache: DownloadCache, url: str, version: str, size: int | None, path: str):
+		self.cache = cache
+		self.url = url
+		self.version = version
+		self.size = size
+		self.path = path
+		self.written = 0
+		self._hash = hashlib.sha256()
+		self._file = open(path, "wb")
+		self._closed = False
+
+	def _write(self, data: bytes) -> None:
+		self._file.write(data)
+		self._hash.update(data)
+
+	async def write(self, data: bytes) -> None:
+		"""Append data, committing the file once all of it arrived."""
+		if self._closed or not data:
+			return
+		if self.size is not None and self.written + len(data) > self.size:
+			log.warning(f"Download of {self.url} is longer than {self.size} bytes, not caching it")
+			await self.abort()
+			return
+		await asyncio.to_thread(self._write, data)
+		self.written += len(data)
+		if self.written == self.size:
+			await self.finish()
+
+	def _close_file(self) -> None:
+		self._file.flush()
+		os.fsync(self._file.fileno())
+		self._file.close()
+
+	async def finish(self) -> None:
+		"""Move the written file into the cache, if it is complete."""
+		if self._closed:
+			return
+		if not self.written or (self.size is not None and self.written != self.size):
+			await self.abort()
+			return
+		self._closed = True
+		digest = self._hash.hexdigest()
+		try:
+			await asyncio.to_thread(self._close_file)
+			await asyncio.to_thread(self.cache._store_blob, digest, self.path)
+			self.cache._index(self.url, self.version, digest, self.written)
+		except (OSError, sqlite3.Error) as e:
+			log.warning(f"Could not cache {self.url}: {e}")
+			self._remove()
+
+	def _remove(self) -> None:
+		try:
+			os.remove(self.path)
+		except FileNotFoundError:
+			pass
+
+	async def abort(self) -> None:
+		"""Drop the partial file."""
+		if self._closed:
+			return
+		self._closed = True
+		self._file.close()
+		self._remove()
+
+# wraps a download object (anything with an async read and close) so that everything the uploader reads from it
+# is written to the cache as well
+class CachingReader:
+	def __init__(self, download, writer: CacheWriter):
+		self.download = download
+		self.writer = writer
+		self.name = getattr(download, "name", None)
+		self.size = getattr(download, "size", None)
+
+	async def read(self, size: int = -1) -> bytes:
+		data = await self.download.read(size)
+		await self.writer.write(data)
+		return data
+
+	async def close(self) -> None:
+		# a download that was not read to the end is not worth keeping
+		await self.writer.abort()
+		await self.download.close()
+
+# the cache of every download of the bot, or None when it is turned off
+download_cache = DownloadCache(settings.DOWNLOAD_CACHE_DIR, settings.DOWNLOAD_CACHE_MB * 1024 * 1024) if settings.DOWNLOAD_CACHE_DIR else None
+if download_cache is not None:
+	metrics.watch_cache("download", download_cache)
+	metrics.Observed("bot_download_cache_bytes_saved_total", "Bytes sent from the on-disk download cache instead of being downloaded again.", "counter", lambda: download_cache.bytes_saved)
+	metrics.Observed("bot_download_cache_bytes", "Bytes held by the on-disk download cache.", "gauge", lambda: download_cache.total_bytes)
@@ -0,0 +1,78 @@
+"""persistent cache of telegram file references for files that were already uploaded"""
+import sqlite3
+import time
+from telethon.tl import types
+from settings import settings
+import metrics
+
+# maps a source URL and its version (ETag/Content-Length) to the document telegram stored after the first upload
+class FileReferenceCache:
+	def __init__(self, path: str, max_age: float):
+		self.max_age = max_age
+		self.hits = 0
+		self.misses = 0
+		self.invalidations = 0
+		self._db = sqlite3.connect(path, check_same_thread=False)
+		self._db.execute("""
+			CREATE TABLE IF NOT EXISTS file_refs (
+				url TEXT PRIMARY KEY,
+				version TEXT NOT NULL,
+				document_id INTEGER NOT NULL,
+				access_hash INTEGER NOT NULL,
+				file_reference BLOB NOT NULL,
+				created_at REAL NOT NULL
+			)
+		""")
+		self._db.commit()
+
+	@staticmethod
+	def version_of(file_info: dict | None) -> str | None:
+		"""Build the version string of a remote file from its HEAD metadata, or None if it can not be identified."""
+		if not file_info or (not file_info.get("etag") and file_info.get("content_length") is None):
+			return None
+		return f"{file_info.get('etag') or ''}:{file_info.get('content_length') or ''}"
+
+	def get(self, url: str, version: str | None) -> types.InputDocument | None:
+		"""Return the cached telegram document for the given URL if it still matches the origin file."""
+		if version is None:
+			self.misses += 1
+			return None
+		row = self._db.execute("SELECT version, document_id, access_hash, file_reference, created_at FROM file_refs WHERE url = ?", (url,)).fetchone()
+		if not row:
+			self.misses += 1
+			return None
+
+		# the origin file changed or the entry is too old, so it has to be uploaded again
+		cached_version, document_id, access_hash, file_reference, created_at = row
+		if cached_version != version or time.time() - created_at > self.max_age:
+			self.invalidate(url)
+			self.misses += 1
+			return None
+
+		self.hits += 1
+		return types.InputDocument(id=document_id, access_hash=access_hash, file_reference=file_reference)
+
+	def store(self, url: str, version: str | None, document: types.Document | None) -> None:
+		"""Remember the document telegram returned for an uploaded file."""
+		if version is None or document is None:
+			return
+		self._db.execute(
+			"INSERT OR REPLACE INTO file_refs (url, version, document_id, access_hash, file_reference, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+			(url, version, document.id, document.access_hash, document.file_reference, time.time())
+		)
+		self._db.commit()
+
+	def invalidate(self, url: str) -> None:
+		"""Forget the cached document of a URL."""
+		if self._db.execute("DELETE FROM file_refs WHERE url = ?", (url,)).rowcount:
+			self.invalidations += 1
+		self._db.commit()
+
+	def stats(self) -> dict:
+		"""Return hit/miss counters and the number of cached files."""
+		entries = self._db.execute("SELECT COUNT(*) FROM file_refs").fetchone()[0]
+		return {"hits": self.hits, "misses": self.misses, "invalidations": self.invalidations, "entries": entries}
+
+# the cache shared by every delivery path of the bot
+file_cache = FileReferenceCache(settings.FILE_CACHE_PATH, settings.FILE_CACHE_MAX_AGE)
+metrics.watch_cache("file", file_cache)
@@ -0,0 +1,293 @@
+"""central queue of file deliveries served by a fixed pool of workers"""
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from telethon import TelegramClient
+from settings import settings
+from utils import fetch_file_info
+from delivery import PreparedFile, album_groups, prepare_remote_file, send_prepared_album, send_prepared_file
+from ratelimit import scheduler
+from logs import request_id
+
+log = logging.getLogger(__name__)
+
+class QueueFull(Exception):
+	"""Raised when the queue sheds a request because too many jobs are waiting."""
+
+# one file to be sent to one chat
+@dataclass
+class Job:
+	user_id: int
+	chat_id: int
+	url: str
+	filename: str
+	caption: str
+	future: asyncio.Future
+	prefetch: asyncio.Task | None = field(default=None, repr=False)
+	# correlation id of the update that queued the job, so the worker's logs can be traced back to it
+	request_id: str | None = None
+	# the jobs sent together with this one as a telegram album, this one first, or None for a single file
+	album: list["Job"] | None = field(default=None, repr=False)
+
+	@property
+	def members(self) -> list["Job"]:
+		return self.album or [self]
+
+	async def discard_prefetch(self) -> None:
+		"""Stop the download started ahead of time for this job, if any."""
+		if self.prefetch is None:
+			return
+		self.prefetch.cancel()
+		try:
+			prepared: PreparedFile = await self.prefetch
+			await prepared.close()
+		except (asyncio.CancelledError, Exception):
+			pass
+		self.prefetch = None
+
+# status message of a chat waiting in the queue, edited as the chat moves forward
+@dataclass
+class QueueStatus:
+	message_id: int
+	total_files: int
+	position: int
+
+# jobs are served round-robin per user, one job of a user at a time so the files of a post arrive in order.
+# jobs for a URL that is already being sent wait for it and then reuse the uploaded telegram copy, and new
+# jobs are shed when too many are queued or deferred while too many bytes are in flight.
+class JobQueue:
+	def __init__(self, client: TelegramClient, workers: int, max_depth: int, max_inflight_bytes: int, prefetch: int):
+		self.client = client
+		self.workers = workers
+		self.max_depth = max_depth
+		self.max_inflight_bytes = max_inflight_bytes
+		self.prefetch = prefetch
+		self.inflight_bytes = 0
+		self.coalesced = 0
+		self.shed = 0
+		self.cancelled = 0
+		# users in round-robin order, each with its own waiting jobs
+		self._queues: OrderedDict[int, deque[Job]] = OrderedDict()
+		self._busy_users: set[int] = set()
+		self._inflight_urls: dict[str, asyncio.Future] = {}
+		self._status: dict[int, QueueStatus] = {}
+		self._changed = asyncio.Condition()
+		self._tasks: list[asyncio.Task] = []
+		# the job each worker is running, as its own task so cancel() can stop it without stopping the worker
+		self._running: dict[asyncio.Task, Job] = {}
+		self._background: set[asyncio.Task] = set()
+
+	@property
+	def depth(self) -> int:
+		"""Number of files waiting to be started."""
+		return sum(len(job.members) for jobs in self._queues.values() for job in jobs)
+
+	def start(self) -> None:
+		"""Start the worker pool and the queue position reporter."""
+		if self._tasks:
+			return
+		self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+		self._tasks.append(asyncio.create_task(self._report_positions()))
+
+	async def stop(self) -> None:
+		"""Stop the workers, failing every job that is still waiting."""
+		for task in self._tasks:
+			task.cancel()
+		await asyncio.gather(*self._tasks, return_exceptions=True)
+		self._tasks = []
+		for jobs in self._queues.values():
+			for job in jobs:
+				for member in job.members:
+					await member.discard_prefetch()
+					if not member.future.done():
+						member.future.set_result(False)
+		self._queues.clear()
+
+	async def _notify(self) -> None:
+		async with self._changed:
+			self._changed.notify_all()
+
+	def submit(self, user_id: int, chat_id: int, files: list[tuple[str, str, str]], status_message_id: int | None = None, album_size: int = 0) -> list[asyncio.Future]:
+		"""Queue (url, filename, caption) files for a chat and return one future per file telling whether it was sent.
+		With an album_size above 1, consecutive files of the same media kind are sent as albums of up to that many files."""
+		if self.depth + len(files) > self.max_depth:
+			self.shed += 1
+			raise QueueFull(f"{self.depth} jobs are already waiting")
+
+		loop = asyncio.get_running_loop()
+		queue = self._queues.setdefault(user_id, deque())
+		groups = album_groups(files, album_size) if album_size > 1 else [[file] for file in files]
+		futures = []
+		for group in groups:
+			jobs = [Job(user_id, chat_id, url, filename, caption, loop.create_future(), request_id=request_id.get()) for url, filename, caption in group]
+			if len(jobs) > 1:
+				jobs[0].album = jobs
+			queue.append(jobs[0])
+			futures.extend(job.future for job in jobs)
+		# the status message starts out with the plain progress text, the reporter adds the position once known
+		if status_message_id is not None:
+			self._status[chat_id] = QueueStatus(status_message_id, len(files), 0)
+		task = asyncio.create_task(self._notify())
+		self._background.add(task)
+		task.add_done_callback(self._background.discard)
+		return futures
+
+	async def cancel(self, chat_id: int) -> int:
+		"""Drop the waiting jobs of a chat and cancel its running ones, which close their downloads and uploads,
+		returning how many files were called off."""
+		dropped = []
+		for user_id, jobs in list(self._queues.items()):
+			if any(job.chat_id == chat_id for job in jobs):
+				dropped.extend(job for job in jobs if job.chat_id == chat_id)
+				rest = deque(job for job in jobs if job.chat_id != chat_id)
+				if rest or user_id in self._busy_users:
+					self._queues[user_id] = rest
+				else:
+					del self._queues[user_id]
+		running = [task for task, job in self._running.items() if job.chat_id == chat_id]
+		count = sum(len(job.members) for job in dropped) + sum(len(self._running[task].members) for task in running)
+		for task in running:
+			task.cancel()
+		for job in dropped:
+			for member in job.members:
+				await member.discard_prefetch()
+				if not member.future.done():
+					member.future.set_result(False)
+		# the workers pick up the cancelled tasks and move on to the next user
+		await asyncio.gather(*running, return_exceptions=True)
+		self._status.pop(chat_id, None)
+		if count:
+			self.cancelled += count
+			await self._notify()
+		return count
+
+	def position(self, user_id: int) -> int:
+		"""Number of users served before the next job of this user, 0 when one of its jobs is running."""
+		if user_id in self._busy_users:
+			return 0
+		position = 1
+		for queued_user, jobs in self._queues.items():
+			if queued_user == user_id:
+				break
+			if jobs and queued_user not in self._busy_users:
+				position += 1
+		return position
+
+	def _next_job(self) -> Job | None:
+		# the first user in round-robin order with a waiting job and nothing running goes to the back of the line
+		for user_id, jobs in self._queues.items():
+			if jobs and user_id not in self._busy_users:
+				self._queues.move_to_end(user_id)
+				self._busy_users.add(user_id)
+				return jobs.popleft()
+		return None
+
+	async def _worker(self) -> None:
+		while True:
+			async with self._changed:
+				await self._changed.wait_for(lambda: any(jobs and user_id not in self._busy_users for user_id, jobs in self._queues.items()))
+				job = self._next_job()
+			request_id.set(job.request_id)
+			task = asyncio.create_task(self._run(job))
+			self._running[task] = job
+			try:
+				await asyncio.wait([task])
+			except asyncio.CancelledError:
+				task.cancel()
+				await asyncio.gather(task, return_exceptions=True)
+				raise
+			finally:
+				self._running.pop(task, None)
+				self._busy_users.discard(job.user_id)
+				if not self._queues.get(job.user_id):
+					self._queues.pop(job.user_id, None)
+					self._status.pop(job.chat_id, None)
+				await self._notify()
+
+	async def _prepared(self, job: Job) -> PreparedFile:
+		prepared = await job.prefetch if job.prefetch else await prepare_remote_file(job.url, job.filename)
+		job.prefetch = None
+		return prepared
+
+	async def _run(self, job: Job) -> None:
+		members = job.members
+		# another chat is already sending one of these URLs, wait for it so this job reuses its upload
+		for member in members:
+			inflight = self._inflight_urls.get(member.url)
+			if inflight is not None:
+				self.coalesced += 1
+				await member.discard_prefetch()
+				await asyncio.shield(inflight)
+
+		loop = asyncio.get_running_loop()
+		done = {member.url: loop.create_future() for member in members}
+		self._inflight_urls.update(done)
+		reserved = 0
+		sent = [False] * len(members)
+		try:
+			file_infos = await asyncio.gather(*(fetch_file_info(member.url) for member in members))
+			size = sum((file_info or {}).get("content_length") or 0 for file_info in file_infos)
+			# admission control: defer the job while the bytes already in flight are over the limit
+			async with self._changed:
+				await self._changed.wait_for(lambda: not self.inflight_bytes or self.inflight_bytes + size <= self.max_inflight_bytes)
+				self.inflight_bytes += size
+				reserved = size
+
+			self._prefetch_next(job.user_id)
+			if job.album:
+				sent = await send_prepared_album(self.client, job.chat_id, [self._prepared(member) for member in members], [member.caption for member in members])
+			else:
+				sent = [await send_prepared_file(self.client, job.chat_id, await self._prepared(job), job.caption)]
+		except Exception as e:
+			log.exception(f"Job for {job.url} failed: {e}")
+		finally:
+			self.inflight_bytes -= reserved
+			for member, member_sent in zip(members, sent):
+				if self._inflight_urls.get(member.url) is done[member.url]:
+					del self._inflight_urls[member.url]
+				if not done[member.url].done():
+					done[member.url].set_result(member_sent)
+				if not member.future.done():
+					member.future.set_result(member_sent)
+			# the chat is about to write its final status, so the position reporter must leave the message alone
+			if not any(queued.chat_id == job.chat_id for queued in self._queues.get(job.user_id, ())):
+				self._status.pop(job.chat_id, None)
+			# an album that failed or was cancelled partway leaves the downloads of the members it never got to
+			for member in members:
+				await member.discard_prefetch()
+
+	def _prefetch_next(self, user_id: int) -> None:
+		# start downloading the next files of the same user while the current one uploads
+		upcoming = [member for job in self._queues.get(user_id, ()) for member in job.members]
+		for job in upcoming[:self.prefetch]:
+			if job.prefetch is None and job.url not in self._inflight_urls:
+				job.prefetch = asyncio.create_task(prepare_remote_file(job.url, job.filename))
+
+	async def _report_positions(self) -> None:
+		while True:
+			await asyncio.sleep(settings.QUEUE_FEEDBACK_INTERVAL)
+			for chat_id, status in list(self._status.items()):
+				# a chat whose delivery finished while an earlier chat's edit was waiting
+				if self._status.get(chat_id) is not status:
+					continue
+				user_id = next((job.user_id for jobs in self._queues.values() for job in jobs if job.chat_id == chat_id), None)
+				position = self.position(user_id) if user_id is not None else 0
+				if position == status.position:
+					continue
+				status.position = position
+				try:
+					await scheduler.call(chat_id, self._edit_position, chat_id, status)
+				except Exception as e:
+					log.warning(f"Could not update queue position for {chat_id}: {e}")
+
+	async def _edit_position(self, chat_id: int, status: QueueStatus) -> None:
+		# the delivery may have finished while this edit waited for its turn, and its final text must stay
+		if self._status.get(chat_id) is status:
+			await self.client.edit_message(chat_id, status.message_id, queue_status_text(status.total_files, status.position))
+
+def queue_status_text(total_files: int, position: int) -> str:
+	"""Progress message shown to a chat while its files are queued or being sent."""
+	if position:
+		return f"در حال پردازش {total_files} فایل... نوبت شما در صف: {position} ⏳"
+	return f"در حال پردازش {total_files} فایل... لطفاً منتظر بمانید ⏳"
@@ -0,0 +1,67 @@
+"""paged inline keyboards for long post and file lists"""
+import hashlib
+from dataclasses import dataclass
+from telethon import Button
+from settings import settings
+from cache import TTLCache
+
+# callback data prefixes: open a page of a listing, or pick an item of it
+PAGE_PREFIX = b"pg"
+ITEM_PREFIX = b"it"
+NOOP_DATA = b"noop"
+
+# the pages of one listing, built once and shared by every user looking at it
+@dataclass(frozen=True)
+class PagedKeyboard:
+	token: str
+	pages: tuple
+
+	def page(self, number: int) -> list:
+		"""Return the button rows of a page, clamped to the pages that exist."""
+		return list(self.pages[self.clamp(number)])
+
+	def clamp(self, number: int) -> int:
+		"""Return the nearest page number that exists."""
+		return max(0, min(number, len(self.pages) - 1))
+
+# keyboards by listing token, so a listing seen by many users is laid out once
+_keyboards = TTLCache(settings.CATEGORY_CACHE_TTL + settings.CATEGORY_CACHE_STALE_TTL, max_entries=1000)
+
+def listing_token(labels: list[str]) -> str:
+	"""Short fingerprint of a listing, so stale buttons of an older version of it can be recognized."""
+	return hashlib.blake2b("\n".join(labels).encode(), digest_size=4).hexdigest()
+
+def paged_keyboard(labels: list[str]) -> PagedKeyboard:
+	"""Return the paged inline keyboard of a listing, building it on first use."""
+	token = listing_token(labels)
+	keyboard = _keyboards.get(token)
+	if keyboard is not None:
+		return keyboard
+
+	page_size = settings.KEYBOARD_PAGE_SIZE
+	page_count = max(1, (len(labels) + page_size - 1) // page_size)
+	pages = []
+	for number in range(page_count):
+		start = number * page_size
+		rows = [[Button.inline(label, f"{ITEM_PREFIX.decode()}:{token}:{index}".encode())] for index, label in enumerate(labels[start:start + page_size], start)]
+		# navigation row, only for listings longer than one page
+		if page_count > 1:
+			navigation = []
+			if number > 0:
+				navigation.append(Button.inline("« قبلی", f"{PAGE_PREFIX.decode()}:{token}:{number - 1}".encode()))
+			navigation.append(Button.inline(f"{number + 1}/{page_count}", NOOP_DATA))
+			if number < page_count - 1:
+				navigation.append(Button.inline("بعدی »", f"{PAGE_PREFIX.decode()}:{token}:{number + 1}".encode()))
+			rows.append(navigation)
+		pages.append(tuple(rows))
+
+	keyboard = PagedKeyboard(token, tuple(pages))
+	_keyboards.set(token, keyboard)
+	return keyboard
+
+def parse_callback(data: bytes) -> tuple[bytes, str, int] | None:
+	"""Split paging or item callback data into (prefix, token, number), or None for any other data."""
+	parts = data.split(b":")
+	if len(parts) != 3 or parts[0] not in (PAGE_PREFIX, ITEM_PREFIX) or not parts[2].isdigit():
+		return None
+	return parts[0], parts[1].decode(), int(parts[2])
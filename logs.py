@@ -0,0 +1,58 @@
+"""structured logging with a correlation id per telegram update"""
+import contextvars
+import json
+import logging
+import sys
+import time
+import uuid
+
+# id of the update being handled. tasks started while handling it inherit it, and queued jobs carry it along
+request_id: contextvars.ContextVar[str | None] = contextvars.ContextVar("request_id", default=None)
+
+def new_request_id() -> str:
+	"""Start a new correlation id for the current task and return it."""
+	value = uuid.uuid4().hex[:12]
+	request_id.set(value)
+	return value
+
+# attributes every LogRecord has, anything else came in through extra= and is logged as a field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+# one JSON object per line: time, level, logger, message, the correlation id and the extra= fields
+class JsonFormatter(logging.Formatter):
+	def format(self, record: logging.LogRecord) -> str:
+		entry = {
+			"time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+			"level": record.levelname.lower(),
+			"logger": record.name,
+			"message": record.getMessage()
+		}
+		current = request_id.get()
+		if current:
+			entry["request_id"] = current
+		for key, value in vars(record).items():
+			if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+				entry[key] = value
+		if record.exc_info:
+			entry["exception"] = self.formatException(record.exc_info)
+		return json.dumps(entry, ensure_ascii=False, default=str)
+
+# plain lines for a terminal, with the correlation id when there is one
+class TextFormatter(logging.Formatter):
+	def format(self, record: logging.LogRecord) -> str:
+		current = request_id.get()
+		prefix = f"[{current}] " if current else ""
+		line = f"{self.formatTime(record)} {record.levelname} {record.name}: {prefix}{record.getMessage()}"
+		if record.exc_info:
+			line += "\n" + self.formatException(record.exc_info)
+		return line
+
+def setup_logging(level: str = "INFO", json_format: bool = True) -> None:
+	"""Send every log record to stderr, as JSON lines or as plain text."""
+	handler = logging.StreamHandler(sys.stderr)
+	handler.setFormatter(JsonFormatter() if json_format else TextFormatter())
+	root = logging.getLogger()
+	root.handlers[:] = [handler]
+	root.setLevel(level.upper())
+	# telethon is chatty at INFO
+	logging.getLogger("telethon").setLevel(max(logging.WARNING, root.level))
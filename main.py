@@ -1,8 +1,25 @@
 import os
 import asyncio
+import functools
+import logging
+import time
 from telethon import TelegramClient, events, Button
 from settings import settings
-from utils import get_posts, get_full_content, download_to_bytesio, filter_links, check_user_membership, extract_download_links
+from utils import get_posts, get_textbook_items, get_post_links, filter_links, open_http_session, close_http_session
+from parsing import parse_pool
+from jobs import JobQueue, QueueFull
+from ratelimit import scheduler
+from catalog import catalog
+from sessions import sessions, Session, State
+from membership import MembershipCache
+from prefetch import prefetcher
+from uploads import uploader
+from actors import actors
+from keyboards import PAGE_PREFIX, NOOP_DATA, paged_keyboard, parse_callback
+from logs import new_request_id, setup_logging
+import metrics
+
+log = logging.getLogger("bot")
 
 # Telegram client setup
 api_id = settings.API_ID
@@ -10,6 +27,26 @@ api_hash = settings.API_HASH
 bot_token = settings.BOT_TOKEN
 client = TelegramClient("bot_session", api_id, api_hash)
 
+# every file delivery of the bot goes through this queue and its worker pool
+job_queue = JobQueue(client, settings.JOB_WORKERS, settings.JOB_QUEUE_MAX_DEPTH, settings.JOB_MAX_INFLIGHT_MB * 1024 * 1024, settings.PREFETCH_FILES)
+
+# channel membership answers, cached and kept current from the channel's join/leave updates
+membership = MembershipCache(client, settings.CHANNEL_USERNAME, settings.MEMBERSHIP_POSITIVE_TTL, settings.MEMBERSHIP_NEGATIVE_TTL, settings.MEMBERSHIP_REFRESH_INTERVAL)
+
+# what the metrics endpoint reports about the state of the bot, read at scrape time
+metrics.Observed("bot_active_sessions", "Chat sessions held in memory.", "gauge", lambda: len(sessions))
+metrics.Observed("bot_session_bytes", "Approximate bytes taken by the chat sessions in memory.", "gauge", lambda: sessions.memory_report()["session_bytes"])
+metrics.Observed("bot_job_queue_depth", "File deliveries waiting for a worker.", "gauge", lambda: job_queue.depth)
+metrics.Observed("bot_job_inflight_bytes", "Bytes of the file deliveries running right now.", "gauge", lambda: job_queue.inflight_bytes)
+metrics.Observed("bot_jobs_coalesced_total", "Deliveries that reused an upload of the same file running for another chat.", "counter", lambda: job_queue.coalesced)
+metrics.Observed("bot_jobs_shed_total", "Requests turned away because the delivery queue was full.", "counter", lambda: job_queue.shed)
+metrics.Observed("bot_jobs_cancelled_total", "Files whose delivery was called off by /cancel, /start or another pick of their chat.", "counter", lambda: job_queue.cancelled)
+metrics.Observed("bot_membership_lookups_total", "Membership checks that had to ask telegram.", "counter", lambda: membership.lookups)
+
+# seconds from the start of main() until the bot took updates, reported once it is ready
+time_to_ready: float | None = None
+metrics.Observed("bot_time_to_ready_seconds", "Seconds the last startup took until the bot took updates, warm-up included.", "gauge", lambda: time_to_ready or 0)
+
 # Category definitions
 CATEGORIES = {
 	"سینمایی خارجی": "سینمایی-خارجی",
@@ -23,10 +60,266 @@ CATEGORIES = {
 	}
 }
 
-# User state management (in-memory for now)
-user_states = {}
+# shown when the delivery queue is too long to accept more files
+BUSY_MESSAGE = "ربات در حال حاضر شلوغ است. لطفاً چند دقیقه دیگر دوباره تلاش کنید."
+# shown in place of the progress message of a delivery that was called off
+CANCELLED_MESSAGE = "ارسال فایل‌ها لغو شد."
+
+async def respond(event, *args, **kwargs):
+	"""Reply to an event once the send scheduler allows it."""
+	return await scheduler.call(event.chat_id, event.respond, *args, **kwargs)
+
+async def queue_files(event, files: list[tuple[str, str, str]], status_msg, album_size: int = 0) -> int | None:
+	"""Send (url, filename, caption) files through the job queue, as albums of up to album_size files when above 1,
+	returning how many were sent or None when the queue is full."""
+	try:
+		futures = job_queue.submit(event.sender_id, event.chat_id, files, status_msg.id, album_size)
+	except QueueFull as e:
+		log.warning(f"Queue full, shedding request from {event.chat_id}: {e}")
+		return None
+	try:
+		return sum(await asyncio.gather(*futures))
+	except asyncio.CancelledError:
+		# the chat cancelled or replaced the delivery, so the progress message should not stay behind
+		await scheduler.call(event.chat_id, client.edit_message, event.chat_id, status_msg.id, CANCELLED_MESSAGE)
+		raise
+
+async def cancel_transfers(chat_id: int) -> bool:
+	"""Stop the delivery running for a chat along with its queued, downloading and uploading files, returning
+	whether there was anything to stop."""
+	cancelled = await actors.cancel_transfer(chat_id)
+	return await job_queue.cancel(chat_id) > 0 or cancelled
+
+# a delivery runs beside the chat's actor and never writes the session, which the actor's updates own: the chat
+# stays on the list it picked from, and the list is shown again by the actor, see show_listing_again
+async def run_delivery(event, deliver, selected: dict):
+	try:
+		await deliver(event, selected)
+	except Exception as e:
+		metrics.ERRORS.inc(stage="post")
+		log.exception(f"Error processing selection: {e}")
+		await respond(event, "خطایی در پردازش درخواست شما رخ داد.")
+
+async def start_delivery(event, deliver, selected: dict):
+	"""Run the delivery of a picked post or book as the transfer of its chat, in place of the one running before,
+	so the chat can go on browsing and a /cancel can stop it."""
+	await cancel_transfers(event.chat_id)
+	actors.start_transfer(event.chat_id, run_delivery(event, deliver, selected))
+
+async def show_listing_again(state: State, text: str, event):
+	"""Show the list a delivery was picked from once more, unless the chat went on to another step meanwhile."""
+	session = sessions.get(event.chat_id)
+	if session is not None and session.state == state:
+		await show_listing(event, session, text)
+		sessions.save(event.chat_id)
+
+async def list_posts(category_slug: str) -> list:
+	"""Return the posts of a category from the local catalog, or from the site while it is not indexed yet."""
+	if settings.CATALOG_ENABLED and catalog.ready:
+		posts = catalog.category_posts(category_slug)
+		if posts:
+			return posts
+	return await get_posts(category_slug)
+
+# sessions only name what the user is browsing, these resolve it from the shared caches and catalog
+def category_slug(session: Session) -> str:
+	"""Return the slug of the category or subcategory a session is browsing."""
+	category = CATEGORIES[session.category]
+	return category[session.subcategory] if isinstance(category, dict) else category
+
+async def session_posts(session: Session) -> list:
+	"""Return the posts listed to a session, either its search results or its category listing."""
+	if session.post_ids is not None:
+		return catalog.posts_by_ids(session.post_ids)
+	return await list_posts(category_slug(session))
+
+async def session_items(session: Session) -> list:
+	"""Return the textbook items of the subcategory a session is browsing."""
+	posts = await list_posts(category_slug(session))
+	return await get_textbook_items(posts[0]["link"]) if posts else []
+
+async def session_links(session: Session) -> list:
+	"""Return the books a session chooses from, of the selected grade or of the whole subcategory."""
+	items = await session_items(session)
+	if session.item_index is None:
+		return [link for item in items for link in item["links"]]
+	return items[session.item_index]["links"] if session.item_index < len(items) else []
+
+def find_post(posts: list, text: str) -> dict:
+	"""Return the post a "N. title" label refers to, raising ValueError or IndexError when there is none."""
+	number, _, title = text.strip().partition(". ")
+	post_index = int(number) - 1
+	# the listing may have changed since the keyboard was sent, so the title wins when the number disagrees
+	if 0 <= post_index < len(posts) and posts[post_index]['title']['rendered'] == title:
+		return posts[post_index]
+	return next((p for p in posts if p['title']['rendered'] == title), None) or posts[post_index]
+
+def post_labels(posts: list) -> list[str]:
+	return [f"{i+1}. {p['title']['rendered']}" for i, p in enumerate(posts)]
+
+def link_labels(links: list) -> list[str]:
+	return [link["description"] or link["filename"] for link in links]
+
+async def session_listing(session: Session) -> list:
+	"""Return the posts or books a session is choosing from."""
+	if session.state == State.POST_SELECTION:
+		return await session_posts(session)
+	return await session_links(session)
+
+def listing_labels(session: Session, listing: list) -> list[str]:
+	"""Return the button labels of the posts or books a session is choosing from."""
+	return post_labels(listing) if session.state == State.POST_SELECTION else link_labels(listing)
+
+async def post_links(post: dict) -> list[tuple[str, str, str]]:
+	"""Return the download links of a post, from the catalog when the post is indexed and from the post page otherwise."""
+	download_links = catalog.post_links(post['id']) if settings.CATALOG_ENABLED else []
+	return download_links or await get_post_links(post['link'])
+
+# keys under which picks are counted for the speculative prefetch
+def post_key(post: dict) -> str:
+	return f"post:{post['id']}"
+
+def book_key(link: dict) -> str:
+	return f"book:{link['href']}"
+
+async def prefetch_post(post: dict) -> None:
+	# the post page, its links and their HEAD checks all land in the caches deliver_post reads
+	await filter_links(await post_links(post))
+
+def prefetch_page(session: Session, listing: list) -> None:
+	"""Warm the caches for the entries on the shown page of a list that users picked most often."""
+	if not settings.SPECULATIVE_PREFETCH_PER_LIST:
+		return
+	first = session.page * settings.KEYBOARD_PAGE_SIZE
+	shown = listing[first:first + settings.KEYBOARD_PAGE_SIZE]
+	if session.state == State.POST_SELECTION:
+		prefetcher.offer({post_key(post): functools.partial(prefetch_post, post) for post in shown})
+	else:
+		prefetcher.offer({book_key(link): functools.partial(filter_links, [(link["href"], link["filename"], link["description"])]) for link in shown})
+
+async def show_listing(event, session: Session, text: str):
+	"""Send the page of the post or book list the session is on, as an inline keyboard."""
+	listing = await session_listing(session)
+	keyboard = paged_keyboard(listing_labels(session, listing))
+	session.page = keyboard.clamp(session.page)
+	prefetch_page(session, listing)
+	await respond(event, text, buttons=keyboard.page(session.page))
+
+async def reply_keyboard_step(session: Session, text: str) -> State | None:
+	"""Return the step whose reply keyboard has a button with this text, when it is one the session went through."""
+	if text in CATEGORIES:
+		return State.CATEGORY_SELECTION
+	subcategories = CATEGORIES.get(session.category)
+	if isinstance(subcategories, dict) and text in subcategories:
+		return State.SUBCATEGORY_SELECTION
+	if session.state == State.TEXTBOOK_BOOK_SELECTION and session.item_index is not None:
+		if any(item["title"] == text for item in await session_items(session)):
+			return State.TEXTBOOK_SELECTION
+	return None
+
+async def ask_to_join(event, session: Session):
+	"""Park the session until the user joins the channel and tell them so."""
+	if session.state != State.AWAITING_MEMBERSHIP:
+		session.previous_state = session.state
+	session.state = State.AWAITING_MEMBERSHIP
+	await respond(event,
+		f"شما عضو کانال {settings.CHANNEL_USERNAME} نیستید. لطفاً ابتدا عضو شوید.",
+		buttons=[Button.inline("بررسی عضویت", b"check_membership")]
+	)
+
+async def deliver_book(event, selected_link: dict):
+	"""Send a selected textbook file to the chat and show the book list again."""
+	chat_id = event.chat_id
+	prefetcher.record(book_key(selected_link))
+
+	# based on the selection, retreive the download links, validate and filter out invalid links
+	download_links = [(selected_link["href"], selected_link["filename"], selected_link["description"])]
+	filtered_links = await filter_links(download_links)
+
+	# handle the case where every link was invalid
+	if not filtered_links:
+		await respond(event, "فایل انتخاب‌شده معتبر نیست.")
+		return
+
+	# download the book as required
+	status_msg = await respond(event, "در حال پردازش فایل... لطفاً منتظر بمانید ⏳")
+	url, filename, description = filtered_links[0]
+	sent_files = await queue_files(event, [(url, filename, description or filename)], status_msg)
+	# the queue is full, so ask the user to come back later
+	if sent_files is None:
+		await scheduler.call(chat_id, client.edit_message, chat_id, status_msg.id, BUSY_MESSAGE)
+	# if the file was sent, either from the telegram cache or by downloading it
+	elif sent_files:
+		await scheduler.call(chat_id, client.edit_message, chat_id, status_msg.id, "فایل با موفقیت ارسال شد ✅")
+	# handle download failure
+	else:
+		await scheduler.call(chat_id, client.edit_message, chat_id, status_msg.id, "خطا در دانلود فایل!")
+
+	# move back to the book selection part in order to download more books
+	actors.submit(chat_id, functools.partial(show_listing_again, State.TEXTBOOK_BOOK_SELECTION, "لطفاً یک کتاب دیگر انتخاب کنید یا برای بازگشت به صفحه اصلی از /start استفاده کنید:"), event)
+
+async def deliver_post(event, selected_post: dict):
+	"""Send every valid file of a selected post to the chat and show the post list again."""
+	chat_id = event.chat_id
+	prefetcher.record(post_key(selected_post))
+
+	# obtain the download links, from the catalog when the post is indexed and from the post page otherwise
+	download_links = await post_links(selected_post)
+	if not download_links:
+		await respond(event, "هیچ لینک قابل دانلودی در این پست یافت نشد.")
+		return
+
+	# validate and filter out invalid links
+	filtered_links = await filter_links(download_links)
+	if not filtered_links:
+		await respond(event, "هیچ فایل معتبری در این پست یافت نشد.")
+		return
+
+	# download the files as required
+	status_msg = await respond(event, f"در حال پردازش {len(filtered_links)} فایل... لطفاً منتظر بمانید ⏳")
+	files = [
+		(url, filename, f"{description} ({idx + 1} از {len(filtered_links)})" if description else f"فایل {idx + 1} از {len(filtered_links)}")
+		for idx, (url, filename, description) in enumerate(filtered_links)
+	]
+	# the next files download while the current one uploads, files of the same kind go out together as albums,
+	# and the scheduler keeps telegram's limits
+	sent_files = await queue_files(event, files, status_msg, settings.ALBUM_MAX_FILES)
+
+	# tell the user how many files could be obtained, or that the bot is too busy right now
+	if sent_files is None:
+		await scheduler.call(chat_id, client.edit_message, chat_id, status_msg.id, BUSY_MESSAGE)
+	else:
+		await scheduler.call(chat_id, client.edit_message, chat_id, status_msg.id, f"{sent_files} از {len(filtered_links)} فایل با موفقیت ارسال شد ✅")
+
+	# show out the page of posts the user was on in order to download more
+	actors.submit(chat_id, functools.partial(show_listing_again, State.POST_SELECTION, "لطفاً یک پست دیگر انتخاب کنید یا برای بازگشت به صفحه اصلی از /start استفاده کنید:"), event)
+
+def instrumented(name: str):
+	"""Give every update its own correlation id, and time and log its handling by conversation state."""
+	def decorate(handler):
+		@functools.wraps(handler)
+		async def wrapper(event):
+			new_request_id()
+			session = sessions.peek(event.chat_id)
+			state = session.state.value if session else "none"
+			started = time.perf_counter()
+			try:
+				return await handler(event)
+			except Exception:
+				metrics.ERRORS.inc(stage=name)
+				log.exception(f"Unhandled error in the {name} handler")
+				raise
+			finally:
+				# whatever the handler changed in the session after its awaits is written on the next flush
+				sessions.save(event.chat_id)
+				elapsed = time.perf_counter() - started
+				metrics.HANDLER_SECONDS.observe(elapsed, handler=name, state=state)
+				log.info("Handled update", extra={"handler": name, "state": state, "chat_id": event.chat_id, "seconds": round(elapsed, 4)})
+		return wrapper
+	return decorate
 
 # coded by Roohan, Hossein Peimani and Amir Ramezani (interactively)
+@instrumented("message")
 async def handle_message(event):
 	"""Handle incoming messages based on the user's current state."""
 	chat_id = event.chat_id
@@ -34,258 +327,349 @@ async def handle_message(event):
 
 	# handle /start and create state for user
 	if event.text == "/start":
-		user_states[chat_id] = {"state": "category_selection"}
+		await cancel_transfers(chat_id)
+		sessions.reset(chat_id)
 		buttons = [[Button.text(name)] for name in CATEGORIES.keys()]
-		await event.respond("لطفاً یک دسته‌بندی انتخاب کنید:", buttons=buttons)
+		await respond(event, "لطفاً یک دسته‌بندی انتخاب کنید:", buttons=buttons)
 		return
 
 	# handle /cancel in which the selection and state will be cleared
 	if event.text == "/cancel":
-		user_states.pop(chat_id, None)
-		await event.respond("عملیات لغو شد. برای شروع مجدد از /start استفاده کنید.")
+		await cancel_transfers(chat_id)
+		sessions.pop(chat_id)
+		await respond(event, "عملیات لغو شد. برای شروع مجدد از /start استفاده کنید.")
 		return
 
-	# handle a given user having no state into selecting a category
-	if chat_id not in user_states:
-		user_states[chat_id] = {"state": "category_selection"}
-		buttons = [[Button.text(name)] for name in CATEGORIES.keys()]
-		await event.respond("لطفاً یک دسته‌بندی انتخاب کنید:", buttons=buttons)
-		return
+	# handle a given user having no state into selecting a category, a search can start right away though
+	session = sessions.get(chat_id)
+	if session is None:
+		session = sessions.reset(chat_id)
+		if not event.text.startswith("/search"):
+			buttons = [[Button.text(name)] for name in CATEGORIES.keys()]
+			await respond(event, "لطفاً یک دسته‌بندی انتخاب کنید:", buttons=buttons)
+			return
 
 	# always check membership, no matter the state
-	is_member = await check_user_membership(client, user_id)
-	if not is_member:
-		user_states[chat_id]["previous_state"] = user_states[chat_id].get("state", "category_selection")
-		user_states[chat_id]["state"] = "awaiting_membership"
-		await event.respond(
-			f"شما عضو کانال {settings.CHANNEL_USERNAME} نیستید. لطفاً ابتدا عضو شوید.",
-			buttons=[Button.inline("بررسی عضویت", b"check_membership")]
-		)
+	if not await membership.is_member(user_id):
+		await ask_to_join(event, session)
+		return
+
+	# handle /search by answering from the local catalog and showing the matches as a post list
+	if event.text.startswith("/search"):
+		query = event.text[len("/search"):].strip()
+		if not query:
+			await respond(event, "لطفاً عبارت جستجو را بعد از دستور وارد کنید، مثلاً: /search فرندز")
+			return
+		posts = catalog.search(query) if settings.CATALOG_ENABLED else []
+		if not posts:
+			await respond(event, "نتیجه‌ای برای جستجوی شما یافت نشد.")
+			return
+
+		session.state = State.POST_SELECTION
+		session.post_ids = tuple(p['id'] for p in posts)
+		session.page = 0
+		await show_listing(event, session, "نتایج جستجو، لطفاً یک پست انتخاب کنید:")
 		return
 
-	current_state = user_states[chat_id]["state"]
+	current_state = session.state
+	# the reply keyboard of an earlier step stays on screen under an inline list, so its buttons still pick
+	if current_state in (State.POST_SELECTION, State.TEXTBOOK_BOOK_SELECTION):
+		current_state = await reply_keyboard_step(session, event.text.strip()) or current_state
 
 	# handle category selection state
-	if current_state == "category_selection":
+	if current_state == State.CATEGORY_SELECTION:
 		category_name = event.text.strip()
 		if category_name not in CATEGORIES:
-			await event.respond("لطفاً یک دسته‌بندی معتبر انتخاب کنید.")
+			await respond(event, "لطفاً یک دسته‌بندی معتبر انتخاب کنید.")
 			return
 
+		session.category = category_name
+		session.subcategory = None
+		session.post_ids = None
+		session.page = 0
 		# handle selecting sub-categories
 		if isinstance(CATEGORIES[category_name], dict):
-			user_states[chat_id]["state"] = "subcategory_selection"
-			user_states[chat_id]["category"] = category_name
+			session.state = State.SUBCATEGORY_SELECTION
 			subcategories = CATEGORIES[category_name]
 			buttons = [[Button.text(sub_name)] for sub_name in subcategories.keys()]
-			await event.respond("لطفاً یک زیر‌دسته انتخاب کنید:", buttons=buttons)
+			await respond(event, "لطفاً یک زیر‌دسته انتخاب کنید:", buttons=buttons)
 
 		# if the category does not have sub-categories, we should go to selecting posts
 		else:
-			user_states[chat_id]["state"] = "post_selection"
-			user_states[chat_id]["category"] = CATEGORIES[category_name]
-			posts = await get_posts(CATEGORIES[category_name])
-			print(f"Retrieved {len(posts)} posts for category: {category_name}")
+			session.state = State.POST_SELECTION
+			posts = await list_posts(CATEGORIES[category_name])
+			log.info(f"Retrieved {len(posts)} posts for category: {category_name}")
 
 			# if we cant find anything in the category, we need to handle it as well here
 			if not posts:
-				await event.respond("هیچ پستی در این دسته‌بندی یافت نشد.")
-				user_states.pop(chat_id, None)
+				await respond(event, "هیچ پستی در این دسته‌بندی یافت نشد.")
+				sessions.pop(chat_id)
 				return
 
-			user_states[chat_id]["posts"] = posts
-			buttons = [[Button.text(f"{i+1}. {p['title']['rendered']}")] for i, p in enumerate(posts)]
-			await event.respond("لطفاً یک پست انتخاب کنید:", buttons=buttons)
+			await show_listing(event, session, "لطفاً یک پست انتخاب کنید:")
 
 	# subcategory selection's behaiviour
-	elif current_state == "subcategory_selection":
-		category_name = user_states[chat_id]["category"]
+	elif current_state == State.SUBCATEGORY_SELECTION:
+		category_name = session.category
 		subcategory_name = event.text.strip()
 		if subcategory_name not in CATEGORIES[category_name]:
-			await event.respond("لطفاً یک زیر‌دسته معتبر انتخاب کنید.")
+			await respond(event, "لطفاً یک زیر‌دسته معتبر انتخاب کنید.")
 			return
 
-		user_states[chat_id]["subcategory"] = subcategory_name
-		posts = await get_posts(CATEGORIES[category_name][subcategory_name])
-		print(f"Retrieved {len(posts)} posts for subcategory: {subcategory_name}")
+		session.subcategory = subcategory_name
+		posts = await list_posts(CATEGORIES[category_name][subcategory_name])
+		log.info(f"Retrieved {len(posts)} posts for subcategory: {subcategory_name}")
 
 		# the same with handling posts in the sub-category
 		if not posts:
-			await event.respond("هیچ پستی در این زیر‌دسته یافت نشد.")
-			user_states.pop(chat_id, None)
+			await respond(event, "هیچ پستی در این زیر‌دسته یافت نشد.")
+			sessions.pop(chat_id)
 			return
 
 		# parse the post and retreive the links for textbooks which is a sub-category
-		content, items = await get_full_content(posts[0]["link"], is_textbook=True)
+		items = await get_textbook_items(posts[0]["link"])
 		if not items:
-			await event.respond("هیچ فایل دانلودی در این زیر‌دسته یافت نشد.")
-			user_states.pop(chat_id, None)
+			await respond(event, "هیچ فایل دانلودی در این زیر‌دسته یافت نشد.")
+			sessions.pop(chat_id)
 			return
 
 		# handle textbook sub-category selection part
-		user_states[chat_id]["items"] = items
+		session.item_index = None
+		session.page = 0
 		if subcategory_name == "کتاب‌های درسی تمام پایه‌های تحصیلی":
-			user_states[chat_id]["state"] = "textbook_selection"
+			session.state = State.TEXTBOOK_SELECTION
 			buttons = [[Button.text(item["title"])] for item in items]
-			await event.respond("لطفاً یک پایه تحصیلی انتخاب کنید:", buttons=buttons)
+			await respond(event, "لطفاً یک پایه تحصیلی انتخاب کنید:", buttons=buttons)
 		else:
-			user_states[chat_id]["state"] = "textbook_book_selection"
-			user_states[chat_id]["selected_item"] = {"title": subcategory_name, "links": [link for item in items for link in item["links"]]}
-			buttons = [[Button.text(link["description"] or link["filename"])] for link in user_states[chat_id]["selected_item"]["links"]]
-			await event.respond("لطفاً یک فایل انتخاب کنید:", buttons=buttons)
+			session.state = State.TEXTBOOK_BOOK_SELECTION
+			await show_listing(event, session, "لطفاً یک فایل انتخاب کنید:")
 
 	# handle textbook selection behaiviour for a given education class
-	elif current_state == "textbook_selection":
+	elif current_state == State.TEXTBOOK_SELECTION:
 		selected_title = event.text.strip()
-		items = user_states[chat_id]["items"]
-		selected_item = next((item for item in items if item["title"] == selected_title), None)
+		items = await session_items(session)
+		item_index = next((i for i, item in enumerate(items) if item["title"] == selected_title), None)
 
-		if not selected_item or not selected_item["links"]:
-			await event.respond("هیچ فایل دانلودی برای این پایه تحصیلی یافت نشد.")
+		if item_index is None or not items[item_index]["links"]:
+			await respond(event, "هیچ فایل دانلودی برای این پایه تحصیلی یافت نشد.")
 			return
 
 		# move to book selection for download
-		user_states[chat_id]["state"] = "textbook_book_selection"
-		user_states[chat_id]["selected_item"] = selected_item
-		buttons = [[Button.text(link["description"] or link["filename"])] for link in selected_item["links"]]
-		await event.respond("لطفاً یک کتاب انتخاب کنید:", buttons=buttons)
+		session.state = State.TEXTBOOK_BOOK_SELECTION
+		session.item_index = item_index
+		session.page = 0
+		await show_listing(event, session, "لطفاً یک کتاب انتخاب کنید:")
 
-	# handle book selection part based on a selected file for a given class in order to download
-	elif current_state == "textbook_book_selection":
+	# books are normally picked from the inline list, a typed book name still works
+	elif current_state == State.TEXTBOOK_BOOK_SELECTION:
 		selected_desc = event.text.strip()
-		selected_item = user_states[chat_id]["selected_item"]
-		selected_link = next((link for link in selected_item["links"] if (link["description"] or link["filename"]) == selected_desc), None)
+		links = await session_links(session)
+		selected_link = next((link for link in links if (link["description"] or link["filename"]) == selected_desc), None)
 
 		if not selected_link:
-			await event.respond("هیچ فایلی برای این انتخاب یافت نشد.")
+			await respond(event, "هیچ فایلی برای این انتخاب یافت نشد.")
 			return
 
-		# based on the selection, retreive the download links, validate and filter out invalid links
-		download_links = [(selected_link["href"], selected_link["filename"], selected_link["description"])]
-		filtered_links = await filter_links(download_links)
+		await start_delivery(event, deliver_book, selected_link)
 
-		# handle the case where every link was invalid
-		if not filtered_links:
-			await event.respond("فایل انتخاب‌شده معتبر نیست.")
+	# posts are normally picked from the inline list, a typed "N. title" or post number still works
+	elif current_state == State.POST_SELECTION:
+		# validate and retreive the selected index for a given post.
+		try:
+			posts = await session_posts(session)
+			selected_post = find_post(posts, event.text)
+		except (ValueError, IndexError):
+			await respond(event, "لطفاً شماره پست معتبری انتخاب کنید.")
+			return
+		except Exception as e:
+			metrics.ERRORS.inc(stage="post")
+			log.exception(f"Error processing post: {e}")
+			await respond(event, "خطایی در پردازش درخواست شما رخ داد.")
+			sessions.pop(chat_id)
 			return
 
-		# download the book as required
-		status_msg = await event.respond("در حال پردازش فایل... لطفاً منتظر بمانید ⏳")
-		url, filename, description = filtered_links[0]
-		file_buffer = await download_to_bytesio(url, filename)
-		# if the file was downloaded
-		if file_buffer:
-			caption = description or filename
-			await client.send_file(chat_id, file_buffer, caption=caption)
-			await client.edit_message(chat_id, status_msg.id, "فایل با موفقیت ارسال شد ✅")
-		# handle download failure
-		else:
-			await client.edit_message(chat_id, status_msg.id, "خطا در دانلود فایل!")
-
-		# move back to the book selection part in order to download more books
-		buttons = [[Button.text(link["description"] or link["filename"])] for link in selected_item["links"]]
-		await event.respond("لطفاً یک کتاب دیگر انتخاب کنید یا برای بازگشت به صفحه اصلی از /start استفاده کنید:", buttons=buttons)
+		await start_delivery(event, deliver_post, selected_post)
 
-	# handle post selection for movies
-	elif current_state == "post_selection":
-		# validate and retreive the selected index for a given post.
-		try:
-			post_index = int(event.text.strip().split(". ")[0]) - 1
-			selected_post = user_states[chat_id]["posts"][post_index]
-			content, _ = await get_full_content(selected_post['link'], is_textbook=False)
-
-			# obtain the download links
-			download_links = await extract_download_links(content)
-			if not download_links:
-				await event.respond("هیچ لینک قابل دانلودی در این پست یافت نشد.")
-				user_states.pop(chat_id, None)
-				return
+async def handle_listing_callback(event, kind: bytes, token: str, number: int):
+	"""Turn the page of an inline post or book list in place, or deliver the item picked from it."""
+	chat_id = event.chat_id
+	session = sessions.get(chat_id)
+	if session is None or session.state not in (State.POST_SELECTION, State.TEXTBOOK_BOOK_SELECTION, State.AWAITING_MEMBERSHIP):
+		await event.answer("این فهرست دیگر معتبر نیست. برای شروع مجدد از /start استفاده کنید.")
+		return
 
-			# validate and filter out invalid links
-			filtered_links = await filter_links(download_links)
-			if not filtered_links:
-				await event.respond("هیچ فایل معتبری در این پست یافت نشد.")
-				user_states.pop(chat_id, None)
-				return
+	# the buttons are as much an entry point as messages are, so they get the same membership check
+	if not await membership.is_member(event.sender_id):
+		await event.answer()
+		await ask_to_join(event, session)
+		return
+	if session.state == State.AWAITING_MEMBERSHIP:
+		session.state = session.previous_state or State.CATEGORY_SELECTION
+		if session.state not in (State.POST_SELECTION, State.TEXTBOOK_BOOK_SELECTION):
+			await event.answer("این فهرست دیگر معتبر نیست. برای شروع مجدد از /start استفاده کنید.")
+			return
 
-			# download the files as required
-			status_msg = await event.respond(f"در حال پردازش {len(filtered_links)} فایل... لطفاً منتظر بمانید ⏳")
-			sent_files = 0
-			for idx, (url, filename, description) in enumerate(filtered_links):
-				file_buffer = await download_to_bytesio(url, filename)
-				if file_buffer:
-					caption = f"{description} ({idx + 1} از {len(filtered_links)})" if description else f"فایل {idx + 1} از {len(filtered_links)}"
-					await client.send_file(chat_id, file_buffer, caption=caption)
-					sent_files += 1
-				await asyncio.sleep(1) # limit accessing telegram to prevent the bot being blocked
+	listing = await session_listing(session)
+	keyboard = paged_keyboard(listing_labels(session, listing))
 
-			# tell the user how many files could be obtained
-			await client.edit_message(chat_id, status_msg.id, f"{sent_files} از {len(filtered_links)} فایل با موفقیت ارسال شد ✅")
+	# the listing changed since these buttons were sent, so swap in the current one instead of guessing
+	if keyboard.token != token:
+		session.page = 0
+		await event.answer("فهرست به‌روز شد، لطفاً دوباره انتخاب کنید.")
+		await scheduler.call(chat_id, event.edit, buttons=keyboard.page(0))
+		return
 
-			# show out the posts again in order to download more
-			buttons = [[Button.text(f"{i+1}. {p['title']['rendered']}")] for i, p in enumerate(user_states[chat_id]["posts"])]
-			await event.respond("لطفاً یک پست دیگر انتخاب کنید یا برای بازگشت به صفحه اصلی از /start استفاده کنید:", buttons=buttons)
+	# page navigation edits the keyboard of the same message
+	if kind == PAGE_PREFIX:
+		session.page = keyboard.clamp(number)
+		prefetch_page(session, listing)
+		await event.answer()
+		await scheduler.call(chat_id, event.edit, buttons=keyboard.page(session.page))
+		return
 
-		except (ValueError, IndexError):
-			await event.respond("لطفاً شماره پست معتبری انتخاب کنید.")
-		except Exception as e:
-			print(f"Error processing post: {e}")
-			await event.respond("خطایی در پردازش درخواست شما رخ داد.")
-			user_states.pop(chat_id, None)
+	if number >= len(listing):
+		await event.answer("لطفاً یک گزینه معتبر انتخاب کنید.")
+		return
+	await event.answer()
+	await start_delivery(event, deliver_post if session.state == State.POST_SELECTION else deliver_book, listing[number])
 
 # coded by Hossein Peimani
+@instrumented("callback")
 async def handle_inline(event):
-	"""Handle inline button clicks for membership verification."""
+	"""Handle inline button clicks for membership verification and the paged post and book lists."""
 	user_id = event.sender_id
 	chat_id = event.chat_id
 
+	# the page counter between the navigation buttons does nothing
+	if event.data == NOOP_DATA:
+		await event.answer()
+		return
+
+	callback = parse_callback(event.data)
+	if callback is not None:
+		await handle_listing_callback(event, *callback)
+		return
+
 	if event.data == b"check_membership":
-		if await check_user_membership(client, user_id):
-			previous_state = user_states[chat_id].get("previous_state", "category_selection")
-			user_states[chat_id]["state"] = previous_state
+		# the user says they joined, so a cached "not a member" answer is not good enough here
+		if await membership.is_member(user_id, recheck=True):
+			session = sessions.get(chat_id) or sessions.reset(chat_id)
+			previous_state = session.previous_state or State.CATEGORY_SELECTION
+			session.state = previous_state
 
 			# based on the previous state that the user had, we should show out the buttons
-			if previous_state == "category_selection":
+			if previous_state == State.CATEGORY_SELECTION:
 				buttons = [[Button.text(name)] for name in CATEGORIES.keys()]
-				await event.respond("عضویت شما تأیید شد! لطفاً یک دسته‌بندی انتخاب کنید:", buttons=buttons)
-			elif previous_state == "subcategory_selection":
-				category_name = user_states[chat_id]["category"]
-				subcategories = CATEGORIES[category_name]
+				await respond(event, "عضویت شما تأیید شد! لطفاً یک دسته‌بندی انتخاب کنید:", buttons=buttons)
+			elif previous_state == State.SUBCATEGORY_SELECTION:
+				subcategories = CATEGORIES[session.category]
 				buttons = [[Button.text(sub_name)] for sub_name in subcategories.keys()]
-				await event.respond("عضویت شما تأیید شد! لطفاً یک زیر‌دسته انتخاب کنید:", buttons=buttons)
-			elif previous_state == "textbook_selection":
-				items = user_states[chat_id].get("items", [])
+				await respond(event, "عضویت شما تأیید شد! لطفاً یک زیر‌دسته انتخاب کنید:", buttons=buttons)
+			elif previous_state == State.TEXTBOOK_SELECTION:
+				items = await session_items(session)
 				buttons = [[Button.text(item["title"])] for item in items]
-				await event.respond("عضویت شما تأیید شد! لطفاً یک پایه تحصیلی انتخاب کنید:", buttons=buttons)
-			elif previous_state == "textbook_book_selection":
-				selected_item = user_states[chat_id].get("selected_item", {})
-				buttons = [[Button.text(link["description"] or link["filename"])] for link in selected_item["links"]]
-				await event.respond("عضویت شما تأیید شد! لطفاً یک کتاب انتخاب کنید:", buttons=buttons)
-			elif previous_state == "post_selection":
-				posts = user_states[chat_id].get("posts", [])
-				buttons = [[Button.text(f"{i+1}. {p['title']['rendered']}")] for i, p in enumerate(posts)]
-				await event.respond("عضویت شما تأیید شد! لطفاً یک پست انتخاب کنید:", buttons=buttons)
+				await respond(event, "عضویت شما تأیید شد! لطفاً یک پایه تحصیلی انتخاب کنید:", buttons=buttons)
+			elif previous_state == State.TEXTBOOK_BOOK_SELECTION:
+				await show_listing(event, session, "عضویت شما تأیید شد! لطفاً یک کتاب انتخاب کنید:")
+			elif previous_state == State.POST_SELECTION:
+				await show_listing(event, session, "عضویت شما تأیید شد! لطفاً یک پست انتخاب کنید:")
 		# if the user was not joined yet
 		else:
 			await event.answer("شما هنوز عضو کانال نیستید. لطفاً ابتدا به کانال بپیوندید.")
 
-# Register event handlers
-client.on(events.NewMessage)(handle_message)
-client.on(events.CallbackQuery)(handle_inline)
+async def on_message(event):
+	"""Hand a message to the actor of its chat, stopping the chat's delivery right away on /cancel and /start
+	rather than after the updates queued before them."""
+	if event.text in ("/cancel", "/start"):
+		await cancel_transfers(event.chat_id)
+	actors.submit(event.chat_id, handle_message, event)
+
+async def on_callback(event):
+	"""Hand a button click to the actor of its chat."""
+	actors.submit(event.chat_id, handle_inline, event)
+
+# Register event handlers, every update of a chat is handled by its actor one after the other
+client.on(events.NewMessage)(on_message)
+client.on(events.CallbackQuery)(on_callback)
+
+async def warm_up() -> dict:
+	"""Preload every category listing and the textbook pages of every subcategory, so the first users after a
+	restart do not pay for them, and return what was loaded and how long it took."""
+	report = {"listings": 0, "textbook_pages": 0, "failed": 0}
+
+	async def load_listing(slug: str, textbook: bool) -> None:
+		try:
+			with metrics.WARMUP_SECONDS.time(kind="listing"):
+				posts = await list_posts(slug)
+			report["listings"] += 1
+			if textbook and posts:
+				with metrics.WARMUP_SECONDS.time(kind="textbook"):
+					await get_textbook_items(posts[0]["link"])
+				report["textbook_pages"] += 1
+		except Exception as e:
+			report["failed"] += 1
+			log.warning(f"Warm-up of {slug} failed: {e}")
+
+	started = time.perf_counter()
+	loads = []
+	for value in CATEGORIES.values():
+		if isinstance(value, dict):
+			loads.extend(load_listing(slug, True) for slug in value.values())
+		else:
+			loads.append(load_listing(value, False))
+	try:
+		await asyncio.wait_for(asyncio.gather(*loads), settings.WARMUP_TIMEOUT)
+	except asyncio.TimeoutError:
+		log.warning(f"Warm-up did not finish within {settings.WARMUP_TIMEOUT}s, starting anyway")
+	report["seconds"] = round(time.perf_counter() - started, 3)
+	metrics.WARMUP_SECONDS.observe(report["seconds"], kind="total")
+	log.info("Warm-up finished", extra=report)
+	return report
 
 # coded by Amir Ramezani, Hossein Peimani and Roohan (interactively)
 async def main():
 	"""Initialize and run the Telegram client until disconnected."""
-	print("Starting bot...")
-	await client.start(bot_token=bot_token)
-	print("Bot started successfully!")
-	await client.run_until_disconnected()
+	global time_to_ready
+	started = time.perf_counter()
+	setup_logging(settings.LOG_LEVEL, settings.LOG_JSON)
+	log.info("Starting bot...")
+	# the shared HTTP session lives as long as the bot does
+	await open_http_session()
+	metrics_runner = await metrics.start_metrics_server()
+	metrics.loop_lag.start()
+	await parse_pool.start()
+	if settings.CATALOG_ENABLED:
+		catalog.start_sync(settings.CATALOG_SYNC_INTERVAL)
+	job_queue.start()
+	sessions.start(settings.SESSION_FLUSH_INTERVAL)
+	try:
+		# the caches are filled before the client connects, since connecting is what starts the flow of updates
+		if settings.WARMUP_ENABLED:
+			await warm_up()
+		await client.start(bot_token=bot_token)
+		await membership.start()
+		time_to_ready = round(time.perf_counter() - started, 3)
+		log.info(f"Bot started successfully in {time_to_ready}s!", extra={"time_to_ready": time_to_ready})
+		await client.run_until_disconnected()
+	finally:
+		await actors.stop()
+		await prefetcher.stop()
+		await uploader.stop()
+		await membership.stop()
+		await sessions.stop()
+		await job_queue.stop()
+		await catalog.stop_sync()
+		await close_http_session()
+		await parse_pool.stop()
+		await metrics.loop_lag.stop()
+		if metrics_runner is not None:
+			await metrics_runner.cleanup()
 
 if __name__ == "__main__":
 	# run the bot
 	try:
 		asyncio.run(main())
 	except KeyboardInterrupt:
-		print("Bot stopped by user.")
+		log.info("Bot stopped by user.")
 	except Exception as e:
-		print(f"an exception occured: {str(e)}")
+		log.exception(f"an exception occured: {str(e)}")
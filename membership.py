@@ -0,0 +1,99 @@
+"""cached channel membership checks"""
+import asyncio
+import logging
+from telethon import TelegramClient, events, utils as telethon_utils
+from telethon.tl import types
+from settings import settings
+from cache import TTLCache
+from utils import check_user_membership
+
+log = logging.getLogger(__name__)
+
+# answers "is this user in the channel?" from memory whenever possible. results of targeted lookups are cached,
+# members and leavers seen in channel participant updates are applied right away, and optionally the whole
+# member list is reloaded in the background so most members never need a lookup at all.
+class MembershipCache:
+	def __init__(self, client: TelegramClient, channel: str, positive_ttl: float, negative_ttl: float, refresh_interval: float):
+		self.client = client
+		self.channel = channel
+		self.refresh_interval = refresh_interval
+		self.lookups = 0
+		self._members = TTLCache(positive_ttl, max_entries=100000)
+		self._non_members = TTLCache(negative_ttl, max_entries=100000)
+		# user ids from the last bulk refresh, None until one has finished
+		self._member_ids: frozenset[int] | None = None
+		self._channel_id = None
+		self._refresh_task = None
+
+	async def is_member(self, user_id: int, recheck: bool = False) -> bool:
+		"""Return whether a user is a member of the channel, asking telegram again about non-members when recheck is set."""
+		if not settings.MEMBERSHIP_CHECK_ENABLED:
+			return True
+		if self._members.get(user_id) or (self._member_ids is not None and user_id in self._member_ids):
+			return True
+		if not recheck and self._non_members.get(user_id):
+			return False
+
+		self.lookups += 1
+		result = await check_user_membership(self.client, user_id)
+		if result is None:
+			return False
+		self._remember(user_id, result)
+		return result
+
+	def _remember(self, user_id: int, is_member: bool) -> None:
+		if is_member:
+			self._members.set(user_id, True)
+			self._non_members.pop(user_id)
+		else:
+			self._non_members.set(user_id, True)
+			self._members.pop(user_id)
+			if self._member_ids is not None and user_id in self._member_ids:
+				self._member_ids = self._member_ids - {user_id}
+
+	async def _on_participant_update(self, update: types.UpdateChannelParticipant) -> None:
+		if self._channel_id is not None and update.channel_id != self._channel_id:
+			return
+		joined = update.new_participant is not None and not isinstance(update.new_participant, (types.ChannelParticipantBanned, types.ChannelParticipantLeft))
+		self._remember(update.user_id, joined)
+
+	async def _refresh_members(self) -> None:
+		while True:
+			try:
+				member_ids = frozenset([user.id async for user in self.client.iter_participants(self.channel)])
+				self._member_ids = member_ids
+				log.info(f"Membership refresh finished, {len(member_ids)} members")
+			except Exception as e:
+				log.warning(f"Membership refresh error: {e}")
+			await asyncio.sleep(self.refresh_interval)
+
+	async def start(self) -> None:
+		"""Listen for joins and leaves of the channel and start the bulk refresh when configured."""
+		if not settings.MEMBERSHIP_CHECK_ENABLED:
+			return
+		try:
+			self._channel_id = telethon_utils.get_peer_id(await self.client.get_input_entity(self.channel), add_mark=False)
+		except Exception as e:
+			log.warning(f"Could not resolve {self.channel}, participant updates are not filtered: {e}")
+		self.client.add_event_handler(self._on_participant_update, events.Raw(types.UpdateChannelParticipant))
+		if self.refresh_interval > 0 and (self._refresh_task is None or self._refresh_task.done()):
+			self._refresh_task = asyncio.create_task(self._refresh_members())
+
+	async def stop(self) -> None:
+		"""Stop the bulk refresh."""
+		if self._refresh_task is not None:
+			self._refresh_task.cancel()
+			try:
+				await self._refresh_task
+			except asyncio.CancelledError:
+				pass
+			self._refresh_task = None
+
+	def stats(self) -> dict:
+		"""Return cache sizes and how many lookups reached telegram."""
+		return {
+			"lookups": self.lookups,
+			"members_cached": len(self._members),
+			"non_members_cached": len(self._non_members),
+			"member_ids": len(self._member_ids) if self._member_ids is not None else 0
+		}
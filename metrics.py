@@ -0,0 +1,233 @@
+"""in-process counters and histograms of every stage of the bot, exposed in the prometheus text format"""
+import asyncio
+import bisect
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable
+from aiohttp import web
+from settings import settings
+
+log = logging.getLogger(__name__)
+
+# bucket bounds in seconds for fast calls (HTTP requests, parsing, telegram calls) and for whole transfers
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+TRANSFER_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+# bytes per second, from a slow mirror to a local link
+THROUGHPUT_BUCKETS = (64e3, 256e3, 1e6, 4e6, 16e6, 64e6, 256e6)
+
+def _escape(value: str) -> str:
+	return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+	pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+	if extra:
+		pairs.append(extra)
+	return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class _Metric:
+	kind = "untyped"
+
+	def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+		self.name = name
+		self.help = help
+		self.labelnames = labelnames
+		registry.register(self)
+
+	def _key(self, labels: dict) -> tuple:
+		return tuple(labels.get(name, "") for name in self.labelnames)
+
+	def header(self) -> list[str]:
+		return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+# a value that only goes up, per combination of labels
+class Counter(_Metric):
+	kind = "counter"
+
+	def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+		super().__init__(name, help, labelnames)
+		self._values: dict[tuple, float] = {}
+
+	def inc(self, amount: float = 1, **labels) -> None:
+		key = self._key(labels)
+		self._values[key] = self._values.get(key, 0) + amount
+
+	def value(self, **labels) -> float:
+		return self._values.get(self._key(labels), 0)
+
+	def render(self) -> list[str]:
+		return self.header() + [f"{self.name}{_labels(self.labelnames, key)} {value}" for key, value in self._values.items()]
+
+# distribution of observed values in fixed buckets, per combination of labels
+class Histogram(_Metric):
+	kind = "histogram"
+
+	def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+		super().__init__(name, help, labelnames)
+		self.buckets = tuple(sorted(buckets))
+		# per label combination: bucket counts (the last one is +Inf), sum and count
+		self._values: dict[tuple, list] = {}
+
+	def observe(self, value: float, **labels) -> None:
+		key = self._key(labels)
+		entry = self._values.get(key)
+		if entry is None:
+			entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+		entry[0][bisect.bisect_left(self.buckets, value)] += 1
+		entry[1] += value
+		entry[2] += 1
+
+	@contextmanager
+	def time(self, **labels):
+		"""Observe how many seconds the body of a with block took."""
+		started = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(time.perf_counter() - started, **labels)
+
+	def count(self, **labels) -> int:
+		entry = self._values.get(self._key(labels))
+		return entry[2] if entry else 0
+
+	def render(self) -> list[str]:
+		lines = self.header()
+		for key, (counts, total, count) in self._values.items():
+			cumulative = 0
+			for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+				cumulative += bucket_count
+				le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+				lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+			lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {total}")
+			lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+		return lines
+
+# a value read from elsewhere at scrape time. the callback returns a number, or a dict of label tuples to numbers
+class Observed(_Metric):
+	def __init__(self, name: str, help: str, kind: str, read: Callable[[], float | dict], labelnames: tuple[str, ...] = ()):
+		self.kind = kind
+		self.read = read
+		super().__init__(name, help, labelnames)
+
+	def render(self) -> list[str]:
+		values = self.read()
+		if not isinstance(values, dict):
+			values = {(): values}
+		return self.header() + [f"{self.name}{_labels(self.labelnames, key)} {value}" for key, value in values.items()]
+
+# every metric of the process, in registration order
+class Registry:
+	def __init__(self):
+		self._metrics: dict[str, _Metric] = {}
+
+	def register(self, metric: _Metric) -> None:
+		self._metrics[metric.name] = metric
+
+	def render(self) -> str:
+		lines = []
+		for metric in self._metrics.values():
+			try:
+				lines.extend(metric.render())
+			except Exception as e:
+				lines.append(f"# {metric.name} could not be read: {_escape(e)}")
+		return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+# caches reported under bot_cache_* with a cache label, see watch_cache
+_caches: dict[str, object] = {}
+
+def watch_cache(name: str, cache) -> None:
+	"""Report the hits, misses and entries of a cache, read from its stats() at scrape time."""
+	_caches[name] = cache
+
+def _cache_stat(key: str) -> dict:
+	return {(name,): cache.stats()[key] for name, cache in _caches.items()}
+
+Observed("bot_cache_hits_total", "Lookups answered by a cache.", "counter", lambda: _cache_stat("hits"), ("cache",))
+Observed("bot_cache_misses_total", "Lookups a cache could not answer.", "counter", lambda: _cache_stat("misses"), ("cache",))
+Observed("bot_cache_entries", "Entries held by a cache.", "gauge", lambda: _cache_stat("entries"), ("cache",))
+
+# the stages of the bot
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Time to handle one telegram update, by handler and conversation state.", ("handler", "state"), TRANSFER_BUCKETS)
+WP_PAGE_SECONDS = Histogram("bot_wp_posts_page_seconds", "Time to fetch one page of a category listing from the WordPress API.")
+WP_PAGES = Counter("bot_wp_posts_pages_total", "Category listing pages fetched from the WordPress API, by outcome.", ("outcome",))
+PAGE_FETCH_SECONDS = Histogram("bot_page_fetch_seconds", "Time to fetch a post or textbook page, by parser and response status.", ("parser", "status"))
+PAGE_PARSE_SECONDS = Histogram("bot_page_parse_seconds", "Time to parse a fetched post or textbook page, by parser.", ("parser",))
+HEAD_SECONDS = Histogram("bot_head_seconds", "Time of one HEAD request validating a download link, by outcome.", ("outcome",))
+DOWNLOAD_BYTES = Counter("bot_download_bytes_total", "Bytes downloaded from file hosts, by download mode.", ("mode",))
+DOWNLOAD_THROUGHPUT = Histogram("bot_download_bytes_per_second", "Average speed of finished downloads, by download mode.", ("mode",), THROUGHPUT_BUCKETS)
+DOWNLOAD_RESUMES = Counter("bot_download_resumes_total", "Ranged download segments resumed after their connection broke.")
+UPLOAD_SECONDS = Histogram("bot_telegram_upload_seconds", "Time to upload one file to telegram, by upload mode.", ("mode",), TRANSFER_BUCKETS)
+UPLOAD_PART_RETRIES = Counter("bot_telegram_upload_part_retries_total", "File parts sent again after failing in a parallel upload.")
+ALBUMS_SENT = Counter("bot_albums_sent_total", "Groups of files sent to a chat as one telegram album.")
+FILES_SENT = Counter("bot_files_sent_total", "Files sent to chats, by where the file came from.", ("source",))
+SEND_WAIT_SECONDS = Histogram("bot_telegram_send_wait_seconds", "Time a telegram call waited for the rate limiter before running.")
+FLOOD_WAITS = Counter("bot_telegram_flood_waits_total", "FloodWaitErrors returned by telegram.")
+FLOOD_WAIT_SECONDS = Counter("bot_telegram_flood_wait_seconds_total", "Seconds telegram asked the bot to wait in FloodWaitErrors.")
+ERRORS = Counter("bot_errors_total", "Errors handled by the bot, by stage.", ("stage",))
+PARSER_CHECKS = Counter("bot_html_parser_checks_total", "Pages parsed with both html5lib and lxml under the auto parser, by whether the results were the same.", ("outcome",))
+PARSE_SECONDS = Histogram("bot_parse_seconds", "Time to parse one document, by where it was parsed (pool includes waiting for a worker).", ("where",))
+PREFETCH = Counter("bot_prefetch_total", "Speculative prefetches by outcome (started, skipped over budget, failed, used by a later pick).", ("outcome",))
+WARMUP_SECONDS = Histogram("bot_warmup_seconds", "Time to preload one category listing or textbook page at startup, by kind.", ("kind",), TRANSFER_BUCKETS)
+LOOP_LAG_SECONDS = Histogram("bot_event_loop_lag_seconds", "How late the event loop woke a sleeping task, a measure of how long callbacks blocked it.", buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+
+def observe_download(mode: str, size: int, seconds: float) -> None:
+	"""Count a finished download and its average speed."""
+	DOWNLOAD_BYTES.inc(size, mode=mode)
+	if seconds > 0:
+		DOWNLOAD_THROUGHPUT.observe(size / seconds, mode=mode)
+
+# sleeps interval seconds over and over and records how much later than asked it woke up. anything beyond a
+# millisecond or two means some callback held the event loop, and every user waited that long
+class LoopLagMonitor:
+	def __init__(self, interval: float, warn_after: float, keep: int = 10000):
+		self.interval = interval
+		self.warn_after = warn_after
+		self.max_lag = 0.0
+		self.lags: deque[float] = deque(maxlen=keep)
+		self._task = None
+
+	async def _watch(self) -> None:
+		while True:
+			expected = time.perf_counter() + self.interval
+			await asyncio.sleep(self.interval)
+			lag = max(0.0, time.perf_counter() - expected)
+			self.lags.append(lag)
+			self.max_lag = max(self.max_lag, lag)
+			LOOP_LAG_SECONDS.observe(lag)
+			if lag > self.warn_after:
+				log.warning(f"Event loop blocked for {lag:.3f}s")
+
+	def start(self) -> None:
+		"""Start measuring in the background."""
+		if self.interval > 0 and (self._task is None or self._task.done()):
+			self._task = asyncio.create_task(self._watch())
+
+	async def stop(self) -> None:
+		if self._task is not None:
+			self._task.cancel()
+			try:
+				await self._task
+			except asyncio.CancelledError:
+				pass
+			self._task = None
+
+# the monitor of the bot's event loop
+loop_lag = LoopLagMonitor(settings.LOOP_LAG_INTERVAL, settings.LOOP_LAG_WARN)
+Observed("bot_event_loop_lag_max_seconds", "Longest event loop stall seen since startup.", "gauge", lambda: loop_lag.max_lag)
+
+async def handle_metrics(request: web.Request) -> web.Response:
+	return web.Response(body=registry.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def start_metrics_server() -> web.AppRunner | None:
+	"""Serve /metrics on the configured local address, returning the runner to clean up, or None when disabled."""
+	if not settings.METRICS_ENABLED:
+		return None
+	app = web.Application()
+	app.router.add_get("/metrics", handle_metrics)
+	runner = web.AppRunner(app, access_log=None)
+	await runner.setup()
+	await web.TCPSite(runner, settings.METRICS_HOST, settings.METRICS_PORT).start()
+	return runner
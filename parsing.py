@@ -0,0 +1,79 @@
+"""HTML parsing in worker processes, so a large page never stalls the event loop"""
+import asyncio
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable
+from settings import settings
+import metrics
+
+log = logging.getLogger(__name__)
+
+def _warm_up() -> None:
+	# importing the parsers here means the first real page does not pay for it
+	import utils  # noqa: F401
+
+# runs pure parse functions (HTML in, links or items out) in a process pool. at most max_pending parses are
+# submitted at once and the rest wait their turn, small documents are parsed right away on the event loop where
+# shipping them to a worker would cost more than the parse, and everything falls back to parsing in process
+# when the pool is turned off or its workers died and could not be restarted.
+class ParsePool:
+	def __init__(self, workers: int, max_pending: int, inline_max_chars: int):
+		self.workers = workers
+		self.inline_max_chars = inline_max_chars
+		self.pending = 0
+		self._slots = asyncio.Semaphore(max_pending)
+		self._executor: ProcessPoolExecutor | None = None
+
+	async def start(self) -> None:
+		"""Start the worker processes and wait until every one of them is ready."""
+		if self.workers <= 0 or self._executor is not None:
+			return
+		self._executor = ProcessPoolExecutor(max_workers=self.workers)
+		loop = asyncio.get_running_loop()
+		try:
+			await asyncio.gather(*(loop.run_in_executor(self._executor, _warm_up) for _ in range(self.workers)))
+		except Exception as e:
+			log.warning(f"Parse workers could not start, parsing in process: {e}")
+			self._shutdown()
+
+	def _shutdown(self) -> None:
+		if self._executor is not None:
+			self._executor.shutdown(wait=False, cancel_futures=True)
+			self._executor = None
+
+	async def stop(self) -> None:
+		"""Stop the worker processes."""
+		self._shutdown()
+
+	async def run(self, func: Callable[..., Any], document: str, *args) -> Any:
+		"""Return func(document, *args), computed in a worker process unless the document is small or the pool is off."""
+		if self._executor is None or len(document) <= self.inline_max_chars:
+			return self._inline(func, document, *args)
+
+		self.pending += 1
+		try:
+			async with self._slots:
+				started = time.perf_counter()
+				try:
+					result = await asyncio.get_running_loop().run_in_executor(self._executor, func, document, *args)
+				except BrokenProcessPool:
+					# a worker died (out of memory, killed), so start over with fresh ones and parse this page here
+					log.warning("Parse worker died, restarting the pool")
+					self._shutdown()
+					await self.start()
+					return self._inline(func, document, *args)
+				metrics.PARSE_SECONDS.observe(time.perf_counter() - started, where="pool")
+				return result
+		finally:
+			self.pending -= 1
+
+	@staticmethod
+	def _inline(func: Callable[..., Any], document: str, *args) -> Any:
+		with metrics.PARSE_SECONDS.time(where="inline"):
+			return func(document, *args)
+
+# the pool every page and post content is parsed through
+parse_pool = ParsePool(settings.PARSE_WORKERS, settings.PARSE_MAX_PENDING, settings.PARSE_INLINE_MAX_CHARS)
+metrics.Observed("bot_parse_pending", "Parses submitted to or waiting for the parse workers.", "gauge", lambda: parse_pool.pending)
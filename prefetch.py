@@ -0,0 +1,80 @@
+"""speculative prefetch of what users are likely to pick next, ranked by how often it was picked before"""
+import asyncio
+import logging
+from typing import Awaitable, Callable
+from cache import TTLCache
+from ratelimit import TokenBucket
+from settings import settings
+import metrics
+
+log = logging.getLogger(__name__)
+
+# counts how often each post or book is picked and, when a list is shown, warms the caches for the most picked
+# entries of it in the background. at most per_listing entries of one list are considered, at most concurrency
+# loads run at once and the loads are paced by a token bucket of rate per second, anything beyond that budget is
+# skipped rather than queued. an entry loaded less than recent_ttl seconds ago is not loaded again.
+class Prefetcher:
+	def __init__(self, per_listing: int, min_picks: int, concurrency: int, rate: float, burst: float, recent_ttl: float, max_tracked: int = 20000):
+		self.per_listing = per_listing
+		self.min_picks = min_picks
+		self.concurrency = concurrency
+		self.max_tracked = max_tracked
+		self.picks: dict[str, int] = {}
+		self._budget = TokenBucket(rate, burst)
+		self._recent = TTLCache(recent_ttl, max_entries=max_tracked)
+		self._running: dict[str, asyncio.Task] = {}
+
+	@property
+	def running(self) -> int:
+		return len(self._running)
+
+	def record(self, key: str) -> None:
+		"""Count a pick of an entry, and whether it had been prefetched."""
+		self.picks[key] = self.picks.get(key, 0) + 1
+		if self._recent.get(key):
+			metrics.PREFETCH.inc(outcome="used")
+		if len(self.picks) > self.max_tracked:
+			# forget the least picked half, so the counts stay bounded and follow what is popular now
+			ranked = sorted(self.picks.items(), key=lambda item: item[1], reverse=True)
+			self.picks = {key: count // 2 for key, count in ranked[:self.max_tracked // 2]}
+
+	def rank(self, keys: list[str]) -> list[str]:
+		"""Return the keys worth prefetching, most picked first and in list order among equals."""
+		ranked = sorted((key for key in keys if self.picks.get(key, 0) >= self.min_picks), key=lambda key: -self.picks.get(key, 0))
+		return ranked[:self.per_listing]
+
+	def offer(self, candidates: dict[str, Callable[[], Awaitable]]) -> None:
+		"""Start loading the most likely of the candidates, key to loader, in list order, as far as the budget allows."""
+		for key in self.rank(list(candidates)):
+			if key in self._running or self._recent.get(key):
+				continue
+			if len(self._running) >= self.concurrency or not self._budget.try_acquire():
+				metrics.PREFETCH.inc(outcome="skipped")
+				return
+			metrics.PREFETCH.inc(outcome="started")
+			self._running[key] = asyncio.create_task(self._load(key, candidates[key]))
+
+	async def _load(self, key: str, loader: Callable[[], Awaitable]) -> None:
+		try:
+			await loader()
+			self._recent.set(key, True)
+		except Exception as e:
+			metrics.PREFETCH.inc(outcome="failed")
+			log.debug(f"Prefetch of {key} failed: {e}")
+		finally:
+			self._running.pop(key, None)
+
+	async def stop(self) -> None:
+		"""Cancel the prefetches that are still running."""
+		tasks = list(self._running.values())
+		for task in tasks:
+			task.cancel()
+		await asyncio.gather(*tasks, return_exceptions=True)
+
+# the prefetcher of post pages and file metadata shared by all chats
+prefetcher = Prefetcher(
+	settings.SPECULATIVE_PREFETCH_PER_LIST, settings.SPECULATIVE_PREFETCH_MIN_PICKS,
+	settings.SPECULATIVE_PREFETCH_CONCURRENCY, settings.SPECULATIVE_PREFETCH_RATE,
+	settings.SPECULATIVE_PREFETCH_BURST, settings.SPECULATIVE_PREFETCH_RECENT_TTL
+)
+metrics.Observed("bot_prefetch_running", "Speculative prefetches running right now.", "gauge", lambda: prefetcher.running)
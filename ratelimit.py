@@ -0,0 +1,91 @@
+"""rate limiting of outgoing telegram calls so the bot stays under telegram's flood limits"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable
+from telethon.errors import FloodWaitError
+from settings import settings
+from cache import TTLCache
+import metrics
+
+log = logging.getLogger(__name__)
+
+# classic token bucket: holds up to capacity tokens and gains rate tokens per second
+class TokenBucket:
+	def __init__(self, rate: float, capacity: float):
+		self.rate = rate
+		self.capacity = capacity
+		self._tokens = capacity
+		self._updated = time.monotonic()
+		self._lock = asyncio.Lock()
+
+	def _refill(self) -> None:
+		now = time.monotonic()
+		self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+		self._updated = now
+
+	async def acquire(self, tokens: float = 1) -> None:
+		"""Take tokens (one by default), waiting until enough are available."""
+		async with self._lock:
+			while True:
+				self._refill()
+				if self._tokens >= tokens:
+					self._tokens -= tokens
+					return
+				await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+	def try_acquire(self) -> bool:
+		"""Take one token if one is available right now, without waiting."""
+		if self._lock.locked():
+			return False
+		self._refill()
+		if self._tokens >= 1:
+			self._tokens -= 1
+			return True
+		return False
+
+# every respond, edit_message and send_file of the bot goes through here. calls are admitted by a global and a
+# per-chat token bucket, and a FloodWaitError pauses all calls for the time telegram asked before retrying.
+class SendScheduler:
+	def __init__(self, global_rate: float, global_burst: float, chat_rate: float, chat_burst: float, max_retries: int = 3):
+		self.chat_rate = chat_rate
+		self.chat_burst = chat_burst
+		self.max_retries = max_retries
+		self.flood_waits = 0
+		self._global = TokenBucket(global_rate, global_burst)
+		# idle chats lose their bucket, which is fine since an idle bucket is full anyway
+		self._chats = TTLCache(600, max_entries=50000)
+		self._paused_until = 0.0
+
+	def _chat_bucket(self, chat_id: int) -> TokenBucket:
+		bucket = self._chats.get(chat_id)
+		if bucket is None:
+			bucket = TokenBucket(self.chat_rate, self.chat_burst)
+		self._chats.set(chat_id, bucket)
+		return bucket
+
+	async def call(self, chat_id: int, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+		"""Run a telegram call for a chat once the rate limits allow it, backing off on flood waits."""
+		for attempt in range(self.max_retries + 1):
+			started = time.perf_counter()
+			await self._chat_bucket(chat_id).acquire()
+			await self._global.acquire()
+			while (delay := self._paused_until - time.monotonic()) > 0:
+				await asyncio.sleep(delay)
+			metrics.SEND_WAIT_SECONDS.observe(time.perf_counter() - started)
+			try:
+				return await func(*args, **kwargs)
+			except FloodWaitError as e:
+				self.flood_waits += 1
+				metrics.FLOOD_WAITS.inc()
+				metrics.FLOOD_WAIT_SECONDS.inc(e.seconds)
+				if attempt == self.max_retries:
+					raise
+				log.warning(f"Flood wait of {e.seconds}s while sending to {chat_id}, backing off")
+				self._paused_until = max(self._paused_until, time.monotonic() + e.seconds)
+
+# the scheduler shared by the whole bot
+scheduler = SendScheduler(
+	settings.SEND_GLOBAL_RATE, settings.SEND_GLOBAL_BURST,
+	settings.SEND_CHAT_RATE, settings.SEND_CHAT_BURST
+)
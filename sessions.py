@@ -0,0 +1,190 @@
+"""compact per-chat conversation state with eviction and optional sqlite persistence"""
+import asyncio
+import json
+import logging
+import sqlite3
+import sys
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field, fields
+from enum import Enum
+from settings import settings
+
+log = logging.getLogger(__name__)
+
+# the steps of a conversation with the bot
+class State(str, Enum):
+	CATEGORY_SELECTION = "category_selection"
+	SUBCATEGORY_SELECTION = "subcategory_selection"
+	TEXTBOOK_SELECTION = "textbook_selection"
+	TEXTBOOK_BOOK_SELECTION = "textbook_book_selection"
+	POST_SELECTION = "post_selection"
+	AWAITING_MEMBERSHIP = "awaiting_membership"
+
+# what the bot remembers about a chat. listings are not copied in here: a session only names the category
+# and subcategory, whose posts and textbook items live in the shared caches and catalog, or keeps the ids of
+# the posts a search found, plus the index of the selected textbook grade and the page of the list keyboard it is on.
+@dataclass(slots=True)
+class Session:
+	state: State = State.CATEGORY_SELECTION
+	previous_state: State | None = None
+	category: str | None = None
+	subcategory: str | None = None
+	post_ids: tuple[int, ...] | None = None
+	item_index: int | None = None
+	page: int = 0
+	touched: float = field(default_factory=time.time)
+
+	def to_json(self) -> str:
+		return json.dumps(asdict(self), ensure_ascii=False)
+
+	@classmethod
+	def from_json(cls, data: str) -> "Session":
+		values = json.loads(data)
+		values["state"] = State(values["state"])
+		if values.get("previous_state"):
+			values["previous_state"] = State(values["previous_state"])
+		if values.get("post_ids") is not None:
+			values["post_ids"] = tuple(values["post_ids"])
+		return cls(**values)
+
+	def size(self) -> int:
+		"""Approximate number of bytes the session takes in memory."""
+		total = sys.getsizeof(self)
+		for f in fields(self):
+			value = getattr(self, f.name)
+			if isinstance(value, State):
+				continue
+			total += sys.getsizeof(value)
+			if isinstance(value, tuple):
+				total += sum(sys.getsizeof(item) for item in value)
+		return total
+
+# sessions of every chat. at most max_sessions stay in memory, least recently used first out, and sessions idle
+# for longer than idle_ttl are dropped. with a database path, sessions are written there every flush_interval
+# seconds and on shutdown, and read back on demand, so they survive restarts and memory eviction.
+class SessionStore:
+	def __init__(self, max_sessions: int, idle_ttl: float, path: str | None = None):
+		self.max_sessions = max_sessions
+		self.idle_ttl = idle_ttl
+		self._sessions: OrderedDict[int, Session] = OrderedDict()
+		self._dirty: set[int] = set()
+		self._deleted: set[int] = set()
+		self._flush_task = None
+		self._db = None
+		if path:
+			self._db = sqlite3.connect(path, check_same_thread=False)
+			self._db.execute("CREATE TABLE IF NOT EXISTS sessions (chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL, touched REAL NOT NULL)")
+			self._db.commit()
+
+	def __len__(self) -> int:
+		return len(self._sessions)
+
+	def _expired(self, session: Session) -> bool:
+		return time.time() - session.touched > self.idle_ttl
+
+	def _remember(self, chat_id: int, session: Session) -> None:
+		self._sessions[chat_id] = session
+		self._sessions.move_to_end(chat_id)
+		self._dirty.add(chat_id)
+		self._deleted.discard(chat_id)
+		while len(self._sessions) > self.max_sessions:
+			evicted_id, evicted = self._sessions.popitem(last=False)
+			# an evicted session is only kept when it can be read back from the database later
+			if evicted_id in self._dirty:
+				self._dirty.discard(evicted_id)
+				self._write(evicted_id, evicted)
+
+	def peek(self, chat_id: int) -> Session | None:
+		"""Return the in-memory session of a chat without counting it as activity or reading the database."""
+		return self._sessions.get(chat_id)
+
+	def get(self, chat_id: int) -> Session | None:
+		"""Return the session of a chat, or None when it has none or it expired. Reading a session counts as activity."""
+		session = self._sessions.get(chat_id)
+		if session is None and self._db is not None and chat_id not in self._deleted:
+			row = self._db.execute("SELECT data FROM sessions WHERE chat_id = ?", (chat_id,)).fetchone()
+			session = Session.from_json(row[0]) if row else None
+		if session is None:
+			return None
+		if self._expired(session):
+			self.pop(chat_id)
+			return None
+		session.touched = time.time()
+		self._remember(chat_id, session)
+		return session
+
+	def reset(self, chat_id: int) -> Session:
+		"""Start a fresh session for a chat."""
+		session = Session()
+		self._remember(chat_id, session)
+		return session
+
+	def save(self, chat_id: int) -> None:
+		"""Mark the in-memory session of a chat as changed, so the next flush writes it. Handlers change sessions
+		after awaits, and a flush may have run since the session was read."""
+		if chat_id in self._sessions:
+			self._dirty.add(chat_id)
+
+	def pop(self, chat_id: int) -> None:
+		"""Forget the session of a chat."""
+		self._sessions.pop(chat_id, None)
+		self._dirty.discard(chat_id)
+		if self._db is not None:
+			self._deleted.add(chat_id)
+
+	def _write(self, chat_id: int, session: Session) -> None:
+		if self._db is not None:
+			self._db.execute("INSERT OR REPLACE INTO sessions (chat_id, data, touched) VALUES (?, ?, ?)", (chat_id, session.to_json(), session.touched))
+
+	def flush(self) -> None:
+		"""Write changed sessions to the database and drop expired ones everywhere."""
+		for chat_id, session in list(self._sessions.items()):
+			if self._expired(session):
+				self.pop(chat_id)
+		if self._db is None:
+			return
+		for chat_id in self._dirty:
+			self._write(chat_id, self._sessions[chat_id])
+		self._db.executemany("DELETE FROM sessions WHERE chat_id = ?", [(chat_id,) for chat_id in self._deleted])
+		self._db.execute("DELETE FROM sessions WHERE touched < ?", (time.time() - self.idle_ttl,))
+		self._db.commit()
+		self._dirty.clear()
+		self._deleted.clear()
+
+	async def _flush_forever(self, interval: float) -> None:
+		while True:
+			await asyncio.sleep(interval)
+			try:
+				self.flush()
+			except sqlite3.Error as e:
+				log.error(f"Session flush error: {e}")
+
+	def start(self, interval: float) -> None:
+		"""Flush the sessions periodically in the background."""
+		if self._flush_task is None or self._flush_task.done():
+			self._flush_task = asyncio.create_task(self._flush_forever(interval))
+
+	async def stop(self) -> None:
+		"""Stop the background flush and write everything out one last time."""
+		if self._flush_task is not None:
+			self._flush_task.cancel()
+			try:
+				await self._flush_task
+			except asyncio.CancelledError:
+				pass
+			self._flush_task = None
+		self.flush()
+
+	def memory_report(self) -> dict:
+		"""Return how many sessions are in memory and roughly how many bytes they take."""
+		session_bytes = sum(session.size() for session in self._sessions.values())
+		return {
+			"sessions": len(self._sessions),
+			"session_bytes": session_bytes,
+			"index_bytes": sys.getsizeof(self._sessions) + sys.getsizeof(self._dirty) + sys.getsizeof(self._deleted),
+			"bytes_per_session": session_bytes // len(self._sessions) if self._sessions else 0
+		}
+
+# the sessions of every chat talking to the bot
+sessions = SessionStore(settings.SESSION_MAX_ENTRIES, settings.SESSION_IDLE_TTL, settings.SESSION_DB_PATH or None)
@@ -12,6 +12,140 @@ class Settings(BaseSettings):
 	BASE_URL: str
 	# The channel users must join to use the bot
 	CHANNEL_USERNAME: str
+	# membership gate: off by default, seconds a positive and a negative answer are trusted, and seconds between
+	# reloads of the whole member list (0 turns the reload off, it needs the bot to be a channel admin)
+	MEMBERSHIP_CHECK_ENABLED: bool = False
+	MEMBERSHIP_POSITIVE_TTL: float = 3600.0
+	MEMBERSHIP_NEGATIVE_TTL: float = 30.0
+	MEMBERSHIP_REFRESH_INTERVAL: float = 0
+
+	# shared HTTP client: connection pool size in total and per host
+	HTTP_POOL_LIMIT: int = 100
+	HTTP_POOL_LIMIT_PER_HOST: int = 10
+	# seconds to keep resolved hostnames and idle keep-alive connections around
+	HTTP_DNS_CACHE_TTL: int = 300
+	HTTP_KEEPALIVE_TIMEOUT: float = 30.0
+	# default timeouts in seconds for connecting and for waiting on socket reads
+	HTTP_CONNECT_TIMEOUT: float = 15.0
+	HTTP_READ_TIMEOUT: float = 60.0
+	# total timeouts in seconds for HEAD checks and buffered file downloads (streamed ones only time out when stalled)
+	HTTP_HEAD_TIMEOUT: float = 10.0
+	HTTP_DOWNLOAD_TIMEOUT: float = 300.0
+
+	# sqlite file remembering telegram references of uploaded files, and how many seconds an entry is trusted
+	FILE_CACHE_PATH: str = "file_cache.db"
+	FILE_CACHE_MAX_AGE: float = 30 * 24 * 3600
+
+	# stream downloads straight into telegram uploads instead of buffering whole files in memory.
+	# each transfer keeps at most STREAM_MEMORY_MB in memory and spills up to STREAM_SPILL_MB to a temporary file
+	STREAMING_ENABLED: bool = True
+	STREAM_MEMORY_MB: int = 8
+	STREAM_SPILL_MB: int = 256
+	# ranged downloads, used when a host accepts byte ranges and a file spans at least two segments: connections
+	# per file, segment size, segments held ahead of the upload (a file keeps at most this many segments in memory)
+	# and how many times a broken segment is resumed before the download fails
+	DOWNLOAD_CONNECTIONS: int = 4
+	DOWNLOAD_SEGMENT_MB: int = 4
+	DOWNLOAD_WINDOW_SEGMENTS: int = 8
+	DOWNLOAD_SEGMENT_RETRIES: int = 5
+	# parallel uploads of files of at least PARALLEL_UPLOAD_MIN_MB (smaller ones use one connection): extra connections
+	# to telegram, parts in flight on each, part size in KB (a divisor of 512), retries of a failed part, and a cap
+	# on the upload speed of all files together in MB per second (0 for none)
+	PARALLEL_UPLOAD_MIN_MB: int = 20
+	UPLOAD_CONNECTIONS: int = 4
+	UPLOAD_WINDOW: int = 4
+	UPLOAD_PART_KB: int = 512
+	UPLOAD_PART_RETRIES: int = 5
+	UPLOAD_MAX_MBPS: float = 0
+	# directory of the on-disk cache of downloaded files (empty turns it off) and the most MB it may hold
+	DOWNLOAD_CACHE_DIR: str = "download_cache"
+	DOWNLOAD_CACHE_MB: int = 10240
+	# files of a multi-file post that are already downloading while the current one uploads
+	PREFETCH_FILES: int = 2
+
+	# the files of a post go out as albums of up to this many consecutive files of the same kind (telegram allows 10,
+	# 0 or 1 sends every file on its own)
+	ALBUM_MAX_FILES: int = 10
+
+	# delivery job queue: worker count, most jobs allowed to wait, most bytes downloading at once,
+	# and seconds between queue position updates sent to waiting users
+	JOB_WORKERS: int = 4
+	JOB_QUEUE_MAX_DEPTH: int = 500
+	JOB_MAX_INFLIGHT_MB: int = 4096
+	QUEUE_FEEDBACK_INTERVAL: float = 5.0
+	# per-chat actors: updates of one chat allowed to wait while an earlier one is handled, and seconds an actor
+	# with nothing to do is kept before it goes away
+	CHAT_MAX_PENDING_UPDATES: int = 20
+	CHAT_ACTOR_IDLE_TIMEOUT: float = 60.0
+
+	# chat sessions: most kept in memory, seconds of inactivity before one is dropped, sqlite file to keep them
+	# across restarts (empty for memory only) and seconds between writes to it
+	SESSION_MAX_ENTRIES: int = 50000
+	SESSION_IDLE_TTL: float = 7 * 24 * 3600.0
+	SESSION_DB_PATH: str = "sessions.db"
+	SESSION_FLUSH_INTERVAL: float = 30.0
+
+	# outgoing telegram calls per second and burst size, for the whole bot and for each chat
+	SEND_GLOBAL_RATE: float = 25.0
+	SEND_GLOBAL_BURST: float = 30.0
+	SEND_CHAT_RATE: float = 1.0
+	SEND_CHAT_BURST: float = 3.0
+
+	# seconds a category listing is served from memory, and how much longer it may be served while it is refreshed
+	CATEGORY_CACHE_TTL: float = 600.0
+	CATEGORY_CACHE_STALE_TTL: float = 6 * 3600.0
+
+	# HTML tree builder: "html5lib", "lxml", "html.parser" or "auto" (lxml for the pages it parses exactly like
+	# html5lib, html5lib for the rest), and seconds before a page is checked against html5lib again under "auto"
+	HTML_PARSER: str = "html5lib"
+	HTML_PARSER_CHECK_TTL: float = 24 * 3600.0
+	# parsed post and textbook pages: seconds they are fresh, seconds they may be served while revalidated, and how many are kept
+	PAGE_CACHE_TTL: float = 600.0
+	PAGE_CACHE_STALE_TTL: float = 24 * 3600.0
+	PAGE_CACHE_MAX_ENTRIES: int = 2000
+
+	# link validation: HEAD requests running at once in total and per host, and seconds a HEAD result is reused
+	LINK_CHECK_CONCURRENCY: int = 32
+	LINK_CHECK_PER_HOST: int = 8
+	HEAD_CACHE_TTL: float = 600.0
+	HEAD_CACHE_MAX_ENTRIES: int = 20000
+
+	# local sqlite index of the site used for /search and category browsing, and seconds between incremental syncs
+	CATALOG_ENABLED: bool = True
+	CATALOG_PATH: str = "catalog.db"
+	CATALOG_SYNC_INTERVAL: float = 900.0
+
+	# preload every category listing and the textbook pages before taking updates, giving up after WARMUP_TIMEOUT seconds
+	WARMUP_ENABLED: bool = True
+	WARMUP_TIMEOUT: float = 120.0
+	# speculative prefetch of post pages and file metadata when a list is shown: entries of a list considered (0 turns
+	# it off), picks an entry needs before it is prefetched, loads at once, loads per second and burst, and seconds
+	# a prefetched entry is not loaded again
+	SPECULATIVE_PREFETCH_PER_LIST: int = 3
+	SPECULATIVE_PREFETCH_MIN_PICKS: int = 1
+	SPECULATIVE_PREFETCH_CONCURRENCY: int = 4
+	SPECULATIVE_PREFETCH_RATE: float = 2.0
+	SPECULATIVE_PREFETCH_BURST: float = 10.0
+	SPECULATIVE_PREFETCH_RECENT_TTL: float = 300.0
+
+	# posts or files shown on one page of an inline list keyboard
+	KEYBOARD_PAGE_SIZE: int = 10
+
+	# prometheus metrics served on http://METRICS_HOST:METRICS_PORT/metrics, and the log level and format (JSON lines or text)
+	METRICS_ENABLED: bool = True
+	METRICS_HOST: str = "127.0.0.1"
+	METRICS_PORT: int = 9108
+	LOG_LEVEL: str = "INFO"
+	LOG_JSON: bool = True
+	# seconds between event loop lag samples (0 turns the monitor off) and the lag worth a warning in the log
+	LOOP_LAG_INTERVAL: float = 0.5
+	LOOP_LAG_WARN: float = 0.25
+
+	# HTML parsing: worker processes (0 parses on the event loop), most parses submitted at once, and documents up to
+	# this many characters are parsed in process since sending them to a worker costs more than the parse itself
+	PARSE_WORKERS: int = 2
+	PARSE_MAX_PENDING: int = 64
+	PARSE_INLINE_MAX_CHARS: int = 16384
 
 	# pydantic way of handling environment variable loading like dotenv
 	class Config:
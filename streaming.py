@@ -0,0 +1,312 @@
+"""streaming downloads that feed telegram's part based uploader while they are still running"""
+import asyncio
+import logging
+import re
+import tempfile
+import time
+import aiohttp
+import metrics
+from settings import settings
+from utils import get_http_session
+
+log = logging.getLogger(__name__)
+
+# "bytes first-last/total" of a 206 response
+_CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+def _transfer_timeout() -> aiohttp.ClientTimeout:
+	# a transfer may take as long as it needs while data keeps coming, only a stalled connection times out.
+	# the upload reading the stream paces the download, so a total limit would cut off slow uploads too
+	return aiohttp.ClientTimeout(total=None, connect=settings.HTTP_CONNECT_TIMEOUT, sock_read=settings.HTTP_READ_TIMEOUT)
+
+# async file-like object filled by a background download and drained by telethon's upload_file.
+# chunks are kept in memory up to memory_limit bytes, anything beyond that spills to a temporary file
+# of at most spill_limit bytes, and once both are full the download waits for the uploader to catch up.
+class StreamingDownload:
+	def __init__(self, url: str, filename: str, size: int, memory_limit: int, spill_limit: int, chunk_size: int = 64*1024):
+		self.url = url
+		self.name = filename
+		self.size = size
+		self.memory_limit = memory_limit
+		self.spill_limit = spill_limit
+		self.chunk_size = chunk_size
+		self.received = 0
+		self._buffer = bytearray()
+		self._spill = None
+		self._spill_read = 0
+		self._spill_write = 0
+		self._done = False
+		self._error = None
+		self._data_ready = asyncio.Event()
+		self._space_ready = asyncio.Event()
+		self._task = None
+
+	def start(self) -> "StreamingDownload":
+		"""Start downloading in the background."""
+		if self._task is None:
+			self._task = asyncio.create_task(self._download())
+		return self
+
+	@property
+	def _spill_pending(self) -> int:
+		return self._spill_write - self._spill_read
+
+	async def _download(self) -> None:
+		session = await get_http_session()
+		started = time.perf_counter()
+		try:
+			async with session.get(self.url, timeout=_transfer_timeout()) as response:
+				if response.status != 200:
+					raise IOError(f"unexpected status {response.status} for {self.url}")
+				async for chunk in response.content.iter_chunked(self.chunk_size):
+					await self._put(chunk)
+			if self.received != self.size:
+				raise IOError(f"got {self.received} of {self.size} bytes of {self.url}")
+			metrics.observe_download("stream", self.received, time.perf_counter() - started)
+		except asyncio.CancelledError:
+			self._error = IOError(f"download of {self.url} was cancelled")
+			raise
+		except Exception as e:
+			metrics.ERRORS.inc(stage="download")
+			log.warning(f"Download error: {e}", extra={"url": self.url})
+			self._error = e
+		finally:
+			self._done = True
+			self._data_ready.set()
+
+	async def _put(self, chunk: bytes) -> None:
+		while True:
+			# memory only takes chunks while nothing older is waiting on disk, so the order is kept
+			if not self._spill_pending and (len(self._buffer) + len(chunk) <= self.memory_limit or not self._buffer):
+				self._buffer += chunk
+				break
+			if self._spill_pending + len(chunk) <= self.spill_limit:
+				if self._spill is None:
+					self._spill = tempfile.TemporaryFile()
+				self._spill.seek(self._spill_write)
+				self._spill.write(chunk)
+				self._spill_write += len(chunk)
+				break
+			# both buffers are full, wait for the uploader to read some data
+			self._space_ready.clear()
+			await self._space_ready.wait()
+
+		self.received += len(chunk)
+		self._data_ready.set()
+
+	async def read(self, size: int = -1) -> bytes:
+		"""Read up to size bytes, waiting for the download when not enough data has arrived yet."""
+		while not self._done and (size < 0 or len(self._buffer) + self._spill_pending < size):
+			self._data_ready.clear()
+			await self._data_ready.wait()
+
+		available = len(self._buffer) + self._spill_pending
+		if self._error and (size < 0 or available < size):
+			raise self._error
+		if size < 0 or size > available:
+			size = available
+
+		data = bytes(self._buffer[:size])
+		del self._buffer[:size]
+		if len(data) < size:
+			self._spill.seek(self._spill_read)
+			spilled = self._spill.read(size - len(data))
+			self._spill_read += len(spilled)
+			data += spilled
+			# reuse the temporary file from the beginning once it is drained
+			if not self._spill_pending:
+				self._spill_read = self._spill_write = 0
+				self._spill.truncate(0)
+
+		self._space_ready.set()
+		return data
+
+	async def close(self) -> None:
+		"""Stop the download and release the buffers and the temporary file."""
+		if self._task is not None and not self._task.done():
+			self._task.cancel()
+			try:
+				await self._task
+			except (asyncio.CancelledError, Exception):
+				pass
+		self._buffer = bytearray()
+		if self._spill is not None:
+			self._spill.close()
+			self._spill = None
+
+# the origin answered a range request with the whole file
+class RangesNotSupported(Exception):
+	pass
+
+# async file-like object, like StreamingDownload, filled by several connections at once. the file is split into
+# segments of segment_size bytes that up to connections workers fetch with range requests, never more than window
+# segments ahead of the reader so memory stays bounded. a segment whose connection breaks resumes from the last
+# byte it received, up to retries times, every response must cover exactly the bytes asked for of a file of the
+# expected size, and when the origin ignores ranges before anything was read the download turns into a single stream.
+class RangedDownload:
+	def __init__(self, url: str, filename: str, size: int, connections: int, segment_size: int, window: int, retries: int, chunk_size: int = 64*1024):
+		self.url = url
+		self.name = filename
+		self.size = size
+		self.segment_size = segment_size
+		self.window = max(window, connections)
+		self.retries = retries
+		self.chunk_size = chunk_size
+		self.received = 0
+		self.resumes = 0
+		self.segments = -(-size // segment_size)
+		self.connections = min(connections, self.segments)
+		self._next_segment = 0
+		self._fetched = 0
+		self._read_segment = 0
+		self._read_offset = 0
+		self._position = 0
+		self._finished: dict[int, bytearray] = {}
+		self._error = None
+		self._fallback: StreamingDownload | None = None
+		self._changed = asyncio.Condition()
+		self._tasks: list[asyncio.Task] = []
+		self._started = 0.0
+
+	def start(self) -> "RangedDownload":
+		"""Start the download workers in the background."""
+		if not self._tasks:
+			self._started = time.perf_counter()
+			self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.connections)]
+		return self
+
+	async def _fail(self, error: Exception) -> None:
+		async with self._changed:
+			if self._error is None and self._fallback is None:
+				if isinstance(error, RangesNotSupported) and self._position == 0:
+					log.info(f"Ranges refused, downloading as a single stream: {error}", extra={"url": self.url})
+					self._fallback = StreamingDownload(self.url, self.name, self.size, settings.STREAM_MEMORY_MB * 1024 * 1024, settings.STREAM_SPILL_MB * 1024 * 1024, self.chunk_size).start()
+					self._finished.clear()
+				else:
+					metrics.ERRORS.inc(stage="download")
+					log.warning(f"Download error: {error}", extra={"url": self.url})
+					self._error = error
+			self._changed.notify_all()
+
+	def _stopped(self) -> bool:
+		return self._error is not None or self._fallback is not None
+
+	async def _worker(self) -> None:
+		while True:
+			async with self._changed:
+				await self._changed.wait_for(lambda: self._stopped() or self._next_segment >= self.segments or self._next_segment < self._read_segment + self.window)
+				if self._stopped() or self._next_segment >= self.segments:
+					return
+				index = self._next_segment
+				self._next_segment += 1
+			try:
+				data = await self._fetch_segment(index)
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				await self._fail(e)
+				return
+			async with self._changed:
+				if self._stopped():
+					return
+				self._finished[index] = data
+				self._fetched += 1
+				if self._fetched == self.segments:
+					metrics.observe_download("ranged", self.size, time.perf_counter() - self._started)
+				self._changed.notify_all()
+
+	async def _fetch_segment(self, index: int) -> bytearray:
+		first = index * self.segment_size
+		last = min(self.size, first + self.segment_size) - 1
+		expected = last - first + 1
+		data = bytearray()
+		session = await get_http_session()
+		failures = 0
+		while len(data) < expected:
+			offset = first + len(data)
+			try:
+				async with session.get(self.url, headers={"Range": f"bytes={offset}-{last}"}, timeout=_transfer_timeout()) as response:
+					if response.status == 200:
+						raise RangesNotSupported(f"{self.url} answered a range request with the whole file")
+					if response.status != 206:
+						raise IOError(f"unexpected status {response.status} for {self.url}")
+					match = _CONTENT_RANGE.fullmatch(response.headers.get("Content-Range", "").strip())
+					if not match or (int(match[1]), int(match[2])) != (offset, last):
+						raise IOError(f"{self.url} sent range {response.headers.get('Content-Range')!r} for bytes {offset}-{last}")
+					if match[3] != "*" and int(match[3]) != self.size:
+						raise IOError(f"{self.url} changed size from {self.size} to {match[3]} bytes")
+					async for chunk in response.content.iter_chunked(self.chunk_size):
+						if len(data) + len(chunk) > expected:
+							raise IOError(f"{self.url} sent more than the {expected} bytes of segment {index}")
+						data += chunk
+						self.received += len(chunk)
+				if len(data) < expected:
+					raise aiohttp.ClientPayloadError(f"segment {index} ended after {len(data)} of {expected} bytes")
+			except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+				failures += 1
+				if failures > self.retries:
+					raise IOError(f"segment {index} of {self.url} failed {failures} times: {e}") from e
+				self.resumes += 1
+				metrics.DOWNLOAD_RESUMES.inc()
+				log.info(f"Segment {index} broke at {len(data)} of {expected} bytes, resuming: {e}", extra={"url": self.url})
+				await asyncio.sleep(min(0.5 * 2 ** (failures - 1), 10.0))
+		return data
+
+	async def read(self, size: int = -1) -> bytes:
+		"""Read up to size bytes in order, waiting for the segments they are in when those have not arrived yet."""
+		if self._fallback is not None:
+			return await self._fallback.read(size)
+		if size < 0:
+			size = self.size - self._position
+		out = bytearray()
+		while len(out) < size and self._position < self.size:
+			async with self._changed:
+				await self._changed.wait_for(lambda: self._stopped() or self._read_segment in self._finished)
+				if self._fallback is not None:
+					return await self._fallback.read(size)
+				if self._read_segment not in self._finished:
+					raise self._error
+				segment = self._finished[self._read_segment]
+			piece = segment[self._read_offset:self._read_offset + size - len(out)]
+			out += piece
+			self._read_offset += len(piece)
+			self._position += len(piece)
+			if self._read_offset == len(segment):
+				# the segment is drained, free it and let the workers fetch one more
+				async with self._changed:
+					del self._finished[self._read_segment]
+					self._read_segment += 1
+					self._read_offset = 0
+					self._changed.notify_all()
+		return bytes(out)
+
+	async def close(self) -> None:
+		"""Stop the workers and release the buffered segments."""
+		for task in self._tasks:
+			task.cancel()
+		await asyncio.gather(*self._tasks, return_exceptions=True)
+		self._finished.clear()
+		if self._fallback is not None:
+			await self._fallback.close()
+
+def open_stream(url: str, filename: str, size: int) -> StreamingDownload:
+	"""Start a streaming download capped by the configured per-transfer memory and spill sizes."""
+	return StreamingDownload(
+		url, filename, size,
+		memory_limit=settings.STREAM_MEMORY_MB * 1024 * 1024,
+		spill_limit=settings.STREAM_SPILL_MB * 1024 * 1024
+	).start()
+
+def open_download(url: str, filename: str, size: int, accept_ranges: bool) -> StreamingDownload | RangedDownload:
+	"""Start a ranged download over several connections when the origin supports ranges and the file spans at
+	least two segments, otherwise a single streaming download."""
+	segment_size = settings.DOWNLOAD_SEGMENT_MB * 1024 * 1024
+	if accept_ranges and settings.DOWNLOAD_CONNECTIONS > 1 and size >= 2 * segment_size:
+		return RangedDownload(
+			url, filename, size,
+			connections=settings.DOWNLOAD_CONNECTIONS,
+			segment_size=segment_size,
+			window=settings.DOWNLOAD_WINDOW_SEGMENTS,
+			retries=settings.DOWNLOAD_SEGMENT_RETRIES
+		).start()
+	return open_stream(url, filename, size)
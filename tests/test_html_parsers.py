@@ -0,0 +1,84 @@
+"""differential test of the lxml tree builder against html5lib, the parser the link extraction was written against"""
+import asyncio
+import os
+
+# settings the bot refuses to start without, none of them is used by the parsers
+for name, value in {"API_ID": "1", "API_HASH": "test", "BOT_TOKEN": "test", "BASE_URL": "https://example.com", "CHANNEL_USERNAME": "@test", "PARSE_WORKERS": "0"}.items():
+	os.environ.setdefault(name, value)
+
+import pytest
+import utils
+
+BASE = "https://example.com"
+
+def post_page(content: str) -> str:
+	# an elementor post page with the theme noise around the content, like the site serves it
+	return (
+		f'<html><head><title>post</title></head><body><nav><ul><li><a href="{BASE}/category/x/">x</a></li></ul></nav>'
+		f'<div class="elementor-widget-theme-post-content"><div class="elementor-widget-container">'
+		f'<div class="post-ser-css"><a href="{BASE}/files/other.mkv">series</a></div>{content}<p> </p></div></div>'
+		f"<footer>{'<p>footer</p>' * 5}</footer></body></html>"
+	)
+
+POST_CONTENT = (
+	"<p>عنوان پست</p>"
+	+ "".join(f'<p><a href="{BASE}/files/1-{number}.mkv">قسمت {number + 1}</a></p>' for number in range(3))
+	+ f'<audio class="wp-audio-shortcode" controls><source src="{BASE}/files/a.mp3"><a href="{BASE}/files/a.mp3">{BASE}/files/a.mp3</a></audio>'
+	+ f'<p><a href="{BASE}/files/a.mp3">دانلود صوت</a> | <a href="{BASE}/files/1.zip"><strong>زیرنویس</strong></a></p>'
+	+ f'<p><a href="{BASE}/tag/x/">tag</a> <a href="{BASE}/files/2.mp4#t=1">skip</a></p>'
+)
+
+TEXTBOOK_PAGE = "<html><body><div>" + "".join(
+	f"<h2>پایه {grade}</h2>" + "".join(f'<p><a href="{BASE}/scb/{grade}/book-{book}.zip">کتاب {book} پایه {grade}</a></p>' for book in range(3))
+	for grade in range(1, 4)
+) + f'<p><a href="{BASE}/wp-login.php">login</a></p></div></body></html>'
+
+# (parse function, document) pairs both tree builders read the same way
+WELL_FORMED = [
+	(utils.parse_post_links, post_page(POST_CONTENT)),
+	(utils.parse_content_links, POST_CONTENT),
+	(utils.parse_textbook_items, TEXTBOOK_PAGE),
+]
+
+# broken markup common in wordpress pages, which lxml repairs differently from html5lib and browsers
+MALFORMED = [
+	(utils.parse_post_links, post_page(f'<p><a href="{BASE}/files/d.zip">D<p>more</a></p>')),
+	(utils.parse_content_links, f'<p><a href="{BASE}/files/d.zip">D<p>more</a></p>'),
+	(utils.parse_textbook_items, f'<html><body><h2>پایه 1</h2><p><a href="{BASE}/scb/1/b2.zip">b2<p>b3</a></p></body></html>'),
+]
+
+@pytest.mark.parametrize("parse, document", WELL_FORMED, ids=lambda value: getattr(value, "__name__", ""))
+def test_lxml_matches_html5lib(parse, document):
+	result = parse(document, "html5lib")
+	assert result
+	assert parse(document, "lxml") == result
+	assert utils.differential_parse(document, parse) == (result, True)
+
+@pytest.mark.parametrize("parse, document", MALFORMED, ids=lambda value: getattr(value, "__name__", ""))
+def test_differential_parse_keeps_html5lib_result(parse, document):
+	result = parse(document, "html5lib")
+	assert parse(document, "lxml") != result
+	assert utils.differential_parse(document, parse) == (result, False)
+
+def test_post_clutter_is_removed():
+	links = utils.parse_post_links(post_page(POST_CONTENT))
+	assert links == utils.parse_content_links(POST_CONTENT)
+	assert [href for href, _, _ in links] == [f"{BASE}/files/1-{number}.mkv" for number in range(3)] + [f"{BASE}/files/a.mp3", f"{BASE}/files/1.zip"]
+
+def test_auto_uses_lxml_only_where_it_agreed(monkeypatch):
+	monkeypatch.setattr(utils, "HTML_PARSER", "auto")
+	utils.parser_checks.clear()
+	used = []
+	def parse(document: str, parser: str) -> list:
+		used.append(parser)
+		return utils.parse_content_links(document, parser)
+	well_formed, malformed = POST_CONTENT, MALFORMED[1][1]
+
+	async def run():
+		for _ in range(2):
+			assert await utils.parse_page(parse, well_formed, "well-formed") == utils.parse_content_links(well_formed)
+			assert await utils.parse_page(parse, malformed, "malformed") == utils.parse_content_links(malformed)
+
+	asyncio.run(run())
+	# the first parse of each page checks both builders, later ones trust the answer
+	assert used == ["html5lib", "lxml", "html5lib", "lxml", "lxml", "html5lib"]
@@ -0,0 +1,179 @@
+"""parallel uploads of large files to telegram over several MTProto connections"""
+import asyncio
+import inspect
+import logging
+from telethon import TelegramClient, helpers
+from telethon.errors import FloodWaitError, RPCError
+from telethon.network import MTProtoSender
+from telethon.tl import functions, types
+from telethon.tl.alltlobjects import LAYER
+from ratelimit import TokenBucket
+from settings import settings
+import metrics
+
+log = logging.getLogger(__name__)
+
+# telegram only takes SaveBigFilePart uploads for files larger than this
+BIG_FILE_SIZE = 10 * 1024 * 1024
+
+# updates telegram pushes to the upload connections are dropped, the main connection gets them as well
+class _DiscardUpdates:
+	def put_nowait(self, update) -> None:
+		pass
+
+# one extra connection to the bot's home data center and the number of parts it has in flight
+class UploadSender:
+	def __init__(self, sender: MTProtoSender):
+		self.sender = sender
+		self.inflight = 0
+		self.broken = False
+
+# uploads files of at least min_size bytes as parts sent concurrently over connections extra connections, each with
+# up to window parts in flight, instead of one part after the other over the bot's own connection. the connections
+# are opened on first use and shared by all uploads, so all uploads together keep at most connections * window parts
+# (of part_size bytes each) in flight. a part that fails is sent again on its own, up to retries times, and smaller
+# files, or any file when the connections cannot be opened, go through telethon's upload_file as before.
+class ParallelUploader:
+	def __init__(self, connections: int, window: int, part_size: int, retries: int, min_size: int, max_bytes_per_second: float = 0):
+		self.connections = connections
+		self.window = window
+		self.part_size = part_size
+		self.retries = retries
+		self.min_size = max(min_size, BIG_FILE_SIZE + 1)
+		self._senders: list[UploadSender] = []
+		self._client: TelegramClient | None = None
+		self._lock = asyncio.Lock()
+		self._slots = asyncio.Semaphore(connections * window)
+		self._rate = TokenBucket(max_bytes_per_second, max(max_bytes_per_second, part_size)) if max_bytes_per_second else None
+
+	def handles(self, size: int | None) -> bool:
+		"""Return whether a file of this size is uploaded in parallel."""
+		return self.connections > 1 and size is not None and size >= self.min_size
+
+	@property
+	def inflight(self) -> int:
+		return sum(sender.inflight for sender in self._senders)
+
+	async def open_sender(self, client: TelegramClient) -> MTProtoSender:
+		"""Open one more connection to the home data center of the client, authorized with its key."""
+		dc = await client._get_dc(client.session.dc_id)
+		sender = MTProtoSender(client.session.auth_key, loggers=client._log, updates_queue=_DiscardUpdates())
+		await sender.connect(client._connection(dc.ip_address, dc.port, dc.id, loggers=client._log, proxy=client._proxy, local_addr=client._local_addr))
+		# every new connection introduces itself before its first real request
+		client._init_request.query = functions.help.GetConfigRequest()
+		await sender.send(functions.InvokeWithLayerRequest(LAYER, client._init_request))
+		return sender
+
+	async def _connected(self, client: TelegramClient) -> list[UploadSender]:
+		async with self._lock:
+			if self._client is not client:
+				await self._disconnect()
+				self._client = client
+			for sender in [s for s in self._senders if s.broken and not s.inflight]:
+				self._senders.remove(sender)
+				await sender.sender.disconnect()
+			while len(self._senders) < self.connections:
+				self._senders.append(UploadSender(await self.open_sender(client)))
+			return list(self._senders)
+
+	async def _send_part(self, senders: list[UploadSender], file_id: int, index: int, count: int, part: bytes) -> None:
+		error = None
+		for attempt in range(self.retries + 1):
+			if attempt:
+				metrics.UPLOAD_PART_RETRIES.inc()
+				log.info(f"Retrying part {index} of {count}: {error}")
+				await asyncio.sleep(min(0.5 * 2 ** (attempt - 1), 10.0))
+			# the least busy healthy connection takes the part
+			usable = [s for s in senders if not s.broken] or senders
+			sender = min(usable, key=lambda s: s.inflight)
+			sender.inflight += 1
+			try:
+				if self._rate is not None:
+					await self._rate.acquire(len(part))
+				if await sender.sender.send(functions.upload.SaveBigFilePartRequest(file_id, index, count, part)):
+					return
+				error = IOError("telegram did not accept the part")
+			except FloodWaitError as e:
+				metrics.FLOOD_WAITS.inc()
+				metrics.FLOOD_WAIT_SECONDS.inc(e.seconds)
+				error = e
+				await asyncio.sleep(e.seconds)
+			except (ConnectionError, asyncio.TimeoutError) as e:
+				sender.broken = True
+				error = e
+			except RPCError as e:
+				error = e
+			finally:
+				sender.inflight -= 1
+		raise IOError(f"part {index} of {count} failed {self.retries + 1} times: {error}")
+
+	async def upload(self, client: TelegramClient, file, file_size: int, file_name: str) -> types.TypeInputFile:
+		"""Upload a file object of file_size bytes, in parallel when it is large enough, and return its input file."""
+		if not self.handles(file_size):
+			return await client.upload_file(file, file_size=file_size, file_name=file_name)
+		try:
+			senders = await self._connected(client)
+		except Exception as e:
+			log.warning(f"Upload connections could not be opened, uploading over the main one: {e}")
+			return await client.upload_file(file, file_size=file_size, file_name=file_name)
+
+		file_id = helpers.generate_random_long()
+		count = -(-file_size // self.part_size)
+		tasks: list[asyncio.Task] = []
+		errors: list[Exception] = []
+
+		async def send(index: int, part: bytes) -> None:
+			try:
+				await self._send_part(senders, file_id, index, count, part)
+			except Exception as e:
+				errors.append(e)
+				raise
+
+		try:
+			for index in range(count):
+				await self._slots.acquire()
+				# the permit goes to the task sending the part, and is given back here if no task took it, be it a
+				# failed or cancelled read or a part that gave up for good
+				task = None
+				try:
+					# stop reading as soon as a part gave up for good
+					if errors:
+						raise errors[0]
+					part = file.read(self.part_size)
+					if inspect.isawaitable(part):
+						part = await part
+					if not part or (len(part) != self.part_size and index < count - 1):
+						raise IOError(f"read {len(part)} bytes for part {index} of {file_name}, the file is shorter than {file_size} bytes")
+					task = asyncio.create_task(send(index, part))
+				finally:
+					if task is None:
+						self._slots.release()
+				# released from a callback since a task cancelled before it started never runs its own cleanup
+				task.add_done_callback(lambda _: self._slots.release())
+				tasks.append(task)
+			await asyncio.gather(*tasks)
+		except BaseException:
+			for task in tasks:
+				task.cancel()
+			await asyncio.gather(*tasks, return_exceptions=True)
+			raise
+		return types.InputFileBig(file_id, count, file_name)
+
+	async def _disconnect(self) -> None:
+		for sender in self._senders:
+			await sender.sender.disconnect()
+		self._senders = []
+
+	async def stop(self) -> None:
+		"""Close the upload connections."""
+		async with self._lock:
+			await self._disconnect()
+			self._client = None
+
+# the uploader every file delivery goes through
+uploader = ParallelUploader(
+	settings.UPLOAD_CONNECTIONS, settings.UPLOAD_WINDOW, settings.UPLOAD_PART_KB * 1024,
+	settings.UPLOAD_PART_RETRIES, settings.PARALLEL_UPLOAD_MIN_MB * 1024 * 1024,
+	settings.UPLOAD_MAX_MBPS * 1024 * 1024
+)
+metrics.Observed("bot_upload_parts_inflight", "File parts being sent over the parallel upload connections.", "gauge", lambda: uploader.inflight)
@@ -4,209 +4,417 @@ import os
 from urllib.parse import urlparse
 import asyncio
 import aiohttp
-from bs4 import BeautifulSoup
+from typing import Any, Callable, Hashable
+from bs4 import BeautifulSoup, SoupStrainer
 from telethon import TelegramClient
+from telethon.errors import UserNotParticipantError
+from telethon.tl import functions, types
 from settings import settings
+from cache import TTLCache
+from parsing import parse_pool
+import metrics
+import logging
 import mimetypes
 import re
+import time
 
 mimetypes.init()
 
-# coded by Amir Ramezani
+log = logging.getLogger(__name__)
+
+# the tree builder used for every parse. html5lib repairs broken markup the way browsers do, which is what the
+# link extraction was written against. lxml is several times faster on large elementor pages but repairs some
+# broken markup differently, so "auto" trusts it only with pages it parsed like html5lib (see parse_page), and
+# falls back to html5lib when lxml is not installed
+def _pick_html_parser(name: str) -> str:
+	if name != "auto":
+		return name
+	try:
+		import lxml  # noqa: F401
+		return "auto"
+	except ImportError:
+		return "html5lib"
+
+HTML_PARSER = _pick_html_parser(settings.HTML_PARSER)
+
+# one long-lived HTTP session shared by every helper, so connections to the site and file hosts stay warm
+_http_session: aiohttp.ClientSession | None = None
+
+async def open_http_session() -> aiohttp.ClientSession:
+	"""Create the shared HTTP session with keep-alive pooling and a DNS cache."""
+	global _http_session
+	if _http_session is None or _http_session.closed:
+		connector = aiohttp.TCPConnector(
+			limit=settings.HTTP_POOL_LIMIT,
+			limit_per_host=settings.HTTP_POOL_LIMIT_PER_HOST,
+			ttl_dns_cache=settings.HTTP_DNS_CACHE_TTL,
+			keepalive_timeout=settings.HTTP_KEEPALIVE_TIMEOUT
+		)
+		timeout = aiohttp.ClientTimeout(total=None, connect=settings.HTTP_CONNECT_TIMEOUT, sock_read=settings.HTTP_READ_TIMEOUT)
+		_http_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+	return _http_session
+
+async def close_http_session() -> None:
+	"""Close the shared HTTP session and release its pooled connections."""
+	global _http_session
+	if _http_session is not None and not _http_session.closed:
+		await _http_session.close()
+	_http_session = None
+
+async def get_http_session() -> aiohttp.ClientSession:
+	"""Return the shared HTTP session, opening it on first use."""
+	if _http_session is None or _http_session.closed:
+		return await open_http_session()
+	return _http_session
+
+# category listings shared by every user, served from memory and refreshed in the background once stale
+category_cache = TTLCache(settings.CATEGORY_CACHE_TTL, stale_ttl=settings.CATEGORY_CACHE_STALE_TTL)
+metrics.watch_cache("category", category_cache)
+
 async def get_posts(category_slug: str, per_page: int = 100) -> list:
+	"""Retrieve the post listing of a category, from the shared cache when possible."""
+	# empty listings are reported as failed loads so they are retried instead of cached
+	async def load() -> list | None:
+		return await fetch_posts(category_slug, per_page) or None
+	return await category_cache.get_or_load((category_slug, per_page), load) or []
+
+# coded by Amir Ramezani
+async def fetch_posts(category_slug: str, per_page: int = 100) -> list:
 	"""Retrieve posts from a specific category via the WordPress JSON API."""
 	base_url = settings.BASE_URL
 	posts = []
 
-	async with aiohttp.ClientSession() as session:
-		try:
-			async with session.get(f"{base_url}/wp-json/wp/v2/categories", params={"slug": category_slug}) as resp:
-				categories = await resp.json()
-				if not categories or not categories[0].get('count', 0):
-					return []
+	session = await get_http_session()
+	try:
+		async with session.get(f"{base_url}/wp-json/wp/v2/categories", params={"slug": category_slug}) as resp:
+			categories = await resp.json()
+			if not categories or not categories[0].get('count', 0):
+				return []
+
+			category_id = categories[0]['id']
+			total_posts = categories[0]['count']
 
-				category_id = categories[0]['id']
-				total_posts = categories[0]['count']
+		# wordpress returns the posts in a paginated form.
+		total_pages = (total_posts + per_page - 1) // per_page
 
-			# wordpress returns the posts in a paginated form.
-			total_pages = (total_posts + per_page - 1) // per_page
-			# retreive posts together in an async form.
-			tasks = [
-				session.get(f"{base_url}/wp-json/wp/v2/posts", params={
+		# each page is read inside its own context so its connection goes back to the pool
+		async def fetch_page(page: int) -> list:
+			with metrics.WP_PAGE_SECONDS.time():
+				async with session.get(f"{base_url}/wp-json/wp/v2/posts", params={
 					"categories": category_id,
 					"page": page,
 					"per_page": per_page,
-					"_fields": "id,title,content,excerpt,link,date"
-				}) for page in range(1, total_pages + 1)
-			]
-			responses = await asyncio.gather(*tasks)
+					# only what the listing keyboard needs, the content is fetched once a post is selected
+					"_fields": "id,title,link,date"
+				}) as response:
+					if response.status == 200:
+						metrics.WP_PAGES.inc(outcome="ok")
+						return await response.json()
+					metrics.WP_PAGES.inc(outcome="error")
+					log.warning(f"Failed to fetch page: {await response.text()}", extra={"category": category_slug, "page": page, "status": response.status})
+					return []
+
+		# retreive posts together in an async form.
+		pages = await asyncio.gather(*(fetch_page(page) for page in range(1, total_pages + 1)))
 
-			# extract from the responces into the given posts list.
-			for response in responses:
-				if response.status == 200:
-					posts.extend(await response.json())
-				else:
-					print(f"Failed to fetch page: {await response.text()}")
+		# extract from the responces into the given posts list.
+		for page_posts in pages:
+			posts.extend(page_posts)
 
-		except aiohttp.ClientError as e:
-			print(f"Network error: {e}")
-		except Exception as e:
-			print(f"Unexpected error: {e}")
+	except aiohttp.ClientError as e:
+		metrics.ERRORS.inc(stage="listing")
+		log.warning(f"Network error: {e}", extra={"category": category_slug})
+	except Exception as e:
+		metrics.ERRORS.inc(stage="listing")
+		log.exception(f"Unexpected error: {e}", extra={"category": category_slug})
 
-		return posts
+	return posts
 
 # coded by Amir Ramezani, modified by hossein Peimani.
-async def get_full_content(post_url: str, is_textbook: bool = False) -> tuple[str, list]:
-	"""Fetch full content of a post, with special handling for textbooks."""
-	async with aiohttp.ClientSession() as session:
-		try:
-			async with session.get(post_url) as response:
-				html = await response.text()
-				soup = BeautifulSoup(html, 'html5lib')
-
-				# handle textbooks and retreive the links
-				if is_textbook:
-					body = soup.find('body')
-					if not body:
-						return "محتوا یافت نشد", []
-
-					items = []
-					current_header = None
-					seen_links = set()
-					for elem in body.find_all(['h2', 'p', 'a'], recursive=True):
-						if elem.name == 'h2':
-							current_header = elem.get_text(strip=True)
-							items.append({"title": current_header, "links": []})
-						elif elem.name == 'a' and current_header:
-							href = elem.get('href', '')
-							description = elem.get_text(strip=True) or ""
-							if (href.startswith(('http://', 'https://')) and 
-								('/scb/' in href or href.endswith(('.zip', '.rar'))) and 
-								'wp-' not in href and 'login' not in href and 'admin' not in href):
-								filename = os.path.basename(urlparse(href).path)
-								link_key = (href, description)
-								if link_key not in seen_links:
-									seen_links.add(link_key)
-									items[-1]["links"].append({"href": href, "filename": filename, "description": description})
-						elif elem.name == 'p' and elem.find('a'):
-							for a in elem.find_all('a'):
-								href = a.get('href', '')
-								description = a.get_text(strip=True) or ""
-								if (href.startswith(('http://', 'https://')) and 
-									('/scb/' in href or href.endswith(('.zip', '.rar'))) and 
-									'wp-' not in href and 'login' not in href and 'admin' not in href):
-									filename = os.path.basename(urlparse(href).path)
-									link_key = (href, description)
-									if link_key not in seen_links:
-										seen_links.add(link_key)
-										if current_header:
-											items[-1]["links"].append({"href": href, "filename": filename, "description": description})
-										else:
-											items.append({"title": description, "links": [{"href": href, "filename": filename, "description": description}]})
-
-					filtered_items = [item for item in items if item["links"]]
-					return "", filtered_items if filtered_items else []
-
-				# parse post case
-				else:
-					content_div = soup.find('div', class_='elementor-widget-theme-post-content')
-					if not content_div:
-						return "محتوا یافت نشد", []
-
-					widget_container = content_div.find('div', class_='elementor-widget-container') or content_div
-					for element in widget_container.find_all(class_=['post-ser-css', 'mejs-container', 'wp-audio-shortcode']):
-						element.decompose()
-					for p in widget_container.find_all('p'):
-						if not p.text.strip() or p.text.strip() == ' ':
-							p.decompose()
-					return str(widget_container), []
-
-		except Exception as e:
-			print(f"Error fetching {post_url}: {e}")
-			return "", []
+def parse_full_content(html: str, is_textbook: bool = False, parser: str = "html5lib") -> tuple[str, list]:
+	"""Parse the full content of a post page, with special handling for textbooks."""
+	soup = BeautifulSoup(html, parser)
 
-# coded by Amir Ramezani
-async def download_to_bytesio(url: str, filename: str, chunk_size: int = 1024*1024) -> io.BytesIO | None:
-	"""Download a file from a URL into a BytesIO buffer asynchronously."""
-	async with aiohttp.ClientSession() as session:
+	# handle textbooks and retreive the links
+	if is_textbook:
+		body = soup.find('body')
+		if not body:
+			return "محتوا یافت نشد", []
+
+		items = []
+		current_header = None
+		seen_links = set()
+		for elem in body.find_all(['h2', 'p', 'a'], recursive=True):
+			if elem.name == 'h2':
+				current_header = elem.get_text(strip=True)
+				items.append({"title": current_header, "links": []})
+			elif elem.name == 'a' and current_header:
+				href = elem.get('href', '')
+				description = elem.get_text(strip=True) or ""
+				if (href.startswith(('http://', 'https://')) and 
+					('/scb/' in href or href.endswith(('.zip', '.rar'))) and 
+					'wp-' not in href and 'login' not in href and 'admin' not in href):
+					filename = os.path.basename(urlparse(href).path)
+					link_key = (href, description)
+					if link_key not in seen_links:
+						seen_links.add(link_key)
+						items[-1]["links"].append({"href": href, "filename": filename, "description": description})
+			elif elem.name == 'p' and elem.find('a'):
+				for a in elem.find_all('a'):
+					href = a.get('href', '')
+					description = a.get_text(strip=True) or ""
+					if (href.startswith(('http://', 'https://')) and 
+						('/scb/' in href or href.endswith(('.zip', '.rar'))) and 
+						'wp-' not in href and 'login' not in href and 'admin' not in href):
+						filename = os.path.basename(urlparse(href).path)
+						link_key = (href, description)
+						if link_key not in seen_links:
+							seen_links.add(link_key)
+							if current_header:
+								items[-1]["links"].append({"href": href, "filename": filename, "description": description})
+							else:
+								items.append({"title": description, "links": [{"href": href, "filename": filename, "description": description}]})
+
+		filtered_items = [item for item in items if item["links"]]
+		return "", filtered_items if filtered_items else []
+
+	# parse post case
+	else:
+		content_div = soup.find('div', class_='elementor-widget-theme-post-content')
+		if not content_div:
+			return "محتوا یافت نشد", []
+
+		widget_container = content_div.find('div', class_='elementor-widget-container') or content_div
+		strip_post_clutter(widget_container)
+		return str(widget_container), []
+
+def strip_post_clutter(content) -> None:
+	"""Remove the series box, the audio player (whose fallback link repeats the file) and empty paragraphs from
+	parsed post content, so only the post's own download links are left."""
+	for element in content.find_all(class_=['post-ser-css', 'mejs-container', 'wp-audio-shortcode']):
+		element.decompose()
+	for p in content.find_all('p'):
+		if not p.text.strip() or p.text.strip() == ' ':
+			p.decompose()
+
+# parsed pages shared by every user, keyed by parser and URL. only the extracted links are kept, never the HTML,
+# and stale entries are served while they are revalidated with the origin's ETag/Last-Modified in the background
+page_cache = TTLCache(settings.PAGE_CACHE_TTL, stale_ttl=settings.PAGE_CACHE_STALE_TTL, max_entries=settings.PAGE_CACHE_MAX_ENTRIES)
+metrics.watch_cache("page", page_cache)
+
+async def fetch_parsed(url: str, parse: Callable[[str], Any]) -> Any:
+	"""Fetch a page and return parse(html), reusing the cached result while the page has not changed."""
+	key = (parse.__name__, url)
+
+	async def load() -> dict | None:
+		previous = page_cache.peek(key)
+		headers = {}
+		if previous and previous["etag"]:
+			headers["If-None-Match"] = previous["etag"]
+		if previous and previous["last_modified"]:
+			headers["If-Modified-Since"] = previous["last_modified"]
+
+		session = await get_http_session()
+		started = time.perf_counter()
 		try:
-			async with session.get(url, timeout=aiohttp.ClientTimeout(total=300)) as response:
+			async with session.get(url, headers=headers) as response:
+				# the page did not change, so the previous parse is still valid
+				if response.status == 304 and previous:
+					metrics.PAGE_FETCH_SECONDS.observe(time.perf_counter() - started, parser=parse.__name__, status=304)
+					return previous
 				if response.status != 200:
+					metrics.PAGE_FETCH_SECONDS.observe(time.perf_counter() - started, parser=parse.__name__, status=response.status)
+					log.warning(f"Error fetching {url}: status {response.status}")
 					return None
-				file_buffer = io.BytesIO()
-				async for chunk in response.content.iter_chunked(chunk_size):
-					file_buffer.write(chunk)
-				file_buffer.name = filename
-				file_buffer.seek(0)
-				return file_buffer
+				html = await response.text()
+				etag = response.headers.get('ETag')
+				last_modified = response.headers.get('Last-Modified')
+			metrics.PAGE_FETCH_SECONDS.observe(time.perf_counter() - started, parser=parse.__name__, status=200)
 		except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-			print(f"Download error: {e}")
-			return None
-		except Exception as e:
-			print(f"Unexpected error: {e}")
+			metrics.ERRORS.inc(stage="page")
+			log.warning(f"Error fetching {url}: {e}")
 			return None
+		# parse functions are plain module level functions so they can be shipped to a parse worker
+		with metrics.PAGE_PARSE_SECONDS.time(parser=parse.__name__):
+			result = await parse_page(parse, html, key)
+		return {"etag": etag, "last_modified": last_modified, "result": result}
+
+	entry = await page_cache.get_or_load(key, load)
+	return entry["result"] if entry else None
+
+def parse_textbook_items(html: str, parser: str = "html5lib") -> list:
+	"""Parse the grades and book links of a textbook page."""
+	return parse_full_content(html, True, parser)[1]
+
+def parse_post_links(html: str, parser: str = "html5lib") -> list[tuple[str, str, str]]:
+	"""Parse the download links of a post page."""
+	content, _ = parse_full_content(html, False, parser)
+	return parse_download_links(content, parser)
+
+# whether lxml parsed a page exactly like html5lib, by parse function and page. a page is checked again once its
+# answer expires, since an edit may have broken its markup
+parser_checks = TTLCache(settings.HTML_PARSER_CHECK_TTL, max_entries=settings.PAGE_CACHE_MAX_ENTRIES)
+
+def differential_parse(html: str, parse: Callable[[str, str], Any]) -> tuple[Any, bool]:
+	"""Parse a page with html5lib and with lxml, returning the html5lib result and whether lxml gave the same."""
+	result = parse(html, "html5lib")
+	return result, parse(html, "lxml") == result
+
+async def parse_page(parse: Callable[[str, str], Any], html: str, key: Hashable) -> Any:
+	"""Run parse(html, parser) with the configured parser, in a parse worker when the page is large. With "auto",
+	a page is parsed with both html5lib and lxml when first seen, and from then on with lxml alone if it gave the
+	same result and with html5lib otherwise."""
+	if HTML_PARSER != "auto":
+		return await parse_pool.run(parse, html, HTML_PARSER)
+	agreed = parser_checks.get(key)
+	if agreed is not None:
+		return await parse_pool.run(parse, html, "lxml" if agreed else "html5lib")
+	result, agreed = await parse_pool.run(differential_parse, html, parse)
+	parser_checks.set(key, agreed)
+	metrics.PARSER_CHECKS.inc(outcome="same" if agreed else "different")
+	if not agreed:
+		log.info(f"lxml and html5lib disagree on {key!r}, keeping html5lib for it")
+	return result
+
+async def get_textbook_items(page_url: str) -> list:
+	"""Return the grades and book links of a textbook page, from the parsed page cache when possible."""
+	return await fetch_parsed(page_url, parse_textbook_items) or []
+
+async def get_post_links(post_url: str) -> list[tuple[str, str, str]]:
+	"""Return the download links of a post page, from the parsed page cache when possible."""
+	return await fetch_parsed(post_url, parse_post_links) or []
+
+# coded by Amir Ramezani
+async def download_to_bytesio(url: str, filename: str, chunk_size: int = 1024*1024) -> io.BytesIO | None:
+	"""Download a file from a URL into a BytesIO buffer asynchronously."""
+	session = await get_http_session()
+	try:
+		started = time.perf_counter()
+		async with session.get(url, timeout=aiohttp.ClientTimeout(total=settings.HTTP_DOWNLOAD_TIMEOUT, connect=settings.HTTP_CONNECT_TIMEOUT, sock_read=settings.HTTP_READ_TIMEOUT)) as response:
+			if response.status != 200:
+				return None
+			file_buffer = io.BytesIO()
+			async for chunk in response.content.iter_chunked(chunk_size):
+				file_buffer.write(chunk)
+			file_buffer.name = filename
+			file_buffer.seek(0)
+		metrics.observe_download("buffered", file_buffer.getbuffer().nbytes, time.perf_counter() - started)
+		return file_buffer
+	except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+		metrics.ERRORS.inc(stage="download")
+		log.warning(f"Download error: {e}", extra={"url": url})
+		return None
+	except Exception as e:
+		metrics.ERRORS.inc(stage="download")
+		log.exception(f"Unexpected error: {e}", extra={"url": url})
+		return None
+
+# HEAD results shared by every user, plus limits on how many link checks run at once overall and per host
+head_cache = TTLCache(settings.HEAD_CACHE_TTL, max_entries=settings.HEAD_CACHE_MAX_ENTRIES)
+metrics.watch_cache("head", head_cache)
+_head_semaphore = asyncio.Semaphore(settings.LINK_CHECK_CONCURRENCY)
+_host_semaphores: dict[str, asyncio.Semaphore] = {}
+
+async def fetch_file_info(url: str) -> dict | None:
+	"""Retrieve the headers of a remote file (filename, type, length, validators), from the HEAD cache when possible."""
+	return await head_cache.get_or_load(url, lambda: head_file_info(url))
+
+async def head_file_info(url: str) -> dict | None:
+	"""Retrieve the headers of a remote file (filename, type, length, validators) using a HEAD request."""
+	host = urlparse(url).netloc
+	host_semaphore = _host_semaphores.setdefault(host, asyncio.Semaphore(settings.LINK_CHECK_PER_HOST))
+	session = await get_http_session()
+	outcome = "error"
+	try:
+		async with _head_semaphore, host_semaphore:
+			# only the request itself is timed, not the wait for a free slot
+			started = time.perf_counter()
+			try:
+				async with session.head(url, timeout=aiohttp.ClientTimeout(total=settings.HTTP_HEAD_TIMEOUT)) as response:
+					outcome = "ok" if response.status == 200 else "status"
+					if response.status != 200:
+						return None
+					content_disp = response.headers.get('Content-Disposition', '')
+					filename = next((part.split('=')[1].strip('"') for part in content_disp.split(';') if 'filename=' in part), None) or os.path.basename(urlparse(url).path)
+					content_length = response.headers.get('Content-Length', '')
+					return {
+						"url": url,
+						"filename": filename,
+						"content_type": response.headers.get('Content-Type', ''),
+						"content_length": int(content_length) if content_length.isdigit() else None,
+						"etag": response.headers.get('ETag'),
+						"last_modified": response.headers.get('Last-Modified'),
+						"accept_ranges": response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+					}
+			finally:
+				metrics.HEAD_SECONDS.observe(time.perf_counter() - started, outcome=outcome)
+	except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+		log.warning(f"Error checking {url}: {e}")
+		return None
 
 # coded by Hossein Peimani
 async def extract_filename(url: str) -> tuple[str, str, str] | None:
 	"""Retrieve file metadata (URL, filename, content type) using a HEAD request."""
-	async with aiohttp.ClientSession() as session:
-		try:
-			async with session.head(url, timeout=aiohttp.ClientTimeout(total=10)) as response:
-				if response.status != 200:
-					return None
-				content_type = response.headers.get('Content-Type', '')
-				content_disp = response.headers.get('Content-Disposition', '')
-				filename = next((part.split('=')[1].strip('"') for part in content_disp.split(';') if 'filename=' in part), None) or os.path.basename(urlparse(url).path)
-				return url, filename, content_type
-		except aiohttp.ClientError as e:
-			print(f"Error checking {url}: {e}")
-			return None
+	file_info = await fetch_file_info(url)
+	if not file_info:
+		return None
+	return url, file_info["filename"], file_info["content_type"]
 
 # coded by Hossein Peimani
 async def filter_links(download_links: list[tuple[str, str, str]]) -> list[tuple[str, str, str]]:
 	"""Filter download links to retain only audio, video, or archive files."""
-	filtered_links = []
+	allowed_extensions = r'\.(mp3|ogg|wav|mp4|mkv|avi|rar|zip)$'
 
-	for url, filename, description in download_links:
-		allowed_extensions = r'\.(mp3|ogg|wav|mp4|mkv|avi|rar|zip)$'
+	async def is_valid(url: str, filename: str) -> bool:
 		if not re.search(allowed_extensions, filename, re.IGNORECASE):
-			continue
+			return False
 
 		file_info = await extract_filename(url)
 		if not file_info:
-			continue
+			return False
 
 		url, server_filename, content_type = file_info
 		mime_type, _ = mimetypes.guess_type(filename)
 
-		if (mime_type and ('audio' in mime_type or 'video' in mime_type or 'zip' in mime_type or 'rar' in mime_type)) or 'audio' in content_type or 'video' in content_type or 'zip' in content_type or 'rar' in content_type:
-			filtered_links.append((url, filename, description))
+		return bool((mime_type and ('audio' in mime_type or 'video' in mime_type or 'zip' in mime_type or 'rar' in mime_type)) or 'audio' in content_type or 'video' in content_type or 'zip' in content_type or 'rar' in content_type)
 
-	return filtered_links
+	# every link is checked at the same time, gather keeps the results in input order
+	results = await asyncio.gather(*(is_valid(url, filename) for url, filename, _ in download_links))
+	return [link for link, valid in zip(download_links, results) if valid]
 
 # coded by Hossein Peimani
-async def check_user_membership(client: TelegramClient, user_id: int) -> bool:
-	return True # For  deactivating the feature
-	"""Verify if a user is a member of the specified Telegram channel."""
+async def check_user_membership(client: TelegramClient, user_id: int) -> bool | None:
+	"""Verify if a user is a member of the specified Telegram channel, returning None when it could not be checked."""
+	if not settings.MEMBERSHIP_CHECK_ENABLED:
+		return True # For  deactivating the feature
+	# ask telegram about this one user instead of walking every member of the channel
 	try:
-		print(f"Checking membership for user {user_id} in channel {settings.CHANNEL_USERNAME}")
-		async for participant in client.iter_participants(settings.CHANNEL_USERNAME):
-			if participant.id == user_id:
-				print(f"Membership result: True (user {user_id} found in channel)")
-				return True
-		print(f"Membership result: False (user {user_id} not found in channel)")
+		result = await client(functions.channels.GetParticipantRequest(settings.CHANNEL_USERNAME, user_id))
+		return not isinstance(result.participant, (types.ChannelParticipantBanned, types.ChannelParticipantLeft))
+	except UserNotParticipantError:
 		return False
 	except Exception as e:
 		if "Chat admin privileges are required" in str(e):
-			print(f"Error: Bot needs admin privileges in {settings.CHANNEL_USERNAME} to check membership!")
+			log.error(f"Bot needs admin privileges in {settings.CHANNEL_USERNAME} to check membership!")
 		else:
-			print(f"Error checking membership for user {user_id}: {e}")
-		return False
+			log.warning(f"Error checking membership for user {user_id}: {e}")
+		return None
 
 # coded by Amir Ramezani, turned into a function by Hossein Peimani
-async def extract_download_links(post_content: str) -> list[tuple[str, str, str]]:
+def parse_download_links(post_content: str, parser: str = "html5lib") -> list[tuple[str, str, str]]:
 	"""Extract download links and descriptions from post content."""
-	soup = BeautifulSoup(post_content, 'html5lib')
+	# html5lib can not build partial trees, the other parsers only need to look at the anchors
+	parse_only = SoupStrainer('a') if parser != 'html5lib' else None
+	return soup_download_links(BeautifulSoup(post_content, parser, parse_only=parse_only))
+
+def parse_content_links(post_content: str, parser: str = "html5lib") -> list[tuple[str, str, str]]:
+	"""Extract download links from the rendered content of a post as the API returns it, without the clutter the
+	post page is cleaned of."""
+	soup = BeautifulSoup(post_content, parser)
+	strip_post_clutter(soup)
+	return soup_download_links(soup)
+
+def soup_download_links(soup) -> list[tuple[str, str, str]]:
 	download_links = []
 	allowed_extensions = r'\.(mp3|ogg|wav|mp4|mkv|avi|rar|zip)$'
 	for a in soup.find_all('a', href=True):
@@ -217,3 +425,7 @@ async def extract_download_links(post_content: str) -> list[tuple[str, str, str]
 			if re.search(allowed_extensions, href, re.IGNORECASE):
 				download_links.append((href, filename, description))
 	return download_links
+
+async def extract_download_links(post_content: str, post_url: str) -> list[tuple[str, str, str]]:
+	"""Extract download links and descriptions from the rendered content of a post, in a parse worker when it is large."""
+	return await parse_page(parse_content_links, post_content, (parse_content_links.__name__, post_url))